@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import numpy as np
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+
+def bucket(timestamps, values, width):
+    """Aggregates a time-sorted series into fixed-width time buckets
+
+    Buckets are aligned to multiples of `width` seconds since the epoch.
+    Returns (bucket_start, min, mean, max, count) arrays.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(timestamps) == 0:
+        empty = np.empty(0)
+        return empty, empty, empty, empty, np.empty(0, dtype=np.int64)
+    keys = np.floor(timestamps / width).astype(np.int64)
+    # Series are sorted, so every bucket is one contiguous run of samples
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    mins = np.minimum.reduceat(values, starts)
+    maxs = np.maximum.reduceat(values, starts)
+    means = np.add.reduceat(values, starts) / counts
+    return keys[starts] * width, mins, means, maxs, counts
+
+
+def lttb(timestamps, values, threshold):
+    """Largest-Triangle-Three-Buckets downsampling to `threshold` points
+
+    Keeps the visual shape of the series (peaks and troughs) far better
+    than taking every n-th sample. The first and last points are kept.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    n = len(timestamps)
+    if threshold >= n or threshold < 3:
+        return timestamps, values
+
+    # Bucket boundaries for the n - 2 points between the first and the last
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    # Average point of every bucket, used as the third triangle vertex
+    sums_t = np.add.reduceat(timestamps[1:n - 1], edges[:-1] - 1)
+    sums_v = np.add.reduceat(values[1:n - 1], edges[:-1] - 1)
+    sizes = np.diff(edges)
+    avg_t = np.r_[sums_t / sizes, timestamps[-1]]
+    avg_v = np.r_[sums_v / sizes, values[-1]]
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    prev = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Twice the triangle area for every candidate point in the bucket
+        areas = np.abs(
+            (timestamps[prev] - avg_t[i + 1]) * (values[lo:hi] - values[prev]) -
+            (timestamps[prev] - timestamps[lo:hi]) * (avg_v[i + 1] - values[prev]))
+        prev = lo + int(np.argmax(areas))
+        selected[i + 1] = prev
+    return timestamps[selected], values[selected]
+
+
+def downsample(timestamps, values, max_points):
+    """Returns at most `max_points` points which are representative for plots"""
+    if len(timestamps) <= max_points:
+        return np.asarray(timestamps), np.asarray(values)
+    return lttb(timestamps, values, max_points)
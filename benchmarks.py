@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""Benchmarks for the storage, log parsing, schedule and control paths
+
+Every benchmark runs in its own process so its peak RSS can be reported.
+Results are written as JSON and can be compared with an earlier run:
+
+    ./benchmarks.py --output before.json
+    ./benchmarks.py --output after.json --compare before.json
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = ["db_insert_single", "db_insert_batched", "log_parse",
+              "schedule_lookup", "offset_cycle"]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction),
+                             len(sorted_values) - 1)]
+
+
+def timed(function, iterations):
+    """Calls function(i) `iterations` times, returns each call's duration"""
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def db_insert(workdir, batch_size, samples):
+    import temperature_db
+
+    db = temperature_db.DatabaseWriter(
+        os.path.join(workdir, "bench.db"), batch_size=batch_size,
+        flush_interval=3600)
+    start_ts = time.time() - samples * 15
+
+    def write(i):
+        db.write("dht_22", timestamp=start_ts + i * 15,
+                 temperature=20 + (i % 50) / 10, humidity=40 + (i % 30) / 10)
+
+    latencies = timed(write, samples)
+    start = time.perf_counter()
+    db.close()
+    return {"ops": samples, "latencies": latencies,
+            "extra": {"close_seconds": time.perf_counter() - start}}
+
+
+def bench_db_insert_single(workdir, args):
+    # One commit per sample, like writing every reading straight away
+    return db_insert(workdir, 1, args.samples // 10)
+
+
+def bench_db_insert_batched(workdir, args):
+    return db_insert(workdir, 20, args.samples)
+
+
+def write_synthetic_logs(log_file, size, files):
+    """Writes `files` rotated room_weather.log files of about `size` bytes"""
+    start = dt.datetime.now() - dt.timedelta(days=files)
+    per_file = size // files
+    lines = 0
+    for day in range(files):
+        path = log_file if day == files - 1 else log_file + "." + (
+            start + dt.timedelta(days=day)).strftime("%Y-%m-%d")
+        now = start + dt.timedelta(days=day)
+        with open(path, "w") as f:
+            written = 0
+            while written < per_file:
+                stamp = now.strftime("%Y-%m-%d %H:%M:%S.") + \
+                    "{:03d}".format(now.microsecond // 1000)
+                chunk = (
+                    "{0} Taking measurements from dht_22\n"
+                    "{0} [DHT22] Temperature = {1:.1f} C\n"
+                    "{0} [DHT22] Humidity = {2:.1f} %\n"
+                    "{0} Taking measurements from sense_hat\n"
+                    "{0} [SenseHat] Temperature = {3:.1f} C\n"
+                    "{0} [SenseHat] Humidity = {2:.1f} %\n"
+                    "{0} [SenseHat] Pressure = 1013.2 millibar\n").format(
+                        stamp, 20 + random.random() * 3,
+                        40 + random.random() * 10, 25 + random.random() * 3)
+                f.write(chunk)
+                written += len(chunk)
+                lines += 7
+                now += dt.timedelta(seconds=15)
+    return lines
+
+
+def bench_log_parse(workdir, args):
+    import process_data
+
+    log_file = os.path.join(workdir, "room_weather.log")
+    lines = write_synthetic_logs(log_file, args.log_size_mb * 2 ** 20,
+                                 args.log_files)
+    size = sum(os.path.getsize(f)
+               for f in process_data.find_log_files(log_file))
+    cache_dir = os.path.join(workdir, "cache")
+    latencies = []
+    for _ in range(args.repeat):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        start = time.perf_counter()
+        timestamps, _ = process_data.load_series(
+            log_file, cache_dir=cache_dir)
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    process_data.load_series(log_file, cache_dir=cache_dir)
+    cached = time.perf_counter() - start
+    return {"ops": args.repeat, "latencies": latencies,
+            "extra": {"bytes": size, "lines": lines,
+                      "samples": len(timestamps),
+                      "mb_per_sec": size / 2 ** 20 * args.repeat /
+                      sum(latencies),
+                      "lines_per_sec": lines * args.repeat / sum(latencies),
+                      "cached_seconds": cached}}
+
+
+def bench_schedule_lookup(workdir, args):
+    from schedule import WeeklySchedule
+
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(dirname, "config.json")) as f:
+        schedule = WeeklySchedule(json.load(f)["days"])
+    rng = random.Random(0)
+    week_start = WeeklySchedule.week_start(dt.datetime.now())
+    times = [week_start + dt.timedelta(seconds=rng.randrange(7 * 24 * 3600))
+             for _ in range(1024)]
+
+    def lookup(i):
+        now = times[i % len(times)]
+        schedule.current_slot(now)
+        schedule.next_transition(now)
+
+    return {"ops": args.samples, "latencies": timed(lookup, args.samples)}
+
+
+def bench_offset_cycle(workdir, args):
+    try:
+        import update_offset
+    except ImportError as e:
+        return {"skipped": "{} (copy configuration.py.template to "
+                           "configuration.py)".format(e)}
+    import thermostat
+    from sensor_feed import SensorFeedWriter
+
+    feed_file = os.path.join(workdir, "feed")
+    feed = SensorFeedWriter(feed_file)
+    sensor = update_offset.SensorSource(feed_file)
+    device = thermostat.FakeThermostat(current_temp=19.0)
+    session = thermostat.ThermostatSession(device, retry_delay=0)
+    slot = {"start": dt.datetime.now(),
+            "end": dt.datetime.now() + dt.timedelta(hours=1)}
+
+    rng = random.Random(0)
+
+    def cycle(i):
+        # Noisy readings around a rounding boundary, "operations" in the
+        # result shows how many writes the filtering still lets through
+        feed.publish("dht_22", 20.5 + rng.gauss(0, 0.3), 45.0)
+        update_offset.correct_offset(session, slot, sensor)
+
+    iterations = max(args.samples // 100, 10)
+    latencies = timed(cycle, iterations)
+    return {"ops": iterations, "latencies": latencies,
+            "extra": {"connections": device.connections,
+                      "operations": device.operations}}
+
+
+def run_benchmark(name, args):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        start = time.perf_counter()
+        result = globals()["bench_" + name](workdir, args)
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if "skipped" in result:
+        return {"name": name, "skipped": result["skipped"]}
+    latencies = sorted(result["latencies"])
+    return dict({
+        "name": name,
+        "ops": result["ops"],
+        "seconds": seconds,
+        "ops_per_sec": result["ops"] / sum(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        # Kilobytes on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }, **result.get("extra", {}))
+
+
+def run_isolated(name, argv):
+    """Runs one benchmark in a fresh interpreter and returns its result"""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", name] + argv,
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+    return revision or None
+
+
+def print_results(results, baseline=None):
+    previous = {r["name"]: r for r in (baseline or {}).get("results", [])}
+    for result in results:
+        if "skipped" in result:
+            print("{:<20} skipped: {}".format(result["name"],
+                                             result["skipped"]))
+            continue
+        line = "{name:<20} {ops_per_sec:>12.1f} ops/s  p50 {p50_ms:9.3f} ms" \
+            "  p99 {p99_ms:9.3f} ms  rss {peak_rss_kb:>7} kB".format(**result)
+        old = previous.get(result["name"])
+        if old is not None and "ops_per_sec" in old:
+            line += "  ({:+.1f}% ops/s)".format(
+                (result["ops_per_sec"] / old["ops_per_sec"] - 1) * 100)
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                        help="benchmarks to run (default: all of {})".format(
+                            ", ".join(BENCHMARKS)))
+    parser.add_argument("--samples", type=int, default=20000,
+                        help="operations for the fast benchmarks")
+    parser.add_argument("--log-size-mb", type=int, default=64,
+                        help="total size of the synthetic logs")
+    parser.add_argument("--log-files", type=int, default=8,
+                        help="number of rotated log files")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of the slow benchmarks")
+    parser.add_argument("--output", default="benchmark-results.json",
+                        help="where to write the results as JSON")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="earlier results to compare with")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_benchmark(args.worker, args)))
+        return
+
+    names = args.benchmarks or BENCHMARKS
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("Unknown benchmarks: {}".format(
+            ", ".join(sorted(unknown))))
+    worker_argv = ["--samples", str(args.samples),
+                   "--log-size-mb", str(args.log_size_mb),
+                   "--log-files", str(args.log_files),
+                   "--repeat", str(args.repeat)]
+    results = [run_isolated(name, worker_argv) for name in names]
+    report = {
+        "created": dt.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "arguments": worker_argv,
+        "results": results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
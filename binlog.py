@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""Compact binary log of readings and thermostat corrections
+
+Every record is one fixed-size little-endian struct per kind:
+
+    2 byte sync marker, uint16 length of the rest, uint8 kind,
+    float64 epoch timestamp, fields
+
+String fields are NUL padded, numeric fields float32 with NaN for missing
+values. Readers skip records of unknown kinds and fields appended to a
+kind later by their length. After garbage, like the NUL padding a power
+loss leaves behind, they resume at the next sync marker. Files rotate at
+midnight like the text logs and rotated files are gzipped.
+"""
+import collections
+import glob
+import gzip
+import logging
+import logging.handlers
+import math
+import os
+import shutil
+import struct
+
+MAGIC = b"\xb1\x7e"
+HEADER = "<2sHBd"
+PREFIX = struct.Struct("<2sH")
+# Lengths outside of these are garbage rather than a record
+MIN_LENGTH = struct.calcsize("<Bd")
+MAX_LENGTH = 1024
+
+# kind: (id, [(field, struct code)]). Only ever append new kinds or fields
+# and never reuse ids, so old files stay readable: fields missing from older,
+# shorter records read as None (NaN in read_columns) and fields unknown to an
+# older reader are skipped.
+KINDS = collections.OrderedDict([
+    ("reading", (1, [("sensor", "10s"), ("temperature", "f"),
+                     ("humidity", "f"), ("pressure", "f")])),
+    ("offset", (2, [("device", "16s"), ("sensor_temp", "f"),
+                    ("sensor_humidity", "f"), ("current_temp", "f"),
+                    ("offset_temp", "f"), ("new_offset", "f"),
+                    ("target_temp_l", "f"), ("target_temp_h", "f"),
+                    ("manual_temp", "f")])),
+])
+
+RECORDS = dict(
+    (kind, collections.namedtuple(kind.capitalize() + "Record", [
+        "timestamp"] + [name for name, _ in fields]))
+    for kind, (_, fields) in KINDS.items())
+STRUCTS = dict(
+    (kind, struct.Struct(HEADER + "".join(code for _, code in fields)))
+    for kind, (_, fields) in KINDS.items())
+KIND_IDS = dict((kind_id, kind) for kind, (kind_id, _) in KINDS.items())
+
+
+def encode(kind, timestamp, fields):
+    kind_id, layout = KINDS[kind]
+    values = []
+    for name, code in layout:
+        value = fields.get(name)
+        if code.endswith("s"):
+            values.append(str(value or "").encode("utf-8"))
+        else:
+            values.append(math.nan if value is None else value)
+    record_struct = STRUCTS[kind]
+    return record_struct.pack(MAGIC, record_struct.size - PREFIX.size,
+                              kind_id, timestamp, *values)
+
+
+def decode(data, offset=0):
+    """Returns the record starting at `offset`, or None if of unknown kind"""
+    kind = KIND_IDS.get(data[offset + PREFIX.size])
+    if kind is None:
+        return None
+    end = offset + PREFIX.size + PREFIX.unpack_from(data, offset)[1]
+    if end - offset < STRUCTS[kind].size:
+        # Written before the trailing fields were added
+        data = data[offset:end] + FILLERS[kind][end - offset:]
+        offset = 0
+    values = STRUCTS[kind].unpack_from(data, offset)[3:]
+    return RECORDS[kind](*(
+        v.rstrip(b"\x00").decode("utf-8", errors="replace")
+        if isinstance(v, bytes) else None if math.isnan(v) else v
+        for v in values))
+
+
+# Records with every field missing, to pad shorter records with
+FILLERS = dict((kind, encode(kind, math.nan, {})) for kind in KINDS)
+
+
+def compress_rotated(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class BinaryLogHandler(logging.handlers.TimedRotatingFileHandler):
+    """Appends the structured records logged with log_record() to a file
+
+    Other log records are ignored, so the handler can share a logger with
+    text handlers.
+    """
+
+    def __init__(self, filename, when="midnight", backupCount=1000):
+        super(BinaryLogHandler, self).__init__(
+            filename, when=when, backupCount=backupCount, delay=True)
+        self.mode = "ab"
+        self.encoding = None
+        self.errors = None
+        self.namer = lambda name: name + ".gz"
+        self.rotator = compress_rotated
+
+    def emit(self, record):
+        structured = getattr(record, "structured", None)
+        if structured is None:
+            return
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(encode(*structured))
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+
+def setup(filename, when="midnight", backup_count=1000):
+    """Returns the logger for log_record(), writing to `filename`"""
+    logger = logging.getLogger("binlog")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(BinaryLogHandler(filename, when, backup_count))
+    return logger
+
+
+def log_record(logger, kind, timestamp, **fields):
+    logger.info(kind, extra={"structured": (kind, timestamp, fields)})
+
+
+def find_log_files(log_file):
+    """Returns the rotated (gzip'd) files of `log_file`, oldest first, then it"""
+    rotated = sorted(f for f in glob.glob(log_file + ".*") if os.path.isfile(f))
+    return rotated + ([log_file] if os.path.isfile(log_file) else [])
+
+
+def record_length(data, offset):
+    """Returns the length of the record at `offset`, None if not at one"""
+    magic, length = PREFIX.unpack_from(data, offset)
+    if magic != MAGIC or not MIN_LENGTH <= length <= MAX_LENGTH:
+        return None
+    return length
+
+
+def uniform_offsets(data, final=False):
+    """Returns (offsets, end) of the leading records of the same kind
+
+    Each daemon only writes one kind of record, so the complete records of
+    a buffer can usually be found by stride instead of one at a time. The
+    last of them is left to scan_offsets(), which checks what follows it,
+    unless the buffer is `final` and holds nothing else.
+    """
+    if len(data) < PREFIX.size + 1:
+        return None, 0
+    length = record_length(data, 0)
+    if length is None:
+        return None, 0
+    stride = PREFIX.size + length
+
+    def uniform(count):
+        end = count * stride
+        return all(data[i:end:stride].count(data[i]) == count
+                   for i in range(PREFIX.size + 1))
+
+    # Bisect for the longest run of records with identical headers
+    total = len(data) // stride
+    low, high = 1, total
+    while low < high:
+        middle = (low + high + 1) // 2
+        if uniform(middle):
+            low = middle
+        else:
+            high = middle - 1
+    count = low if final and low == total and len(data) == total * stride \
+        else low - 1
+    if count <= 0:
+        return None, 0
+    return range(0, count * stride, stride), count * stride
+
+
+def scan_offsets(data, final=False):
+    """Returns (offsets, end) of the complete records up to any garbage
+
+    Garbage is skipped up to the next marker, where it returns so the rest
+    can go through uniform_offsets() again. A record followed by garbage
+    only counts if no marker starts inside it, so a record torn by a crash
+    does not swallow the start of the records written after the restart.
+    """
+    offsets = []
+    offset = 0
+    size = len(data)
+    while offset + PREFIX.size <= size:
+        length = record_length(data, offset)
+        end = offset + PREFIX.size + length if length is not None else None
+        if end is not None and (end > size or (
+                end + len(MAGIC) > size and not final)):
+            # Wait for more data
+            break
+        if end is not None and (
+                end + len(MAGIC) > size or data.startswith(MAGIC, end) or
+                data.find(MAGIC, offset + 1, end) < 0):
+            offsets.append(offset)
+            offset = end
+            continue
+        offset = data.find(MAGIC, offset + 1)
+        if offset < 0:
+            # Keep a last byte which may start a marker
+            return offsets, size - 1
+        if offset + PREFIX.size > size or \
+                record_length(data, offset) is not None:
+            break
+    return offsets, offset
+
+
+def iter_chunks(path, chunk_size=1 << 22):
+    """Yields (buffer, offsets of the complete records in it) for a file"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        data = b""
+        while True:
+            chunk = f.read(chunk_size)
+            final = not chunk
+            data += chunk
+            while True:
+                offsets, offset = uniform_offsets(data, final)
+                if not offsets:
+                    offsets, offset = scan_offsets(data, final)
+                if offsets:
+                    yield data, offsets
+                if offset <= 0:
+                    break
+                data = data[offset:]
+            if final:
+                # Anything left is a torn last record after a crash
+                return
+
+
+def iter_file(path):
+    for data, offsets in iter_chunks(path):
+        for offset in offsets:
+            if data[offset + PREFIX.size] in KIND_IDS:
+                yield decode(data, offset)
+
+
+def read_records(log_file, kinds=None):
+    """Streams the records of a binary log and its rotated files, in order
+
+    `kinds` limits the output to the given record kinds.
+    """
+    wanted = tuple(RECORDS[kind] for kind in kinds) if kinds else None
+    for path in find_log_files(log_file):
+        for record in iter_file(path):
+            if wanted is None or isinstance(record, wanted):
+                yield record
+
+
+def read_columns(log_file, kind, fields, **match):
+    """Reads numeric `fields` of one kind of record as float64 numpy arrays
+
+    Only records whose string fields equal the `match` values are read,
+    e.g. sensor="dht_22". Missing values are NaN. The records are decoded
+    with numpy a chunk at a time instead of one by one like read_records().
+    """
+    import numpy as np
+
+    kind_id, layout = KINDS[kind]
+    dtype = np.dtype([("magic", "S2"), ("length", "<u2"), ("kind", "u1"),
+                      ("timestamp", "<f8")] +
+                     [(name, "S" + code[:-1] if code.endswith("s") else "<f4")
+                      for name, code in layout])
+    columns = dict((name, []) for name in fields)
+    for path in find_log_files(log_file):
+        for data, offsets in iter_chunks(path):
+            raw = np.frombuffer(data, dtype=np.uint8)
+            if isinstance(offsets, range):
+                offsets = np.arange(offsets.start, offsets.stop,
+                                    offsets.step)
+            else:
+                offsets = np.array(offsets, dtype=np.int64)
+            offsets = offsets[raw[offsets + PREFIX.size] == kind_id]
+            positions = offsets[:, None] + np.arange(dtype.itemsize)
+            sizes = PREFIX.size + raw[offsets + 2].astype(np.int64) + \
+                (raw[offsets + 3].astype(np.int64) << 8)
+            if (sizes >= dtype.itemsize).all():
+                rows = raw[positions]
+            else:
+                # Pad records written before trailing fields were added
+                rows = np.tile(np.frombuffer(FILLERS[kind], dtype=np.uint8),
+                               (len(offsets), 1))
+                present = np.arange(dtype.itemsize) < sizes[:, None]
+                rows[present] = raw[positions[present]]
+            rows = rows.view(dtype)[:, 0]
+            selected = np.ones(len(rows), dtype=bool)
+            for name, value in match.items():
+                selected &= rows[name] == value.encode("utf-8")
+            for name in fields:
+                columns[name].append(
+                    rows[name][selected].astype(np.float64))
+    return [np.concatenate(columns[name]) if columns[name] else np.empty(0)
+            for name in fields]
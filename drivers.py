@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+import collections
+import random
+import time
+
+import metrics
+import temperature_db
+
+DHT22_READ_ATTEMPTS = metrics.histogram(
+    "room_dht22_read_attempts", "Attempts needed per DHT22 reading",
+    buckets=(1, 2, 3, 5, 10, 15))
+DHT22_READ_FAILURES = metrics.counter(
+    "room_dht22_read_failures_total", "DHT22 readings which failed all retries")
+
+# Readings are immutable and replaced as a whole, so a reader always sees the
+# values of one sample together without taking a lock
+DHT22Reading = collections.namedtuple(
+    "DHT22Reading", ["timestamp", "temperature", "humidity"])
+SenseHatReading = collections.namedtuple(
+    "SenseHatReading", ["timestamp", "temperature", "humidity", "pressure"])
+READINGS = {"dht_22": DHT22Reading, "sense_hat": SenseHatReading}
+
+# Log lines written by Thermometer.log_reading
+LOG_MARKERS = {
+    "dht_22": {"temperature": "[DHT22] Temperature = ",
+               "humidity": "[DHT22] Humidity = "},
+    "sense_hat": {"temperature": "[SenseHat] Temperature = ",
+                  "humidity": "[SenseHat] Humidity = ",
+                  "pressure": "[SenseHat] Pressure = "},
+}
+
+HARDWARE = ["pi", "simulated", "replay"]
+
+
+def read_dht22_retry(Adafruit_DHT, sensor, pin, retries=15, delay_seconds=2):
+    """Like Adafruit_DHT.read_retry, but records how many attempts it took"""
+    for attempt in range(1, retries + 1):
+        humidity, temperature = Adafruit_DHT.read(sensor, pin)
+        if humidity is not None and temperature is not None:
+            break
+        if attempt < retries:
+            time.sleep(delay_seconds)
+    else:
+        DHT22_READ_FAILURES.inc()
+    DHT22_READ_ATTEMPTS.observe(attempt)
+    return humidity, temperature
+
+
+class Sensor(object):
+    """Source of readings for one sensor
+
+    read() returns a reading namedtuple, or None when the sensor gave no
+    usable data.
+    """
+
+    def read(self):
+        raise NotImplementedError
+
+
+class DHT22Sensor(Sensor):
+    def __init__(self, pin=4):
+        import Adafruit_DHT
+
+        self.Adafruit_DHT = Adafruit_DHT
+        self.pin = pin
+
+    def read(self):
+        humidity, temperature = read_dht22_retry(
+            self.Adafruit_DHT, self.Adafruit_DHT.DHT22, self.pin)
+        if humidity is None or temperature is None:
+            return None
+        return DHT22Reading(time.time(), temperature, humidity)
+
+
+class SenseHatSensor(Sensor):
+    def __init__(self):
+        from sense_hat import SenseHat
+
+        self.sense = SenseHat()
+
+    def read(self):
+        return SenseHatReading(
+            time.time(), self.sense.get_temperature(),
+            self.sense.get_humidity(), self.sense.get_pressure())
+
+
+class SimulatedSensor(Sensor):
+    """Random walk around plausible room values
+
+    Readings are stamped as if taken every `interval` seconds from now on,
+    so runs faster than real time still produce distinct timestamps.
+    `failure_rate` is the share of reads returning None, like a DHT22
+    read_retry that gave up.
+    """
+
+    def __init__(self, sensor, interval=15, temperature=21.0, humidity=45.0,
+                 pressure=1013.0, step=0.05, failure_rate=0.0, seed=None):
+        self.reading = READINGS[sensor]
+        self.interval = interval
+        self.start = time.time()
+        self.count = 0
+        self.values = {"temperature": temperature, "humidity": humidity,
+                       "pressure": pressure}
+        self.step = step
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+
+    def read(self):
+        if self.random.random() < self.failure_rate:
+            return None
+        for name in self.values:
+            self.values[name] += self.random.gauss(0, self.step)
+        timestamp = self.start + self.count * self.interval
+        self.count += 1
+        return self.reading(timestamp, *(
+            self.values[name] for name in self.reading._fields[1:]))
+
+
+def load_db_readings(sensor, db_file=temperature_db.DB_FILE):
+    reading = READINGS[sensor]
+    rows = collections.defaultdict(dict)
+    for metric in reading._fields[1:]:
+        for ts, value in temperature_db.read_samples(
+                sensor, metric, db_file=db_file):
+            rows[ts][metric] = value
+    return [reading(ts, *(values.get(metric)
+                          for metric in reading._fields[1:]))
+            for ts, values in sorted(rows.items())]
+
+
+def load_log_readings(sensor, log_file, max_delay=1):
+    """Rebuilds readings from the room_weather.log lines of one sensor
+
+    The values of one sample are logged one after the other, starting with
+    the temperature. Every other value joins the closest preceding
+    temperature at most `max_delay` seconds before it; samples which end up
+    incomplete are skipped.
+    """
+    import numpy as np
+    import process_data
+
+    reading = READINGS[sensor]
+    first, others = reading._fields[1], reading._fields[2:]
+    timestamps, values = process_data.load_series(
+        log_file, LOG_MARKERS[sensor][first])
+    columns = [values]
+    for metric in others:
+        metric_timestamps, metric_values = process_data.load_series(
+            log_file, LOG_MARKERS[sensor][metric])
+        column = np.full(len(timestamps), np.nan)
+        index = np.searchsorted(timestamps, metric_timestamps,
+                                side="right") - 1
+        matched = (index >= 0) & (metric_timestamps - timestamps[
+            np.maximum(index, 0)] <= max_delay)
+        column[index[matched]] = metric_values[matched]
+        columns.append(column)
+    rows = np.column_stack([timestamps] + columns)
+    rows = rows[~np.isnan(rows).any(axis=1)]
+    return [reading(*row) for row in rows.tolist()]
+
+
+def load_binlog_readings(sensor, log_file):
+    import binlog
+
+    reading = READINGS[sensor]
+    return [reading(record.timestamp, *(getattr(record, metric)
+                                        for metric in reading._fields[1:]))
+            for record in binlog.read_records(log_file, ["reading"])
+            if record.sensor == sensor]
+
+
+class ReplaySensor(Sensor):
+    """Plays back recorded readings, one per read(), in a loop
+
+    Readings are stamped relative to the start of the replay, keeping the
+    recorded spacing, so consumers checking their age see them as current
+    and runs faster than real time still produce distinct timestamps, like
+    with SimulatedSensor. Every pass over the recording continues where the
+    previous one ended. Samples missing a value come back with None.
+    """
+
+    def __init__(self, readings):
+        if not readings:
+            raise ValueError("Nothing to replay")
+        self.readings = readings
+        self.first = readings[0].timestamp
+        self.span = readings[-1].timestamp - self.first + 1
+        self.start = time.time()
+        self.position = 0
+
+    @classmethod
+    def from_source(cls, sensor, source):
+        """Loads a SQLite database (*.db) or a room_weather.bin/.log set"""
+        if source.endswith(".db"):
+            return cls(load_db_readings(sensor, source))
+        if source.endswith(".bin"):
+            return cls(load_binlog_readings(sensor, source))
+        return cls(load_log_readings(sensor, source))
+
+    def read(self):
+        passes, i = divmod(self.position, len(self.readings))
+        self.position += 1
+        reading = self.readings[i]
+        return reading._replace(timestamp=self.start + (
+            reading.timestamp - self.first) + passes * self.span)
+
+
+class FakeStick(object):
+    def __init__(self):
+        self.events = []
+
+    def get_events(self):
+        events, self.events = self.events, []
+        return events
+
+
+class FakeMatrix(object):
+    """The part of the sense_hat.SenseHat LED matrix API this project uses"""
+
+    def __init__(self):
+        self.pixels = [[0, 0, 0]] * 64
+        self.rotation = 0
+        self.writes = 0
+        self.stick = FakeStick()
+
+    def set_rotation(self, rotation):
+        self.rotation = rotation
+
+    def clear(self):
+        self.set_pixels([[0, 0, 0]] * 64)
+
+    def set_pixel(self, x, y, r, g, b):
+        self.pixels[y * 8 + x] = [r, g, b]
+        self.writes += 1
+
+    def set_pixels(self, pixels):
+        self.pixels = [list(p) for p in pixels]
+        self.writes += 1
+
+    def get_pixels(self):
+        return [list(p) for p in self.pixels]
+
+
+class FakeLcd(object):
+    """Stands in for the grove_rgb_lcd module"""
+
+    def __init__(self):
+        self.rgb = None
+        self.text = ""
+
+    def setRGB(self, r, g, b):
+        self.rgb = (r, g, b)
+
+    def setText(self, text):
+        self.text = text
+
+    def setText_norefresh(self, text):
+        self.text = text
+
+
+def make_sensor(hardware, sensor, replay_source=None, interval=15):
+    if hardware == "pi":
+        return DHT22Sensor() if sensor == "dht_22" else SenseHatSensor()
+    if hardware == "simulated":
+        return SimulatedSensor(sensor, interval)
+    if hardware == "replay":
+        return ReplaySensor.from_source(sensor, replay_source)
+    raise ValueError("Unknown hardware '{}'".format(hardware))
+
+
+def make_matrix(hardware):
+    if hardware == "pi":
+        from sense_hat import SenseHat
+
+        return SenseHat()
+    return FakeMatrix()
+
+
+def make_lcd(hardware):
+    if hardware == "pi":
+        import grove_rgb_lcd
+
+        return grove_rgb_lcd
+    return FakeLcd()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import datetime as dt
+import logging
+import threading
+
+
+class EventScheduler(object):
+    """Wakes a control loop at its timers or at external events, whichever first
+
+    Timers are named wall-clock deadlines; setting a timer again replaces
+    it. Events are raised with notify() from any thread, or by watches:
+    cheap functions polled every `poll_interval` seconds which raise their
+    event when their return value changes. Waiting happens in slices of at
+    most `poll_interval` seconds, so that deadlines follow wall-clock
+    changes. cancel() makes wait() return None for a clean shutdown.
+    """
+
+    def __init__(self, poll_interval=5):
+        self.poll_interval = poll_interval
+        self.timers = {}
+        self.events = []
+        self.watches = {}
+        self.cancelled = False
+        self.condition = threading.Condition()
+        self.logger = logging.getLogger("root")
+
+    def call_at(self, when, name):
+        with self.condition:
+            self.timers[name] = when
+            self.condition.notify()
+
+    def call_later(self, seconds, name):
+        self.call_at(dt.datetime.now() + dt.timedelta(seconds=seconds), name)
+
+    def cancel_timer(self, name):
+        with self.condition:
+            self.timers.pop(name, None)
+
+    def watch(self, name, check):
+        """Raises event `name` whenever the value returned by check() changes"""
+        self.watches[name] = [check, self.poll_watch(name, check)]
+
+    def poll_watch(self, name, check):
+        try:
+            return check()
+        except Exception as e:
+            self.logger.warning("Watch '{}' failed: {}".format(name, e))
+            return None
+
+    def notify(self, name):
+        with self.condition:
+            if name not in self.events:
+                self.events.append(name)
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify()
+
+    def wait(self):
+        """Blocks until timers are due or events are raised
+
+        Returns the names of the due timers and raised events, or None once
+        the scheduler has been cancelled.
+        """
+        while True:
+            for name, watch in self.watches.items():
+                value = self.poll_watch(name, watch[0])
+                if value is not None and value != watch[1]:
+                    watch[1] = value
+                    self.notify(name)
+            with self.condition:
+                if self.cancelled:
+                    return None
+                now = dt.datetime.now()
+                due = sorted((when, name) for name, when in self.timers.items()
+                             if when <= now)
+                if due or self.events:
+                    for _, name in due:
+                        del self.timers[name]
+                    fired = [name for _, name in due] + self.events
+                    self.events = []
+                    return fired
+                timeout = self.poll_interval
+                if self.timers:
+                    next_due = min(self.timers.values())
+                    timeout = min(timeout, (next_due - now).total_seconds())
+                self.condition.wait(max(timeout, 0))
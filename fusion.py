@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import bisect
+import collections
+import math
+
+import metrics
+
+FUSION_REJECTED = metrics.counter(
+    "fusion_rejected_samples_total",
+    "Samples dropped as missing or as outliers", ["sensor"])
+
+
+class SensorFilter(object):
+    """Rolling median followed by an EMA, with outlier rejection
+
+    Missing values (None or NaN, as left by a failed read_retry) and values
+    more than `max_jump` away from the rolling median are rejected. After
+    `window` rejections in a row the readings are taken as a real change
+    and the filter starts over from them. Every update costs O(window).
+    """
+
+    def __init__(self, name, window=5, alpha=0.3, max_jump=3.0):
+        self.name = name
+        self.window = window
+        self.alpha = alpha
+        self.max_jump = max_jump
+        self.values = collections.deque()
+        self.sorted = []
+        self.rejected = []
+        self.value = None
+
+    def median(self):
+        n = len(self.sorted)
+        if n % 2:
+            return self.sorted[n // 2]
+        return (self.sorted[n // 2 - 1] + self.sorted[n // 2]) / 2
+
+    def push(self, value):
+        if len(self.values) == self.window:
+            old = self.values.popleft()
+            del self.sorted[bisect.bisect_left(self.sorted, old)]
+        self.values.append(value)
+        bisect.insort(self.sorted, value)
+
+    def update(self, value):
+        """Adds a sample and returns the filtered value (None until known)"""
+        if value is None or math.isnan(value):
+            FUSION_REJECTED.labels(self.name).inc()
+            return self.value
+        if self.sorted and abs(value - self.median()) > self.max_jump:
+            FUSION_REJECTED.labels(self.name).inc()
+            self.rejected.append(value)
+            if len(self.rejected) < self.window:
+                return self.value
+            # Consistently different: the room really changed
+            self.values.clear()
+            self.sorted = []
+            self.value = None
+            for value in self.rejected[:-1]:
+                self.push(value)
+            value = self.rejected[-1]
+        self.rejected = []
+        self.push(value)
+        median = self.median()
+        if self.value is None:
+            self.value = median
+        else:
+            self.value += self.alpha * (median - self.value)
+        return self.value
+
+
+class TemperatureFusion(object):
+    """Room temperature from a primary sensor, backed by a secondary one
+
+    The secondary sensor (the Sense HAT, warmed up by the Pi) is only used
+    while the primary has no recent samples, corrected by its average
+    difference to the primary, learned while both report.
+    """
+
+    def __init__(self, primary, secondary=None, max_age=120, bias_alpha=0.05):
+        self.primary = SensorFilter(primary)
+        self.secondary = SensorFilter(secondary) if secondary else None
+        self.max_age = max_age
+        self.bias_alpha = bias_alpha
+        self.bias = None
+        self.last = {}
+
+    def update(self, sensor, timestamp, temperature):
+        """Adds one sample of either sensor"""
+        if sensor == self.primary.name:
+            self.primary.update(temperature)
+        elif self.secondary is not None and sensor == self.secondary.name:
+            self.secondary.update(temperature)
+            primary_time = self.last.get(self.primary.name)
+            if self.primary.value is not None and \
+                    self.secondary.value is not None and \
+                    primary_time is not None and \
+                    abs(timestamp - primary_time) <= self.max_age:
+                difference = self.secondary.value - self.primary.value
+                if self.bias is None:
+                    self.bias = difference
+                else:
+                    self.bias += self.bias_alpha * (difference - self.bias)
+        else:
+            return
+        if temperature is not None and not math.isnan(temperature):
+            self.last[sensor] = timestamp
+
+    def temperature(self, now):
+        """Returns the fused temperature, or None without recent samples"""
+        if self.primary.value is not None and self.recent(self.primary, now):
+            return self.primary.value
+        if self.secondary is not None and self.secondary.value is not None \
+                and self.bias is not None and self.recent(self.secondary, now):
+            return self.secondary.value - self.bias
+        return None
+
+    def recent(self, sensor_filter, now):
+        last = self.last.get(sensor_filter.name)
+        return last is not None and now - last <= self.max_age
+
+
+def hysteresis_offset(difference, current, margin=0.3):
+    """Offset to set for a sensor/device `difference`, given the `current` one
+
+    The current offset is kept while the difference stays within 0.5 +
+    `margin` of it, so noise around a .5 boundary does not flip it.
+    """
+    if current is not None and abs(difference - current) <= 0.5 + margin:
+        return current
+    return round(difference)
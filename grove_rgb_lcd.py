@@ -40,8 +40,16 @@ DISPLAY_RGB_ADDR = 0x62
 DISPLAY_TEXT_ADDR = 0x3e
 
 
+# Last backlight color written, writes of the same color are skipped
+current_rgb = None
+
+
 # set backlight to (R,G,B) (values from 0..255 for each)
 def setRGB(r, g, b):
+    global current_rgb
+    if (r, g, b) == current_rgb:
+        return
+    current_rgb = (r, g, b)
     bus.write_byte_data(DISPLAY_RGB_ADDR, 0, 0)
     bus.write_byte_data(DISPLAY_RGB_ADDR, 1, 0)
     bus.write_byte_data(DISPLAY_RGB_ADDR, 0x08, 0xaa)
@@ -55,50 +63,77 @@ def textCommand(cmd):
     bus.write_byte_data(DISPLAY_TEXT_ADDR, 0x80, cmd)
 
 
-# set display text \n for second line(or auto wrap)
-def setText(text):
-    textCommand(0x01)  # clear display
-    time.sleep(.05)
-    textCommand(0x08 | 0x04)  # display on, no cursor
-    textCommand(0x28)  # 2 lines
-    time.sleep(.05)
-    count = 0
-    row = 0
+def layout(text):
+    """Splits text into the 2 rows of 16 characters shown on the display"""
+    rows = [""]
     for c in text:
-        if c == '\n' or count == 16:
-            count = 0
-            row += 1
-            if row == 2:
+        if c == '\n' or len(rows[-1]) == 16:
+            if len(rows) == 2:
                 break
-            textCommand(0xc0)
+            rows.append("")
             if c == '\n':
                 continue
-        count += 1
-        bus.write_byte_data(DISPLAY_TEXT_ADDR, 0x40, ord(c))
+        rows[-1] += c
+    rows += [""] * (2 - len(rows))
+    return [row.ljust(16) for row in rows]
 
 
-# Update the display without erasing the display
-def setText_norefresh(text):
-    textCommand(0x02)  # return home
+class BufferedText(object):
+    """Keeps a copy of the character RAM and writes only what changed
+
+    The display is initialised on the first update only. Each run of
+    changed characters costs one cursor move and one I2C block write.
+    """
+
+    def __init__(self):
+        self.shadow = None
+
+    def reset(self, rows=None):
+        """Tells what the display shows now, e.g. after a clear"""
+        self.shadow = rows
+
+    def update(self, text):
+        rows = layout(text)
+        if self.shadow is None:
+            textCommand(0x08 | 0x04)  # display on, no cursor
+            textCommand(0x28)  # 2 lines
+            time.sleep(.05)
+            self.shadow = [[None] * 16] * 2
+        for row, (new, old) in enumerate(zip(rows, self.shadow)):
+            changed = [col for col in range(16) if new[col] != old[col]]
+            runs = []
+            for col in changed:
+                # Rewriting up to 3 unchanged characters is cheaper than
+                # another cursor move and block write
+                if runs and col - runs[-1][1] <= 3:
+                    runs[-1][1] = col + 1
+                else:
+                    runs.append([col, col + 1])
+            for start, end in runs:
+                textCommand(0x80 | (row * 0x40 + start))  # set cursor
+                bus.write_i2c_block_data(
+                    DISPLAY_TEXT_ADDR, 0x40, [ord(c) for c in new[start:end]])
+        self.shadow = [list(row) for row in rows]
+
+
+text_buffer = BufferedText()
+
+
+# set display text \n for second line(or auto wrap)
+def setText(text):
+    textCommand(0x01)  # clear display
     time.sleep(.05)
     textCommand(0x08 | 0x04)  # display on, no cursor
     textCommand(0x28)  # 2 lines
     time.sleep(.05)
-    count = 0
-    row = 0
-    while len(text) < 32:  # clears the rest of the screen
-        text += ' '
-    for c in text:
-        if c == '\n' or count == 16:
-            count = 0
-            row += 1
-            if row == 2:
-                break
-            textCommand(0xc0)
-            if c == '\n':
-                continue
-        count += 1
-        bus.write_byte_data(DISPLAY_TEXT_ADDR, 0x40, ord(c))
+    text_buffer.reset([[" "] * 16] * 2)
+    text_buffer.update(text)
+
+
+# Update the display without erasing the display, writing only the
+# characters which changed since the last update
+def setText_norefresh(text):
+    text_buffer.update(text)
 
 
 # Create a custom character (from array of row patterns)
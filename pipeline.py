@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import logging
+import logging.handlers
+import queue
+import threading
+
+import metrics
+
+PIPELINE_QUEUE_DEPTH = metrics.gauge(
+    "room_pipeline_queue_depth", "Readings waiting for the writer")
+PIPELINE_DROPPED = metrics.counter(
+    "room_pipeline_dropped_total",
+    "Readings dropped because the writer fell behind")
+PIPELINE_SINK_SECONDS = metrics.histogram(
+    "room_pipeline_sink_seconds", "Time a sink takes per reading", ["sink"])
+PIPELINE_SINK_ERRORS = metrics.counter(
+    "room_pipeline_sink_errors_total", "Readings a sink failed to handle",
+    ["sink"])
+LOG_RECORDS_DROPPED = metrics.counter(
+    "room_log_records_dropped_total",
+    "Log records dropped because the log writer fell behind")
+
+
+class Pipeline(object):
+    """Hands readings from the sensor threads to one background writer
+
+    submit() never blocks: when the queue is full because a sink is slow
+    (e.g. the SD card stalls), the oldest queued reading is dropped and
+    counted. The writer thread passes every reading to each sink in the
+    order they were added; a failing sink is logged and does not stop the
+    others.
+    """
+
+    def __init__(self, maxsize=256):
+        self.queue = queue.Queue(maxsize)
+        self.sinks = []
+        self.thread = None
+        self.logger = logging.getLogger()
+
+    def add_sink(self, name, function):
+        """Registers function(sensor, reading) as a sink"""
+        self.sinks.append((name, function))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="pipeline",
+                                       daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def submit(self, sensor, reading):
+        item = (sensor, reading)
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    PIPELINE_DROPPED.inc()
+                except queue.Empty:
+                    pass
+        PIPELINE_QUEUE_DEPTH.set(self.queue.qsize())
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.handle(*item)
+            finally:
+                self.queue.task_done()
+                PIPELINE_QUEUE_DEPTH.set(self.queue.qsize())
+
+    def handle(self, sensor, reading):
+        for name, function in self.sinks:
+            try:
+                with PIPELINE_SINK_SECONDS.labels(name).time():
+                    function(sensor, reading)
+            except Exception as e:
+                PIPELINE_SINK_ERRORS.labels(name).inc()
+                self.logger.error("Sink '{}' failed for {}: {}".format(
+                    name, sensor, e))
+
+    def close(self, timeout=10):
+        """Writes out the queued readings and stops the writer"""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler which drops and counts records instead of blocking"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def start_queue_logging(logger, handlers, maxsize=1000):
+    """Moves `handlers` of `logger` behind a queue served by a listener thread
+
+    Returns the started QueueListener; stop it to flush pending records.
+    """
+    log_queue = queue.Queue(maxsize)
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    listener.start()
+    return listener
@@ -1,37 +1,307 @@
 #!/usr/bin/env python3
 
 import matplotlib
-import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
-import matplotlib.cbook as cbook
+from dateutil import tz
 
 import numpy as np
-import datetime as dt
+import argparse
+import array
+import csv
+import glob
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
 import sys
-import re
+import time
+import aggregate
+import binlog
+import temperature_db
 
+DHT22_MARKER = "[DHT22] Temperature = "
+# More points than pixels across the figure only slow down rendering
+MAX_PLOT_POINTS = 2000
+
+
+def find_log_files(log_file):
+    """Returns the live log followed by all its rotated (possibly gzip'd) backups"""
+    return sorted(f for f in glob.glob(log_file + "*") if os.path.isfile(f))
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", errors="replace")
+    return open(path, errors="replace")
+
+
+def parse_timestamp(line, hour_cache):
+    """Parses a 'YYYY-mm-dd HH:MM:SS.fff' prefix into epoch seconds
+
+    The fields sit at fixed offsets, so only the hour is converted with
+    mktime (once per hour, which also takes care of DST) and the rest is
+    plain integer arithmetic.
+    """
+    hour_key = line[:13]
+    hour_start = hour_cache.get(hour_key)
+    if hour_start is None:
+        hour_start = time.mktime((int(line[0:4]), int(line[5:7]), int(line[8:10]),
+                                  int(line[11:13]), 0, 0, 0, 0, -1))
+        hour_cache[hour_key] = hour_start
+    return hour_start + int(line[14:16]) * 60 + int(line[17:19]) + \
+        int(line[20:23]) / 1000
+
+
+def parse_lines(lines, marker=DHT22_MARKER):
+    """Extracts (epoch, value) arrays from the log lines containing `marker`"""
+    timestamps = array.array("d")
+    values = array.array("d")
+    hour_cache = {}
+    for line in lines:
+        idx = line.find(marker)
+        if idx < 0:
+            continue
+        # Crashes can leave NUL padding in front of the next line
+        line = line.lstrip("\x00")
+        idx = line.find(marker) + len(marker)
+        try:
+            value = float(line[idx:].split(None, 1)[0])
+            timestamp = parse_timestamp(line, hour_cache)
+        except (ValueError, IndexError):
+            continue
+        timestamps.append(timestamp)
+        values.append(value)
+    return np.frombuffer(timestamps, dtype=np.float64), \
+        np.frombuffer(values, dtype=np.float64)
+
+
+def parse_log_file(path, marker=DHT22_MARKER, offset=0):
+    """Parses `path` from byte `offset` up to its last complete line
+
+    Returns (epoch, value, offset) where offset is where the next call
+    should resume from. Gzip'd files are always parsed in full.
+    """
+    if path.endswith(".gz"):
+        with open_log(path) as f:
+            return parse_lines(f, marker) + (0,)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    # A partially written last line is picked up by the next call
+    end = data.rfind(b"\n") + 1
+    lines = data[:end].decode(errors="replace").splitlines()
+    return parse_lines(lines, marker) + (offset + end,)
+
+
+class LogCache(object):
+    """Directory of already parsed log series, one .npy file per log file
+
+    Entries are keyed by log path and marker and remember the size, mtime,
+    inode and parsed byte offset of the log file. Unchanged files are loaded
+    as they are and a growing live log is resumed from the stored offset.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, "index.json")
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def data_file(self, key):
+        name = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, name + ".npy")
+
+    def load(self, key):
+        try:
+            return np.load(self.data_file(key), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, data, stat, offset):
+        data_file = self.data_file(key)
+        with open(data_file + ".tmp", "wb") as f:
+            np.save(f, data)
+        os.replace(data_file + ".tmp", data_file)
+        self.index[key] = {"size": stat.st_size, "mtime": stat.st_mtime,
+                           "inode": stat.st_ino, "offset": offset}
+
+    def prune(self):
+        """Drops entries of log files which have been deleted"""
+        for key in list(self.index):
+            if os.path.exists(key.rsplit("|", 1)[0]):
+                continue
+            try:
+                os.remove(self.data_file(key))
+            except OSError:
+                pass
+            del self.index[key]
+
+    def save_index(self):
+        with open(self.index_file + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+
+def load_series(log_file, marker=DHT22_MARKER, processes=None, cache_dir=None):
+    """Parses the whole rotated log set, one file per worker process
+
+    Series already parsed into `cache_dir` (default: a .parsed_cache
+    directory next to the logs) are reused, so only new bytes are read.
+    Returns (epoch, value) arrays sorted by time.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(log_file)),
+                                 ".parsed_cache")
+    cache = LogCache(cache_dir)
+    series = []
+    todo = []
+    for path in find_log_files(log_file):
+        key = os.path.abspath(path) + "|" + marker
+        stat = os.stat(path)
+        entry = cache.index.get(key)
+        cached = cache.load(key) if entry is not None else None
+        if cached is not None and entry["size"] == stat.st_size and \
+                entry["mtime"] == stat.st_mtime:
+            series.append(cached)
+            continue
+        if cached is not None and entry["inode"] == stat.st_ino and \
+                entry["size"] <= stat.st_size and not path.endswith(".gz"):
+            # The file only grew since the last run: resume where we stopped
+            todo.append((path, key, stat, entry["offset"], cached))
+        else:
+            todo.append((path, key, stat, 0, None))
+
+    jobs = [(path, marker, offset) for path, _, _, offset, _ in todo]
+    if len(jobs) > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(parse_log_file, jobs)
+    else:
+        results = [parse_log_file(*job) for job in jobs]
+
+    for (path, key, stat, _, previous), (timestamps, values, offset) in \
+            zip(todo, results):
+        data = np.column_stack((timestamps, values))
+        if previous is not None:
+            data = np.concatenate((previous, data))
+        cache.store(key, data, stat, offset)
+        series.append(data)
+    cache.prune()
+    cache.save_index()
+
+    if not series:
+        return np.empty(0), np.empty(0)
+    data = np.concatenate(series)
+    order = np.argsort(data[:, 0], kind="stable")
+    return data[order, 0], data[order, 1]
+
+
+def load_binary_series(log_file, sensor="dht_22", field="temperature"):
+    """Reads (epoch, value) arrays from a structured room_weather.bin set"""
+    timestamps, values = binlog.read_columns(
+        log_file, "reading", ["timestamp", field], sensor=sensor)
+    valid = ~np.isnan(values)
+    return timestamps[valid], values[valid]
+
+
+def epoch_to_datetime64(timestamps):
+    return (timestamps * 1000).astype("datetime64[ms]")
+
+
+def parse_time(value):
+    """Accepts epoch seconds or a local 'YYYY-mm-dd[ HH:MM[:SS]]' string"""
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return int(time.mktime(time.strptime(value, fmt)))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("Invalid time '{}'".format(value))
 
-if __name__ == "__main__":
-    with open(sys.argv[1]) as f:
-        line_list = f.readlines()
 
+def format_time(epoch):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(epoch))
 
-    regexp = re.compile("DHT22.*Temperature = ([0-9]*.[0-9])")
 
-    data = []
+RESOLUTIONS = {"raw": 0, "minutely": 60, "hourly": 3600, "daily": 86400}
 
-    for line in line_list:
-        match = re.search(regexp, line)
-        if match is not None:
-            line = line.replace("\x00", "")
-            # print(line.rstrip("\n"))
-            split_line = line.split()
-            date_time_string = " ".join(split_line[0:2])
-            mtime = dt.datetime.strptime(date_time_string, "%Y-%m-%d %H:%M:%S.%f")
-            temperature = float(match.group(1))
-            data.append((mtime, temperature))
 
+def query_rows(args):
+    """Returns (header, rows) for the range selected on the command line
 
+    Rows are streamed from an indexed range scan of the database, so any
+    range can be exported in constant memory.
+    """
+    start = args.start if args.start is not None else 0
+    end = args.end if args.end is not None else int(time.time()) + 1
+    if args.resolution == "auto":
+        width = temperature_db.pick_resolution(start, end, args.max_points)
+    else:
+        width = RESOLUTIONS[args.resolution]
+    if width == 0:
+        return ["timestamp", "value"], temperature_db.read_samples(
+            args.sensor, args.metric, start, end, db_file=args.db)
+    return ["timestamp", "min", "mean", "max", "count"], \
+        temperature_db.read_aggregates(
+            args.sensor, args.metric, width, start, end, db_file=args.db)
+
+
+def open_output(path, mode="w"):
+    if path == "-":
+        return os.fdopen(os.dup(sys.stdout.fileno()), mode)
+    return open(path, mode)
+
+
+def export_csv(header, rows, out):
+    writer = csv.writer(out)
+    writer.writerow(header[:1] + ["datetime"] + header[1:])
+    for row in rows:
+        writer.writerow((row[0], format_time(row[0])) + tuple(row[1:]))
+
+
+def export_jsonl(header, rows, out):
+    for row in rows:
+        out.write(json.dumps(dict(zip(header, row))) + "\n")
+
+
+def export_parquet(header, rows, path, row_group_size=65536):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet export needs pyarrow (pip3 install pyarrow)")
+
+    types = [pa.int64()] + [pa.float64()] * (len(header) - 2) + \
+        [pa.float64() if header[-1] != "count" else pa.int64()]
+    schema = pa.schema(list(zip(header, types)))
+    writer = pq.ParquetWriter(path, schema)
+    try:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == row_group_size:
+                writer.write_table(pa.Table.from_pylist(
+                    [dict(zip(header, r)) for r in chunk], schema=schema))
+                chunk = []
+        if chunk:
+            writer.write_table(pa.Table.from_pylist(
+                [dict(zip(header, r)) for r in chunk], schema=schema))
+    finally:
+        writer.close()
+
+
+def plot(timestamps, values, output, show=False, lower=None, upper=None):
+    if not show:
+        # Render without a display and without blocking
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
 
     months = mdates.MonthLocator()  # every month
 
@@ -39,15 +309,139 @@ if __name__ == "__main__":
 
     # ax.xaxis.set_major_locator(mdates.DayLocator())
 
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%b %d %Hh'))
+    # datetime64 values are UTC, so format the axis in local time
+    ax.xaxis.set_major_formatter(
+        mdates.DateFormatter('%b %d %Hh', tz=tz.tzlocal()))
 
 
     ax.set_ylim(0, 30)
-    x, y1 = zip(*data)
-    ax.plot(x, y1, 'b-')
+    x = epoch_to_datetime64(np.asarray(timestamps, dtype=np.float64))
+    if lower is not None:
+        ax.fill_between(x, lower, upper, color='b', alpha=0.2)
+    ax.plot(x, values, 'b-')
     ax.grid()
 
     fig.autofmt_xdate()
 
-    fig.savefig("test.png")
-    plt.show()
+    fig.savefig(output)
+    if show:
+        plt.show()
+    plt.close(fig)
+
+
+def command_series(args):
+    conn = temperature_db.connect_readonly(args.db)
+    try:
+        for sensor, metric in conn.execute(
+                "SELECT sensor, metric FROM series ORDER BY sensor, metric"):
+            print("{} {}".format(sensor, metric))
+    finally:
+        conn.close()
+
+
+def command_query(args):
+    header, rows = query_rows(args)
+    print("\t".join(["datetime"] + header[1:]))
+    for row in rows:
+        print("\t".join([format_time(row[0])] + [str(v) for v in row[1:]]))
+
+
+def command_export(args):
+    header, rows = query_rows(args)
+    if args.format == "parquet":
+        if args.output == "-":
+            raise SystemExit("Parquet export needs an --output file")
+        export_parquet(header, rows, args.output)
+        return
+    with open_output(args.output) as out:
+        if args.format == "csv":
+            export_csv(header, rows, out)
+        else:
+            export_jsonl(header, rows, out)
+
+
+def command_plot(args):
+    header, rows = query_rows(args)
+    data = np.array(list(rows), dtype=np.float64).reshape(-1, len(header))
+    if len(header) == 2:
+        timestamps, values = aggregate.downsample(
+            data[:, 0], data[:, 1], args.max_points)
+        plot(timestamps, values, args.output, args.show)
+    else:
+        plot(data[:, 0], data[:, 2], args.output, args.show,
+             lower=data[:, 1], upper=data[:, 3])
+
+
+def command_plot_log(args):
+    if args.log_file.endswith(".bin"):
+        series = load_binary_series(args.log_file)
+    else:
+        series = load_series(args.log_file)
+    timestamps, values = aggregate.downsample(
+        *series, max_points=args.max_points)
+    plot(timestamps, values, args.output, args.show)
+
+
+def add_range_arguments(parser, resolution="raw"):
+    parser.add_argument("--sensor", default="dht_22")
+    parser.add_argument("--metric", default="temperature")
+    parser.add_argument("--start", type=parse_time,
+                        help="Epoch or local 'YYYY-mm-dd[ HH:MM[:SS]]'")
+    parser.add_argument("--end", type=parse_time,
+                        help="Epoch or local 'YYYY-mm-dd[ HH:MM[:SS]]'")
+    parser.add_argument("--resolution", default=resolution,
+                        choices=["auto"] + list(RESOLUTIONS))
+    parser.add_argument("--max-points", type=int, default=MAX_PLOT_POINTS)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Query, export and plot recorded room weather data")
+    parser.add_argument("--db", default=temperature_db.DB_FILE,
+                        help="SQLite database (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("series", help="List recorded series")
+    p.set_defaults(func=command_series)
+
+    p = subparsers.add_parser("query", help="Print samples of a time range")
+    add_range_arguments(p)
+    p.set_defaults(func=command_query)
+
+    p = subparsers.add_parser("export", help="Export samples of a time range")
+    add_range_arguments(p)
+    p.add_argument("--format", default="csv",
+                   choices=["csv", "jsonl", "parquet"])
+    p.add_argument("--output", default="-")
+    p.set_defaults(func=command_export)
+
+    p = subparsers.add_parser("plot", help="Plot samples of a time range")
+    add_range_arguments(p, resolution="auto")
+    p.add_argument("--output", default="plot.png",
+                   help="Image file, the format follows the extension")
+    p.add_argument("--show", action="store_true")
+    p.set_defaults(func=command_plot)
+
+    p = subparsers.add_parser("plot-log", help="Plot DHT22 temperatures "
+                              "parsed from a room_weather.log set, or read "
+                              "from a room_weather.bin set")
+    p.add_argument("log_file")
+    p.add_argument("--output", default="test.png")
+    p.add_argument("--max-points", type=int, default=MAX_PLOT_POINTS)
+    p.add_argument("--show", action="store_true")
+    p.set_defaults(func=command_plot_log)
+
+    if argv is None:
+        argv = sys.argv[1:]
+    # Keep supporting the old "process_data.py <log file>" invocation
+    if argv and argv[0] not in subparsers.choices and os.path.isfile(argv[0]):
+        argv = ["plot-log", "--show"] + argv
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    except FileNotFoundError as e:
+        parser.error(e)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+import metrics
+import temperature_db
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+
+class ReadingsServer(object):
+    """Local HTTP API serving the latest readings from an in-memory snapshot
+
+    Runs its own asyncio loop in a background thread and listens on TCP
+    and optionally on a Unix socket. Endpoints:
+
+        GET /readings   current snapshot as JSON
+        GET /history    ?sensor=&metric=&start=&end=
+                        &resolution=raw|minutely|hourly|daily
+                        samples from the database as JSON
+        GET /events     server-sent events, one per published snapshot
+        GET /metrics    instrumentation in Prometheus text format
+        GET /workers    restarts and uptime of the worker threads
+
+    Requests are answered from the snapshot and never touch the sensors.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8023, unix_path=None,
+                 db_file=temperature_db.DB_FILE, keepalive=15, workers=None):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.db_file = db_file
+        self.keepalive = keepalive
+        self.workers = workers
+        self.snapshot = {}
+        self.subscribers = set()
+        self.loop = None
+        self.error = None
+        self.logger = logging.getLogger()
+
+    def start(self):
+        """Starts serving, raises what binding the sockets raised"""
+        started = threading.Event()
+        thread = threading.Thread(target=self.run, args=(started,),
+                                  name="readings-api", daemon=True)
+        thread.start()
+        started.wait()
+        if self.error is not None:
+            raise self.error
+        return thread
+
+    def run(self, started=None):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(asyncio.start_server(
+                self.handle, self.host, self.port))
+            if self.unix_path is not None:
+                if os.path.exists(self.unix_path):
+                    os.remove(self.unix_path)
+                loop.run_until_complete(asyncio.start_unix_server(
+                    self.handle, self.unix_path))
+            self.loop = loop
+        except Exception as e:
+            # E.g. the port is taken: let start() fail instead of hanging
+            self.error = e
+            loop.close()
+            return
+        finally:
+            if started is not None:
+                started.set()
+        loop.run_forever()
+
+    def publish(self, snapshot):
+        """Replaces the snapshot and pushes it to subscribers (thread-safe)"""
+        if self.loop is None:
+            self.snapshot = snapshot
+            return
+        self.loop.call_soon_threadsafe(self.update_snapshot, snapshot)
+
+    def update_snapshot(self, snapshot):
+        self.snapshot = snapshot
+        for queue in self.subscribers:
+            if queue.full():
+                # Slow client: drop its oldest update rather than block
+                queue.get_nowait()
+            queue.put_nowait(snapshot)
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # Headers are not needed
+            parts = request_line.decode("latin-1").split()
+            if len(parts) != 3:
+                await self.respond(writer, 400, {"error": "Bad request"})
+                return
+            method, target, _version = parts
+            if method != "GET":
+                await self.respond(writer, 405, {"error": "Only GET"})
+                return
+            url = urllib.parse.urlsplit(target)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            if url.path == "/readings":
+                await self.respond(writer, 200, self.snapshot)
+            elif url.path == "/history":
+                await self.history(writer, query)
+            elif url.path == "/events":
+                await self.events(writer)
+            elif url.path == "/metrics":
+                await self.respond(writer, 200, metrics.REGISTRY.expose(),
+                                   "text/plain; version=0.0.4")
+            elif url.path == "/workers" and self.workers is not None:
+                await self.respond(writer, 200, self.workers())
+            else:
+                await self.respond(writer, 404, {"error": "Not found"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            self.logger.error("Readings API request failed: {}".format(e))
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body,
+                      content_type="application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body)
+        data = body.encode("utf-8")
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\n"
+                     "Content-Length: {}\r\nConnection: close\r\n\r\n".format(
+                         status, REASONS[status], content_type,
+                         len(data)).encode("latin-1"))
+        writer.write(data)
+        await writer.drain()
+
+    async def history(self, writer, query):
+        try:
+            sensor = query.get("sensor", "dht_22")
+            metric = query.get("metric", "temperature")
+            end = int(query.get("end", time.time() + 1))
+            start = int(query.get("start", end - 24 * 3600))
+            width = {"raw": 0, "minutely": 60, "hourly": 3600,
+                     "daily": 86400}[
+                query.get("resolution", "raw")]
+        except (KeyError, ValueError):
+            await self.respond(writer, 400, {"error": "Invalid query"})
+            return
+
+        def read():
+            if width == 0:
+                return list(temperature_db.read_samples(
+                    sensor, metric, start, end, db_file=self.db_file))
+            return list(temperature_db.read_aggregates(
+                sensor, metric, width, start, end, db_file=self.db_file))
+
+        # SQLite is blocking, keep it off the event loop
+        try:
+            rows = await self.loop.run_in_executor(None, read)
+        except FileNotFoundError as e:
+            await self.respond(writer, 503, {"error": str(e)})
+            return
+        await self.respond(writer, 200, rows)
+
+    async def events(self, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        queue = asyncio.Queue(maxsize=16)
+        queue.put_nowait(self.snapshot)
+        self.subscribers.add(queue)
+        try:
+            while True:
+                try:
+                    snapshot = await asyncio.wait_for(
+                        queue.get(), self.keepalive)
+                    writer.write("data: {}\n\n".format(
+                        json.dumps(snapshot)).encode("utf-8"))
+                except asyncio.TimeoutError:
+                    writer.write(b": keepalive\n\n")
+                await writer.drain()
+        finally:
+            self.subscribers.discard(queue)
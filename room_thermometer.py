@@ -4,41 +4,94 @@ import logging
 import logging.handlers
 import os
 import time
-import threading
-import sqlite3
-from datetime import datetime as dt
+import signal
+import argparse
+import tempfile
+import drivers
+from drivers import DHT22Reading, SenseHatReading
+import temperature_db
+from temperature_db import Compactor, DatabaseWriter
+from sensor_feed import FEED_FILE, SensorFeedWriter
+from readings_api import ReadingsServer
+from pipeline import Pipeline, start_queue_logging
+from supervisor import Supervisor
+import metrics
+import binlog
 APP_DEBUG = False
 
+SENSOR_READ_SECONDS = metrics.histogram(
+    "room_sensor_read_seconds", "Time to read one sample from a sensor",
+    ["sensor"])
 
-def write_to_db(table_name, temperature, humidity):
-    dirname, _filename = os.path.split(os.path.abspath(__file__))
-    conn = sqlite3.connect(dirname + '/room_temperature.db')
-    c = conn.cursor()
 
-    c.execute("""CREATE TABLE IF NOT EXISTS {}
-        (datetime text, temperature real, humidity real)""".format(
-        table_name))
-
-    now_dt = dt.now().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("INSERT INTO {} VALUES ('{}', '{:.2f}', '{:.2f}')".format(
-        table_name, now_dt, temperature, humidity))
-
-    conn.commit()
-    conn.close()
+class Terminated(Exception):
+    """Raised in the main thread on SIGTERM"""
 
 
 class Thermometer(object):
-    def __init__(self):
-        self.CYCLE_SLEEP = 2
-        self.SENSING_DELAY = 15
+    def __init__(self, hardware="pi", replay_source=None, speedup=1,
+                 db_file=None, structured_log=False):
+        # hardware: "pi" for the real hardware, "simulated" or "replay" (of
+        # replay_source) to run anywhere; speedup shortens all delays.
+        # Without the real hardware, the database, feed, API and logs default
+        # to a scratch directory, so fake readings never reach the
+        # production database or the feed update_offset acts on.
+        self.hardware = hardware
+        if hardware == "pi":
+            dirname, _filename = os.path.split(os.path.abspath(__file__))
+            self.data_dir = dirname
+            default_db = temperature_db.DB_FILE
+            feed_file = FEED_FILE
+            self.API_PORT = 8023
+            self.API_SOCKET = "/tmp/room_thermometer.sock"
+        else:
+            self.data_dir = os.path.join(tempfile.gettempdir(),
+                                         "room_thermometer-" + hardware)
+            os.makedirs(self.data_dir + "/logs", exist_ok=True)
+            default_db = self.data_dir + "/room_temperature.db"
+            feed_file = self.data_dir + "/feed"
+            self.API_PORT = 8033
+            self.API_SOCKET = self.data_dir + "/room_thermometer.sock"
+        if db_file is None:
+            db_file = default_db
+        self.replay_source = replay_source
+        self.SAMPLE_INTERVAL = 15
+        self.CYCLE_SLEEP = 2 / speedup
+        self.SENSING_DELAY = self.SAMPLE_INTERVAL / speedup
         self.INTENSITY = 50
-        self.temperature_dht22 = 0
-        self.temperature_sense = 0
-        self.humidity_dht22 = 0
-        self.humidity_sense = 0
-        self.pressure = 0
-        self.sensor_lock = threading.Lock()
+        self.DB_BATCH_SIZE = 20
+        self.DB_FLUSH_INTERVAL = 60
+        self.DB_COMPACT_INTERVAL = 3600
+        self.PIPELINE_SIZE = 256
+        self.stopping = False
+        self.dht22 = DHT22Reading(0, 0, 0)
+        self.sense_hat = SenseHatReading(0, 0, 0, 0)
+        # Hardware handles outlive the worker threads, so a restarted
+        # worker does not have to initialize its sensor again
+        self.sensors = {}
+        self.matrix = None
+        self.lcd = None
         self.setup_logger()
+        self.binlog = None
+        if structured_log:
+            # Readings go to a binary log instead of the text log
+            self.binlog = binlog.setup(self.data_dir + "/logs/room_weather.bin")
+        self.db = DatabaseWriter(db_file, batch_size=self.DB_BATCH_SIZE,
+                                 flush_interval=self.DB_FLUSH_INTERVAL)
+        # Drops samples past temperature_db.RETENTION, they live on in the
+        # minute/hour/day rollups
+        self.compactor = Compactor(db_file,
+                                   interval=self.DB_COMPACT_INTERVAL)
+        self.feed = SensorFeedWriter(feed_file)
+        self.supervisor = Supervisor()
+        self.api = ReadingsServer(port=self.API_PORT, unix_path=self.API_SOCKET,
+                                  db_file=db_file,
+                                  workers=self.supervisor.status)
+        self.pipeline = Pipeline(maxsize=self.PIPELINE_SIZE)
+        self.pipeline.add_sink("log", self.log_reading)
+        self.pipeline.add_sink("feed", self.feed_reading)
+        self.pipeline.add_sink("api", self.api_reading)
+        self.pipeline.add_sink("db", self.db_reading)
 
     def setup_logger(self):
         self.logger = logging.getLogger()
@@ -49,15 +102,13 @@ class Thermometer(object):
         formatter.default_msec_format = '%s.%03d'
 
         # Setup file handler
-        dirname, _filename = os.path.split(os.path.abspath(__file__))
         fh_info = logging.handlers.TimedRotatingFileHandler(
-            dirname + "/logs/room_weather.log",
+            self.data_dir + "/logs/room_weather.log",
             when='midnight',
             backupCount=1000
         )
         fh_info.setLevel(logging.INFO)
         fh_info.setFormatter(formatter)
-        self.logger.addHandler(fh_info)
 
         # Setup console handler
         ch = logging.StreamHandler()
@@ -67,70 +118,146 @@ class Thermometer(object):
             ch.setLevel(logging.ERROR)
 
         ch.setFormatter(formatter)
-        self.logger.addHandler(ch)
 
-    def measure_sense_hat(self):
-        from sense_hat import SenseHat
-
-        sense = SenseHat()
+        # Handlers run on a listener thread, so a slow SD card never stalls
+        # the threads which log
+        self.log_listener = start_queue_logging(self.logger, [fh_info, ch])
+
+    @property
+    def temperature_dht22(self):
+        return self.dht22.temperature
+
+    @property
+    def humidity_dht22(self):
+        return self.dht22.humidity
+
+    @property
+    def temperature_sense(self):
+        return self.sense_hat.temperature
+
+    @property
+    def humidity_sense(self):
+        return self.sense_hat.humidity
+
+    @property
+    def pressure(self):
+        return self.sense_hat.pressure
+
+    def snapshot(self):
+        dht22, sense_hat = self.dht22, self.sense_hat
+        return {
+            "timestamp": time.time(),
+            "temperature_dht22": dht22.temperature,
+            "humidity_dht22": dht22.humidity,
+            "temperature_sense": sense_hat.temperature,
+            "humidity_sense": sense_hat.humidity,
+            "pressure": sense_hat.pressure,
+        }
+
+    def run_periodically(self, function, interval):
+        """Calls function every `interval` seconds, measured from its start
+
+        Time spent in function does not shift the following calls. After an
+        overrun the schedule restarts from now instead of catching up.
+        """
+        next_run = time.monotonic()
         while True:
-            with self.sensor_lock:
-                self.logger.info("Taking measurements from Sense Hat")
-                self.humidity_sense = sense.get_humidity()
-                self.temperature_sense = sense.get_temperature()
-                self.pressure = sense.get_pressure()
-                self.logger.info("[SenseHat] Temperature = {:.1f} C".format(
-                    self.temperature_sense))
-                self.logger.info(
-                    "[SenseHat] Humidity = {:.1f} %".format(self.humidity_sense))
-                self.logger.info(
-                    "[SenseHat] Pressure = {:.1f} millibar".format(self.pressure))
-                # Write date to temp files (for use by other programs)
-                with open("/tmp/sense_hat_reading.txt", "w") as fh:
-                    fh.write("{}\n".format(self.temperature_sense))
-            time.sleep(self.SENSING_DELAY)
+            function()
+            next_run += interval
+            delay = next_run - time.monotonic()
+            if delay < 0:
+                next_run = time.monotonic()
+                delay = 0
+            time.sleep(delay)
+
+    def sensor_driver(self, sensor):
+        if sensor not in self.sensors:
+            self.sensors[sensor] = drivers.make_sensor(
+                self.hardware, sensor, self.replay_source,
+                self.SAMPLE_INTERVAL)
+        return self.sensors[sensor]
+
+    def measure(self, sensor):
+        driver = self.sensor_driver(sensor)
+
+        def sample():
+            if self.binlog is None:
+                self.logger.info("Taking measurements from {}".format(sensor))
+            with SENSOR_READ_SECONDS.labels(sensor).time():
+                reading = driver.read()
+            if reading is None:
+                # Keep showing the previous reading
+                self.logger.error("[{}] No reading".format(sensor))
+                return
+            if sensor == "dht_22":
+                self.dht22 = reading
+            else:
+                self.sense_hat = reading
+            self.pipeline.submit(sensor, reading)
+
+        self.run_periodically(sample, self.SENSING_DELAY)
 
-    def measure_dht22(self):
-        import Adafruit_DHT
+    def measure_sense_hat(self):
+        self.measure("sense_hat")
 
-        # DHT Sensor Config
-        DHT_SENSOR = Adafruit_DHT.DHT22
-        DHT_PIN = 4
-        while True:
-            with self.sensor_lock:
-                self.logger.info("Taking measurements from DHT22")
-                self.humidity_dht22, self.temperature_dht22 = Adafruit_DHT.read_retry(
-                    DHT_SENSOR, DHT_PIN)
-                self.logger.info("[DHT22] Temperature = {:0.1f} C".format(
-                    self.temperature_dht22))
-                self.logger.info("[DHT22] Humidity = {:0.1f} %".format(
-                    self.humidity_dht22))
-                # Write date to temp files (for use by other programs)
-                with open("/tmp/dht22_reading.txt", "w") as fh:
-                    fh.write("{:.2f}\n{:.2f}\n".format(
-                        self.temperature_dht22, self.humidity_dht22))
-                write_to_db("dht_22", self.temperature_dht22,
-                            self.humidity_dht22)
-            time.sleep(self.SENSING_DELAY)
+    def measure_dht22(self):
+        self.measure("dht_22")
+
+    def log_reading(self, sensor, reading):
+        if self.binlog is not None:
+            binlog.log_record(
+                self.binlog, "reading", reading.timestamp, sensor=sensor,
+                temperature=reading.temperature, humidity=reading.humidity,
+                pressure=getattr(reading, "pressure", None))
+            return
+        if sensor == "dht_22":
+            self.logger.info("[DHT22] Temperature = {:0.1f} C".format(
+                reading.temperature))
+            self.logger.info("[DHT22] Humidity = {:0.1f} %".format(
+                reading.humidity))
+        else:
+            self.logger.info("[SenseHat] Temperature = {:.1f} C".format(
+                reading.temperature))
+            self.logger.info(
+                "[SenseHat] Humidity = {:.1f} %".format(reading.humidity))
+            self.logger.info(
+                "[SenseHat] Pressure = {:.1f} millibar".format(reading.pressure))
+
+    def feed_reading(self, sensor, reading):
+        # Publish to shared memory (for use by other programs)
+        self.feed.publish(sensor, reading.temperature, reading.humidity,
+                          getattr(reading, "pressure", None),
+                          timestamp=reading.timestamp)
+
+    def api_reading(self, sensor, reading):
+        self.api.publish(self.snapshot())
+
+    def db_reading(self, sensor, reading):
+        values = reading._asdict()
+        timestamp = values.pop("timestamp")
+        self.db.write(sensor, timestamp=timestamp, **values)
 
     def display_sense_hat(self):
-        from sense_hat import SenseHat
         import sense_hat_display_number
 
-        sense = SenseHat()
-        sense.set_rotation(270)
-        sense.clear()
-        number_display = sense_hat_display_number.NumberDisplay(rotation=270)
+        if self.matrix is None:
+            self.matrix = drivers.make_matrix(self.hardware)
+        sense = self.matrix
+        number_display = sense_hat_display_number.NumberDisplay(
+            rotation=270, sense=sense)
+        number_display.update()
         color_temp = [self.INTENSITY, 0, 0]
         color_pre = [0, self.INTENSITY, 0]
         color_hum = [0, 0, self.INTENSITY]
 
-        def display_square(x_offset):
-            square_shape = [(x, y) for x in range(2) for y in range(2)]
-            for x, y in square_shape:
-                assert x + x_offset < 8
-                sense.set_pixel(x + x_offset, y,
-                                self.INTENSITY, self.INTENSITY, self.INTENSITY)
+        def show(x_offset, value, color):
+            # Compose square and number off-screen, then push only changes
+            number_display.clear()
+            number_display.fill_rect(x_offset, 0, 2, 2, self.INTENSITY,
+                                     self.INTENSITY, self.INTENSITY)
+            number_display.draw_number(value, *color)
+            number_display.update()
+            time.sleep(self.CYCLE_SLEEP)
 
         while True:
             display_status = False
@@ -140,54 +267,60 @@ class Thermometer(object):
                 if event.action == "pressed":
                     display_status ^= 1
 
-            sense.clear()
-
             if not display_status:
+                number_display.clear()
+                number_display.update()
                 time.sleep(self.CYCLE_SLEEP)
                 continue
 
             # Display Sense-Hat Temperature/Humidit
-            display_square(x_offset=0)
-
-            number_display.show_number(
-                round(self.temperature_sense), *color_temp)
-            time.sleep(self.CYCLE_SLEEP)
-
-            number_display.show_number(
-                round(self.humidity_sense), *color_hum)
-            time.sleep(self.CYCLE_SLEEP)
-
-            number_display.show_number(
-                round(self.pressure) % 100, *color_pre)
-            time.sleep(self.CYCLE_SLEEP)
+            sense_hat = self.sense_hat
+            show(0, round(sense_hat.temperature), color_temp)
+            show(0, round(sense_hat.humidity), color_hum)
+            show(0, round(sense_hat.pressure) % 100, color_pre)
 
             # Display DHT22 Temperature/Humidity
-            sense.clear()
-            display_square(x_offset=6)
-
-            number_display.show_number(
-                round(self.temperature_dht22), *color_temp)
-            time.sleep(self.CYCLE_SLEEP)
-
-            number_display.show_number(
-                round(self.humidity_dht22), *color_hum)
-            time.sleep(self.CYCLE_SLEEP)
+            dht22 = self.dht22
+            show(6, round(dht22.temperature), color_temp)
+            show(6, round(dht22.humidity), color_hum)
 
     def display_grove_lcd(self):
-        import grove_rgb_lcd as grl
+        if self.lcd is None:
+            self.lcd = drivers.make_lcd(self.hardware)
+        grl = self.lcd
         grl.setRGB(r=0, g=0, b=127)
         grl.setText("")
         while True:
             animation_chars = ['_', '|']
             for i in range(len(animation_chars)):
+                dht22 = self.dht22
                 s1 = "Tmp = {:.1f} C {}".format(
-                    self.temperature_dht22, animation_chars[i])
-                s2 = "Hum = {:.1f} %".format(self.humidity_dht22)
+                    dht22.temperature, animation_chars[i])
+                s2 = "Hum = {:.1f} %".format(dht22.humidity)
                 assert len(s1) <= 16
                 assert len(s2) <= 16
                 grl.setText_norefresh(s1 + "\n" + s2)
                 time.sleep(0.5)
 
+    def terminate(self, signum, frame):
+        # Runs on the main thread between two bytecodes, possibly in the
+        # middle of shutdown() or while it holds a lock, so it only unwinds
+        # main() and leaves the cleanup to it
+        if not self.stopping:
+            self.stopping = True
+            raise Terminated()
+
+    def shutdown(self, exit_code=0):
+        # Threads are never joined, so flush pending samples before exiting
+        self.stopping = True
+        try:
+            self.compactor.stop()
+            self.pipeline.close()
+            self.db.close()
+            self.log_listener.stop()
+        finally:
+            os._exit(exit_code)
+
     def main(self):
         # app_functions = [
         #     self.measure_dht22,
@@ -199,23 +332,48 @@ class Thermometer(object):
             self.display_sense_hat
         ]
 
-        app_threads = [threading.Thread(target=f) for f in app_functions]
-        for t in app_threads:
-            t.start()
-
-        while True:
-            time.sleep(1)
-            all_running = True
-            for t in app_threads:
-                if not t.is_alive():
-                    self.logger.error("Thread {} crashed".format(t.getName))
-                    all_running = False
-
-            if not all_running:
-                self.logger.error("One or more threds crashed")
-                os._exit(1)
+        signal.signal(signal.SIGTERM, self.terminate)
+        try:
+            try:
+                self.api.start()
+            except OSError as e:
+                self.logger.error(
+                    "Cannot start the readings API: {}".format(e))
+                self.shutdown(1)
+            self.pipeline.start()
+            self.compactor.start()
+
+            # Restarts a crashed worker on its own, the others keep running
+            for f in app_functions:
+                self.supervisor.add(f.__name__, f)
+            failed = self.supervisor.run()
+            self.logger.error("Thread {} keeps crashing".format(failed))
+            exit_code = 1
+        except Terminated:
+            exit_code = 0
+        self.shutdown(exit_code)
 
 
 if __name__ == "__main__":
-    t = Thermometer()
+    parser = argparse.ArgumentParser(description="Room thermometer daemon")
+    parser.add_argument("--hardware", choices=drivers.HARDWARE, default="pi",
+                        help="where readings come from (default: pi)")
+    parser.add_argument("--replay", metavar="SOURCE",
+                        help="database (*.db) or room_weather.log to replay")
+    parser.add_argument("--speedup", type=float, default=1,
+                        help="run this many times faster than real time")
+    parser.add_argument("--db",
+                        help="database to write to (default: {}, or one in "
+                        "a scratch directory without --hardware pi)".format(
+                            os.path.basename(temperature_db.DB_FILE)))
+    parser.add_argument("--structured-log", action="store_true",
+                        help="log readings to logs/room_weather.bin")
+    args = parser.parse_args()
+    if args.hardware == "replay" and args.replay is None:
+        parser.error("--hardware replay needs --replay SOURCE")
+    if args.replay is not None and args.db is not None and \
+            os.path.abspath(args.replay) == os.path.abspath(args.db):
+        parser.error("--db must not be the database being replayed")
+    t = Thermometer(args.hardware, args.replay, args.speedup, args.db,
+                    args.structured_log)
     t.main()
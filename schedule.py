@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import bisect
+import copy
+import datetime as dt
+
+DAY = 24 * 3600
+WEEK = 7 * DAY
+
+
+def parse_seconds(value):
+    """Seconds since midnight of a "HH:MM:SS" string"""
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+class WeeklySchedule(object):
+    """Heating timeslots of a week compiled into a sorted interval index
+
+    Built once from the "days" section (a list of 7 lists of
+    {"start": "HH:MM:SS", "end": "HH:MM:SS"} periods, Monday first). Slots
+    whose end is not after their start run past midnight, and slots which
+    touch each other, also across days and across the end of the week, are
+    merged into one. Lookups take O(log n).
+    """
+
+    def __init__(self, days):
+        self.days = copy.deepcopy(days)
+        intervals = []
+        for weekday, periods in enumerate(days):
+            for period in periods:
+                start, end = period["start"], period["end"]
+                # Skip unused (null) and empty periods
+                if start is None or end is None or start == end:
+                    continue
+                start = weekday * DAY + parse_seconds(start)
+                end = weekday * DAY + parse_seconds(end)
+                if end <= start:
+                    end += DAY
+                if end > WEEK:
+                    intervals.append((start, WEEK))
+                    intervals.append((0, end - WEEK))
+                else:
+                    intervals.append((start, end))
+
+        merged = []
+        for start, end in sorted(intervals):
+            # "23:59:59" followed by "00:00:00" counts as continuous
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+        # A slot running over the end of the week continues at its start
+        self.wraps = len(merged) > 1 and self.starts[0] == 0 and \
+            self.ends[-1] >= WEEK - 1
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    @staticmethod
+    def week_start(now):
+        return dt.datetime.combine(
+            now.date() - dt.timedelta(days=now.weekday()), dt.time())
+
+    @staticmethod
+    def week_offset(now):
+        return now.weekday() * DAY + now.hour * 3600 + now.minute * 60 + \
+            now.second + now.microsecond / 1e6
+
+    def find(self, offset):
+        """Index of the interval containing `offset`, or None"""
+        i = bisect.bisect_right(self.starts, offset) - 1
+        if i >= 0 and offset < self.ends[i]:
+            return i
+        return None
+
+    def current_slot(self, now=None):
+        """Returns the slot {"start", "end"} containing `now`, or None"""
+        now = now or dt.datetime.now()
+        i = self.find(self.week_offset(now))
+        if i is None:
+            return None
+        start, end = self.starts[i], self.ends[i]
+        if self.wraps and i == 0:
+            start = self.starts[-1] - WEEK
+        if self.wraps and i == len(self.starts) - 1:
+            end = WEEK + self.ends[0]
+        week_start = self.week_start(now)
+        return {"start": week_start + dt.timedelta(seconds=start),
+                "end": week_start + dt.timedelta(seconds=end)}
+
+    def next_start(self, now=None):
+        """Returns when the next slot starts after `now`, or None"""
+        if not self.starts:
+            return None
+        now = now or dt.datetime.now()
+        offset = self.week_offset(now)
+        i = bisect.bisect_right(self.starts, offset)
+        if self.wraps:
+            # The slot starting at 0 is the continuation of the last one
+            candidates = self.starts[1:]
+            i = max(i, 1)
+        else:
+            candidates = self.starts
+        if not candidates:
+            return None
+        start = self.starts[i] if i < len(self.starts) else \
+            candidates[0] + WEEK
+        return self.week_start(now) + dt.timedelta(seconds=start)
+
+    def next_transition(self, now=None):
+        """Returns the next slot start or end after `now`, or None"""
+        now = now or dt.datetime.now()
+        slot = self.current_slot(now)
+        if slot is not None:
+            return slot["end"]
+        return self.next_start(now)
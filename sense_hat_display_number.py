@@ -1,10 +1,9 @@
 #!/usr/bin/env python3
-from sense_hat import SenseHat
 import time
 
 
 class NumberDisplay(object):
-    def __init__(self, rotation=0):
+    def __init__(self, rotation=0, sense=None):
         self.OFFSET_LEFT = 0
         self.OFFSET_TOP = 3
         self.NUMS = [1, 1, 1, 1, 0, 1, 1, 0, 1, 1, 0, 1, 1, 1, 1,  # 0
@@ -18,30 +17,85 @@ class NumberDisplay(object):
                      1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 0, 1, 1, 1, 1,  # 8
                      1, 1, 1, 1, 0, 1, 1, 1, 1, 0, 0, 1, 0, 0, 1]  # 9
 
-        self.sense = SenseHat()
+        if sense is None:
+            from sense_hat import SenseHat
+
+            sense = SenseHat()
+        self.sense = sense
         self.sense.set_rotation(rotation)
+        # Frame being composed and the frame last pushed to the LEDs
+        self.frame = [self.BLACK] * 64
+        self.shown = None
+        self.glyphs = {}
 
-    def show_digit(self, val, xd, yd, r, g, b):
-        """Displays a single digit (0-9)"""
+    BLACK = (0, 0, 0)
+
+    def glyph(self, val, r, g, b):
+        """Pixels of digit `val` in the given color, rendered once"""
+        key = (val, r, g, b)
+        pixels = self.glyphs.get(key)
+        if pixels is None:
+            on = (r, g, b)
+            pixels = [on if bit else self.BLACK
+                      for bit in self.NUMS[val * 15:val * 15 + 15]]
+            self.glyphs[key] = pixels
+        return pixels
+
+    def clear(self):
+        self.frame = [self.BLACK] * 64
+
+    def fill_rect(self, x, y, width, height, r, g, b):
+        for yt in range(y, y + height):
+            for xt in range(x, x + width):
+                assert xt < 8 and yt < 8
+                self.frame[yt * 8 + xt] = (r, g, b)
+
+    def draw_digit(self, val, xd, yd, r, g, b):
+        """Draws a single digit (0-9) into the frame"""
         assert isinstance(val, int)
         assert 0 <= val <= 9
-        offset = val * 15
-        for p in range(offset, offset + 15):
-            xt = p % 3
-            yt = (p-offset) // 3
-            self.sense.set_pixel(
-                xt+xd, yt+yd, r*self.NUMS[p], g*self.NUMS[p], b*self.NUMS[p])
+        pixels = self.glyph(val, r, g, b)
+        for row in range(5):
+            start = (yd + row) * 8 + xd
+            self.frame[start:start + 3] = pixels[row * 3:row * 3 + 3]
 
-    def show_number(self, val, r, g, b):
-        """Displays a two-digits positive number (0-99)"""
+    def draw_number(self, val, r, g, b):
+        """Draws a two-digits positive number (0-99) into the frame"""
         assert isinstance(val, int)
         assert 0 <= val <= 99
 
         abs_val = abs(val)
         tens = abs_val // 10
         units = abs_val % 10
-        self.show_digit(tens, self.OFFSET_LEFT, self.OFFSET_TOP, r, g, b)
-        self.show_digit(units, self.OFFSET_LEFT+4, self.OFFSET_TOP, r, g, b)
+        self.draw_digit(tens, self.OFFSET_LEFT, self.OFFSET_TOP, r, g, b)
+        self.draw_digit(units, self.OFFSET_LEFT+4, self.OFFSET_TOP, r, g, b)
+
+    def update(self):
+        """Pushes the frame to the LEDs, if it differs from the last one
+
+        A single changed pixel is written with set_pixel, anything more with
+        one set_pixels call.
+        """
+        if self.shown is None:
+            changed = range(64)
+        else:
+            changed = [i for i in range(64) if self.frame[i] != self.shown[i]]
+        if len(changed) == 1:
+            i = changed[0]
+            self.sense.set_pixel(i % 8, i // 8, *self.frame[i])
+        elif changed:
+            self.sense.set_pixels(self.frame)
+        self.shown = list(self.frame)
+
+    def show_digit(self, val, xd, yd, r, g, b):
+        """Displays a single digit (0-9)"""
+        self.draw_digit(val, xd, yd, r, g, b)
+        self.update()
+
+    def show_number(self, val, r, g, b):
+        """Displays a two-digits positive number (0-99)"""
+        self.draw_number(val, r, g, b)
+        self.update()
 
 
 # Main function
@@ -50,7 +104,8 @@ def main():
     for i in range(0, 100):
         disp.show_number(i, 200, 0, 60)
         time.sleep(0.2)
-    disp.sense.clear()
+    disp.clear()
+    disp.update()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import collections
+import math
+import mmap
+import os
+import struct
+import time
+
+# Lives in RAM on the Pi, so publishing a sample never touches the SD card
+FEED_FILE = "/dev/shm/room_thermometer_feed" if os.path.isdir("/dev/shm") \
+    else "/tmp/room_thermometer_feed"
+SENSORS = ["dht_22", "sense_hat"]
+CAPACITY = 240
+
+# Layout: one header, then per sensor a sensor header followed by a ring of
+# `capacity` records. Every sensor has its own sequence number which is odd
+# while the sensor's data is being written (a seqlock), so readers can
+# detect and retry torn reads without any locking.
+HEADER = struct.Struct("<4sIII")  # magic, version, sensor count, capacity
+SENSOR_HEADER = struct.Struct("<16sQQ")  # name, sequence, samples written
+RECORD = struct.Struct("<dddd")  # epoch, temperature, humidity, pressure
+MAGIC = b"RTFD"
+VERSION = 1
+
+Sample = collections.namedtuple(
+    "Sample", ["timestamp", "temperature", "humidity", "pressure"])
+
+
+def feed_size(sensor_count, capacity):
+    return HEADER.size + sensor_count * (
+        SENSOR_HEADER.size + capacity * RECORD.size)
+
+
+class SensorFeed(object):
+    def __init__(self, mm, sensors, capacity):
+        self.mm = mm
+        self.capacity = capacity
+        self.offsets = {}
+        offset = HEADER.size
+        for sensor in sensors:
+            self.offsets[sensor] = offset
+            offset += SENSOR_HEADER.size + capacity * RECORD.size
+
+    def close(self):
+        self.mm.close()
+
+
+class SensorFeedWriter(SensorFeed):
+    """Publishes the last `capacity` samples of every sensor in shared memory
+
+    An existing feed file with the same layout is reused, so readers keep
+    working across restarts of the writer. Updates left unfinished by a
+    killed writer are closed when the file is reopened.
+    """
+
+    def __init__(self, path=FEED_FILE, sensors=SENSORS, capacity=CAPACITY):
+        size = feed_size(len(sensors), capacity)
+        fd = None
+        try:
+            fd = os.open(path, os.O_RDWR)
+            mm = mmap.mmap(fd, size)
+            if HEADER.unpack_from(mm, 0) != \
+                    (MAGIC, VERSION, len(sensors), capacity):
+                mm.close()
+                raise ValueError("Incompatible feed layout")
+            offset = HEADER.size
+            for _ in sensors:
+                name, seq, count = SENSOR_HEADER.unpack_from(mm, offset)
+                if seq % 2:
+                    # The previous writer died in the middle of an update
+                    SENSOR_HEADER.pack_into(mm, offset, name, seq + 1, count)
+                offset += SENSOR_HEADER.size + capacity * RECORD.size
+        except (OSError, ValueError):
+            if fd is not None:
+                os.close(fd)
+            # Build the new file aside so readers never see it half done
+            tmp_path = path + ".tmp"
+            fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.ftruncate(fd, size)
+            mm = mmap.mmap(fd, size)
+            HEADER.pack_into(mm, 0, MAGIC, VERSION, len(sensors), capacity)
+            offset = HEADER.size
+            for sensor in sensors:
+                SENSOR_HEADER.pack_into(mm, offset, sensor.encode(), 0, 0)
+                offset += SENSOR_HEADER.size + capacity * RECORD.size
+            os.rename(tmp_path, path)
+        os.close(fd)
+        super(SensorFeedWriter, self).__init__(mm, sensors, capacity)
+
+    def publish(self, sensor, temperature, humidity, pressure=None,
+                timestamp=None):
+        offset = self.offsets[sensor]
+        name, seq, count = SENSOR_HEADER.unpack_from(self.mm, offset)
+        record_offset = offset + SENSOR_HEADER.size + \
+            (count % self.capacity) * RECORD.size
+        SENSOR_HEADER.pack_into(self.mm, offset, name, seq + 1, count)
+        RECORD.pack_into(
+            self.mm, record_offset,
+            timestamp if timestamp is not None else time.time(),
+            temperature if temperature is not None else math.nan,
+            humidity if humidity is not None else math.nan,
+            pressure if pressure is not None else math.nan)
+        SENSOR_HEADER.pack_into(self.mm, offset, name, seq + 2, count + 1)
+
+
+class SensorFeedReader(SensorFeed):
+    """Reads samples published by a SensorFeedWriter, without locks or parsing
+
+    A read which cannot get a consistent copy within `timeout` seconds, e.g.
+    because the writer was killed in the middle of an update, raises
+    RuntimeError instead of retrying forever.
+    """
+
+    def __init__(self, path=FEED_FILE, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.inode = os.fstat(fd).st_ino
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, version, sensor_count, capacity = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            mm.close()
+            raise ValueError("'{}' is not a sensor feed".format(path))
+        sensors = []
+        offset = HEADER.size
+        for _ in range(sensor_count):
+            name = SENSOR_HEADER.unpack_from(mm, offset)[0]
+            sensors.append(name.rstrip(b"\x00").decode())
+            offset += SENSOR_HEADER.size + capacity * RECORD.size
+        self.sensors = sensors
+        super(SensorFeedReader, self).__init__(mm, sensors, capacity)
+
+    def read(self, sensor, n):
+        """Returns (sequence, newest first list of up to n samples)"""
+        offset = self.offsets[sensor]
+        n = min(n, self.capacity)
+        deadline = None
+        while True:
+            _, seq, count = SENSOR_HEADER.unpack_from(self.mm, offset)
+            if seq % 2:
+                # The writer is in the middle of an update
+                if deadline is None:
+                    deadline = time.monotonic() + self.timeout
+                elif time.monotonic() > deadline:
+                    raise RuntimeError(
+                        "Sensor '{}' of the feed stays locked".format(sensor))
+                time.sleep(0)
+                continue
+            samples = []
+            for i in range(count - 1, max(count - n, 0) - 1, -1):
+                record = RECORD.unpack_from(
+                    self.mm, offset + SENSOR_HEADER.size +
+                    (i % self.capacity) * RECORD.size)
+                samples.append(Sample(*(None if math.isnan(v) else v
+                                        for v in record)))
+            if SENSOR_HEADER.unpack_from(self.mm, offset)[1] == seq:
+                return seq, samples
+
+    def latest(self, sensor):
+        samples = self.read(sensor, 1)[1]
+        return samples[0] if samples else None
+
+    def history(self, sensor, n=CAPACITY):
+        """Returns up to n most recent samples, oldest first"""
+        return list(reversed(self.read(sensor, n)[1]))
+
+    def replaced(self):
+        """Tells whether the feed file has been recreated since opening it"""
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return True
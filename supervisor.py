@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import heapq
+import logging
+import queue
+import threading
+import time
+
+import metrics
+
+WORKER_UP = metrics.gauge(
+    "room_worker_up", "Whether a worker thread is running", ["worker"])
+WORKER_RESTARTS = metrics.counter(
+    "room_worker_restarts_total", "Times a worker thread was restarted",
+    ["worker"])
+WORKER_STARTED = metrics.gauge(
+    "room_worker_started_timestamp_seconds",
+    "When a worker thread was last started, for its uptime", ["worker"])
+
+
+class Worker(object):
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+        self.thread = None
+        self.started = None
+        self.restarts = 0
+        self.failures = 0
+
+
+class Supervisor(object):
+    """Runs worker threads and restarts the ones which die
+
+    A worker reports its own end from a finally block, so the supervisor
+    sleeps until a worker dies instead of polling. Only the dead worker is
+    restarted, after `backoff` seconds doubling with every failure in a row
+    up to `max_backoff`. A worker which ran for `reset_after` seconds starts
+    over from `backoff`. After `max_failures` failures in a row run() gives
+    up and returns the worker's name.
+    """
+
+    def __init__(self, backoff=0.5, max_backoff=60, reset_after=300,
+                 max_failures=10):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reset_after = reset_after
+        self.max_failures = max_failures
+        self.workers = {}
+        self.ended = queue.Queue()
+        self.logger = logging.getLogger()
+
+    def add(self, name, function):
+        """Registers function() as a worker, it should run forever"""
+        self.workers[name] = Worker(name, function)
+
+    def start_worker(self, worker):
+        worker.thread = threading.Thread(
+            target=self.run_worker, args=(worker,), name=worker.name,
+            daemon=True)
+        worker.started = time.monotonic()
+        WORKER_STARTED.labels(worker.name).set(time.time())
+        WORKER_UP.labels(worker.name).set(1)
+        worker.thread.start()
+
+    def run_worker(self, worker):
+        try:
+            worker.function()
+            self.logger.error("Worker {} returned".format(worker.name))
+        except Exception:
+            self.logger.exception("Worker {} crashed".format(worker.name))
+        finally:
+            WORKER_UP.labels(worker.name).set(0)
+            self.ended.put(worker)
+
+    def delay(self, worker):
+        """Returns how long to wait before restarting a worker that ended"""
+        if time.monotonic() - worker.started >= self.reset_after:
+            worker.failures = 0
+        worker.failures += 1
+        return min(self.backoff * 2 ** (worker.failures - 1),
+                   self.max_backoff)
+
+    def run(self):
+        """Starts all workers and restarts them until one fails for good"""
+        for worker in self.workers.values():
+            self.start_worker(worker)
+        pending = []
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(pending[0][0] - time.monotonic(), 0)
+            try:
+                worker = self.ended.get(timeout=timeout)
+                delay = self.delay(worker)
+                if worker.failures > self.max_failures:
+                    self.logger.error("Worker {} failed {} times in a row, "
+                                      "giving up".format(worker.name,
+                                                         worker.failures))
+                    return worker.name
+                self.logger.error("Restarting worker {} in {:.1f} s".format(
+                    worker.name, delay))
+                heapq.heappush(pending, (time.monotonic() + delay,
+                                         worker.name))
+            except queue.Empty:
+                pass
+            while pending and pending[0][0] <= time.monotonic():
+                worker = self.workers[heapq.heappop(pending)[1]]
+                worker.restarts += 1
+                WORKER_RESTARTS.labels(worker.name).inc()
+                self.start_worker(worker)
+
+    def status(self):
+        """Returns the restarts and uptime in seconds of every worker"""
+        now = time.monotonic()
+        return dict((worker.name, {
+            "alive": worker.thread is not None and worker.thread.is_alive(),
+            "restarts": worker.restarts,
+            "uptime": now - worker.started
+            if worker.thread is not None and worker.thread.is_alive() else 0,
+        }) for worker in self.workers.values())
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import metrics
+
+DB_FILE = os.path.split(os.path.abspath(__file__))[0] + "/room_temperature.db"
+
+# All sensors share one time-indexed table. A series is one (sensor, metric)
+# pair, e.g. ("dht_22", "temperature"), and timestamps are integer epoch
+# seconds. The samples table is clustered on (series_id, ts) so range scans
+# of one series read contiguous pages.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    sensor TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    UNIQUE (sensor, metric)
+);
+CREATE TABLE IF NOT EXISTS samples (
+    series_id INTEGER NOT NULL REFERENCES series (id),
+    ts INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (series_id, ts)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+"""
+
+# Pre-computed aggregates of the samples table, kept up to date by every
+# flush of the DatabaseWriter. Buckets are aligned to UTC.
+ROLLUPS = {
+    "samples_minutely": 60,
+    "samples_hourly": 3600,
+    "samples_daily": 86400,
+}
+
+# How long rows are kept per table, in seconds (None: forever). Raw samples
+# are already folded into the rollups when written, so the Compactor only
+# has to delete them.
+RETENTION = {
+    "samples": 30 * 86400,
+    "samples_minutely": 365 * 86400,
+    "samples_hourly": None,
+    "samples_daily": None,
+}
+
+ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {} (
+    series_id INTEGER NOT NULL REFERENCES series (id),
+    ts INTEGER NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    sum REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (series_id, ts)
+) WITHOUT ROWID;
+"""
+
+ROLLUP_UPSERT = """
+INSERT INTO {table} (series_id, ts, min, max, sum, count)
+SELECT series_id, ts - ts % {width}, min(value), max(value), sum(value), count(*)
+FROM {source} GROUP BY series_id, ts - ts % {width}
+ON CONFLICT (series_id, ts) DO UPDATE SET
+    min = min(min, excluded.min),
+    max = max(max, excluded.max),
+    sum = sum + excluded.sum,
+    count = count + excluded.count
+"""
+
+DB_WRITE_SECONDS = metrics.histogram(
+    "room_db_write_seconds", "Time spent in DatabaseWriter.write")
+DB_FLUSH_SECONDS = metrics.histogram(
+    "room_db_flush_seconds", "Time to commit one batch of samples")
+DB_SAMPLES = metrics.counter(
+    "room_db_samples_total", "Samples committed to the database")
+DB_COMPACTED_ROWS = metrics.counter(
+    "room_db_compacted_rows_total", "Rows deleted after their retention",
+    ["table"])
+DB_COMPACTION_SECONDS = metrics.histogram(
+    "room_db_compaction_seconds", "Duration of one compaction pass")
+
+# Tables written by older versions: one table per sensor with text datetimes
+LEGACY_TABLES = {
+    "dht_22": ["temperature", "humidity"],
+}
+
+
+def connect(db_file=DB_FILE):
+    conn = sqlite3.connect(db_file, check_same_thread=False)
+    existing = set(row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    if not existing:
+        # Lets the Compactor give deleted pages back to the file system;
+        # only takes effect before the first table is created
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    for table_name in ROLLUPS:
+        conn.executescript(ROLLUP_SCHEMA.format(table_name))
+    added = [table_name for table_name in ROLLUPS
+             if existing and table_name not in existing]
+    if added:
+        # Rollups introduced after the database was created
+        with conn:
+            update_rollups(conn, "samples", added)
+    return conn
+
+
+def connect_readonly(db_file=DB_FILE):
+    """Opens an existing database read-only, without creating it"""
+    if not os.path.isfile(db_file):
+        raise FileNotFoundError("Database '{}' does not exist".format(db_file))
+    return sqlite3.connect("file:{}?mode=ro".format(
+        urllib.parse.quote(os.path.abspath(db_file))), uri=True,
+        check_same_thread=False)
+
+
+def update_rollups(conn, source, tables=ROLLUPS):
+    """Adds the (series_id, ts, value) rows of table `source` to the rollups"""
+    for table_name in tables:
+        conn.execute(ROLLUP_UPSERT.format(
+            table=table_name, width=ROLLUPS[table_name], source=source))
+
+
+def rebuild_rollups(conn):
+    with conn:
+        for table_name in ROLLUPS:
+            conn.execute("DELETE FROM {}".format(table_name))
+        update_rollups(conn, "samples")
+
+
+def get_series_id(conn, sensor, metric, create=False):
+    row = conn.execute(
+        "SELECT id FROM series WHERE sensor = ? AND metric = ?",
+        (sensor, metric)).fetchone()
+    if row is not None:
+        return row[0]
+    if not create:
+        return None
+    return conn.execute(
+        "INSERT INTO series (sensor, metric) VALUES (?, ?)",
+        (sensor, metric)).lastrowid
+
+
+def migrate_legacy_tables(conn):
+    """Move rows of the old per-sensor tables into the samples table"""
+    existing = set(row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    for table_name, metric_names in LEGACY_TABLES.items():
+        if table_name not in existing:
+            continue
+        with conn:
+            for metric in metric_names:
+                series_id = get_series_id(conn, table_name, metric, create=True)
+                # Legacy datetimes were written in local time
+                conn.execute("""INSERT OR REPLACE INTO samples
+                    SELECT ?, CAST(strftime('%s', datetime, 'utc') AS INTEGER), {}
+                    FROM {} WHERE {} IS NOT NULL""".format(
+                    metric, table_name, metric), (series_id,))
+            conn.execute("DROP TABLE {}".format(table_name))
+        rebuild_rollups(conn)
+        logging.getLogger().info(
+            "Migrated legacy table '{}' into samples".format(table_name))
+
+
+def read_samples(sensor, metric, start=None, end=None, db_file=DB_FILE):
+    """Yields (epoch, value) tuples of one series, ordered by time
+
+    `start` and `end` are epoch seconds; `end` is exclusive.
+    """
+    conn = connect_readonly(db_file)
+    try:
+        series_id = get_series_id(conn, sensor, metric)
+        if series_id is None:
+            return
+        cursor = conn.execute(
+            """SELECT ts, value FROM samples
+            WHERE series_id = ? AND ts >= ? AND ts < ? ORDER BY ts""",
+            (series_id, start if start is not None else 0,
+             end if end is not None else 2 ** 62))
+        for row in cursor:
+            yield row
+    finally:
+        conn.close()
+
+
+def read_aggregates(sensor, metric, width, start=None, end=None,
+                    db_file=DB_FILE):
+    """Yields (epoch, min, mean, max, count) tuples from a rollup table
+
+    `width` must be one of the ROLLUPS bucket widths.
+    """
+    table_name = dict((w, t) for t, w in ROLLUPS.items())[width]
+    conn = connect_readonly(db_file)
+    try:
+        series_id = get_series_id(conn, sensor, metric)
+        if series_id is None:
+            return
+        cursor = conn.execute(
+            """SELECT ts, min, sum / count, max, count FROM {}
+            WHERE series_id = ? AND ts >= ? AND ts < ? ORDER BY ts""".format(
+                table_name),
+            (series_id, start if start is not None else 0,
+             end if end is not None else 2 ** 62))
+        for row in cursor:
+            yield row
+    finally:
+        conn.close()
+
+
+def retained_since(table_name, now=None):
+    """Oldest timestamp still kept in `table_name`, or 0"""
+    retention = RETENTION.get(table_name)
+    if retention is None:
+        return 0
+    return int(now if now is not None else time.time()) - retention
+
+
+def pick_resolution(start, end, max_points, sample_interval=15, now=None):
+    """Returns the coarsest needed bucket width (0 for raw samples)
+
+    The choice is made so that at most about `max_points` rows are read,
+    from a table which still holds data back to `start`.
+    """
+    span = end - start
+    if span / sample_interval <= max_points and \
+            start >= retained_since("samples", now):
+        return 0
+    for table_name, width in sorted(ROLLUPS.items(), key=lambda t: t[1]):
+        if span / width <= max_points and \
+                start >= retained_since(table_name, now):
+            return width
+    return max(ROLLUPS.values())
+
+
+class DatabaseWriter(object):
+    """Long-lived SQLite writer which buffers samples and commits them in groups
+
+    Samples are kept in memory until either `batch_size` of them have been
+    collected or `flush_interval` seconds have passed since the last flush,
+    whichever comes first. At most one batch window of data can be lost on a
+    crash; everything that was committed survives thanks to the WAL journal.
+    """
+
+    def __init__(self, db_file=DB_FILE, batch_size=20, flush_interval=60):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.series_ids = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # A single connection is shared by the sensor threads and the flusher
+        self.conn = connect(db_file)
+        self.conn.execute("""CREATE TEMP TABLE pending
+            (series_id INTEGER, ts INTEGER, value REAL,
+             PRIMARY KEY (series_id, ts)) WITHOUT ROWID""")
+        migrate_legacy_tables(self.conn)
+
+        self.stop_event = threading.Event()
+        self.flusher = threading.Thread(
+            target=self.flush_periodically, name="db-flusher", daemon=True)
+        self.flusher.start()
+        atexit.register(self.close)
+
+    def write(self, sensor, timestamp=None, **values):
+        """Buffers one reading, e.g. write("dht_22", temperature=21.3)"""
+        now = int(timestamp if timestamp is not None else time.time())
+        with DB_WRITE_SECONDS.time(), self.lock:
+            if self.closed:
+                raise RuntimeError("Database writer is closed")
+            for metric, value in values.items():
+                if value is not None:
+                    self.buffer.append((sensor, metric, now, round(value, 2)))
+            if len(self.buffer) >= self.batch_size:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if not self.buffer:
+            return
+        samples, self.buffer = self.buffer, []
+        try:
+            with DB_FLUSH_SECONDS.time(), self.conn:
+                rows = []
+                for sensor, metric, ts, value in samples:
+                    key = (sensor, metric)
+                    if key not in self.series_ids:
+                        self.series_ids[key] = get_series_id(
+                            self.conn, sensor, metric, create=True)
+                    rows.append((self.series_ids[key], ts, value))
+                # The first sample of a (series, ts) wins, a rewrite (e.g. a
+                # replay into the same database) must not be counted twice
+                self.conn.execute("DELETE FROM temp.pending")
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO temp.pending VALUES (?, ?, ?)",
+                    rows)
+                self.conn.execute("""DELETE FROM temp.pending WHERE EXISTS (
+                    SELECT 1 FROM samples WHERE samples.series_id =
+                        pending.series_id AND samples.ts = pending.ts)""")
+                self.conn.execute(
+                    "INSERT INTO samples SELECT * FROM temp.pending")
+                # Fold the same batch into the rollups without rescanning
+                update_rollups(self.conn, "temp.pending")
+        except sqlite3.Error:
+            # Series created in the failed transaction were rolled back too
+            self.series_ids = {}
+            # Keep the samples around so that the next flush retries them
+            self.buffer = samples + self.buffer
+            raise
+        DB_SAMPLES.inc(len(samples))
+
+    def flush_periodically(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.getLogger().error("Database flush failed: {}".format(e))
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.stop_event.set()
+            self.flush_locked()
+            self.conn.close()
+
+
+class Compactor(object):
+    """Deletes rows older than their RETENTION in a background thread
+
+    Rows go in transactions of `batch_size`, with a pause between them, so
+    the DatabaseWriter never waits long for the write lock. Freed pages are
+    then returned with incremental vacuum, also in small steps. Databases
+    created before auto_vacuum was enabled are converted once, with a full
+    VACUUM; flushes failing meanwhile are retried by the writer.
+    """
+
+    def __init__(self, db_file=DB_FILE, retention=RETENTION, interval=3600,
+                 batch_size=500, pause=0.2, vacuum_pages=256):
+        self.db_file = db_file
+        self.retention = retention
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="db-compactor",
+                                       daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.compact()
+            except sqlite3.Error as e:
+                self.logger.error("Database compaction failed: {}".format(e))
+            self.stop_event.wait(self.interval)
+
+    def compact(self):
+        """Runs one pass and returns the number of deleted rows"""
+        conn = connect(self.db_file)
+        try:
+            with DB_COMPACTION_SECONDS.time():
+                if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                    self.logger.info("Enabling incremental vacuum")
+                    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                    conn.execute("VACUUM")
+                deleted = 0
+                for table_name, retention in self.retention.items():
+                    if retention is not None:
+                        deleted += self.delete_before(
+                            conn, table_name, retained_since(table_name))
+                if deleted:
+                    self.logger.info("Compaction deleted {} rows".format(
+                        deleted))
+                    self.vacuum(conn)
+                return deleted
+        finally:
+            conn.close()
+
+    def delete_before(self, conn, table_name, cutoff):
+        # The samples table is found through its ts index, the small rollup
+        # tables are scanned
+        query = """DELETE FROM {0} WHERE (series_id, ts) IN (
+            SELECT series_id, ts FROM {0} WHERE ts < ? LIMIT ?)""".format(
+            table_name)
+        deleted = 0
+        while not self.stop_event.is_set():
+            with conn:
+                count = conn.execute(query, (cutoff, self.batch_size)).rowcount
+            deleted += count
+            DB_COMPACTED_ROWS.labels(table_name).inc(count)
+            if count < self.batch_size:
+                break
+            self.stop_event.wait(self.pause)
+        return deleted
+
+    def vacuum(self, conn):
+        while not self.stop_event.is_set() and \
+                conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            # The pragma only runs to completion once all rows are fetched
+            conn.execute("PRAGMA incremental_vacuum({})".format(
+                self.vacuum_pages)).fetchall()
+            self.stop_event.wait(self.pause)
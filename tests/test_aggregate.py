@@ -0,0 +1,48 @@
+import unittest
+
+import numpy as np
+
+import aggregate
+
+
+class BucketTest(unittest.TestCase):
+    def test_buckets_are_aligned_to_the_width(self):
+        starts, mins, means, maxs, counts = aggregate.bucket(
+            [10, 50, 70, 130], [1.0, 3.0, 5.0, 7.0], 60)
+        self.assertEqual(starts.tolist(), [0, 60, 120])
+        self.assertEqual(mins.tolist(), [1.0, 5.0, 7.0])
+        self.assertEqual(means.tolist(), [2.0, 5.0, 7.0])
+        self.assertEqual(maxs.tolist(), [3.0, 5.0, 7.0])
+        self.assertEqual(counts.tolist(), [2, 1, 1])
+
+    def test_empty_series(self):
+        self.assertEqual(len(aggregate.bucket([], [], 60)[0]), 0)
+
+
+class LttbTest(unittest.TestCase):
+    def setUp(self):
+        self.timestamps = np.arange(1000, dtype=np.float64)
+        self.values = np.sin(self.timestamps / 50)
+        self.values[437] = 10.0
+
+    def test_keeps_the_ends_and_the_count(self):
+        timestamps, values = aggregate.lttb(self.timestamps, self.values, 50)
+        self.assertEqual(len(timestamps), 50)
+        self.assertEqual(timestamps[0], 0)
+        self.assertEqual(timestamps[-1], 999)
+        self.assertTrue((np.diff(timestamps) > 0).all())
+
+    def test_keeps_peaks(self):
+        timestamps, values = aggregate.lttb(self.timestamps, self.values, 50)
+        self.assertIn(437, timestamps.tolist())
+        self.assertEqual(values.max(), 10.0)
+
+    def test_short_series_are_returned_as_they_are(self):
+        timestamps, values = aggregate.lttb([1, 2, 3], [4, 5, 6], 5)
+        self.assertEqual(timestamps.tolist(), [1, 2, 3])
+        self.assertEqual(len(aggregate.downsample(
+            self.timestamps, self.values, 2000)[0]), 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import functools
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import binlog
+
+
+def reading(i, sensor="dht_22"):
+    return binlog.encode("reading", 1000 + i, {
+        "sensor": sensor, "temperature": 20 + i, "humidity": 40.0})
+
+
+def shortened(record, size):
+    """`record` as written by a version with fields only up to `size` bytes"""
+    return record[:2] + struct.pack("<H", size - binlog.PREFIX.size) + \
+        record[4:size]
+
+
+class BinlogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "room_weather.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data):
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def timestamps(self, chunk_size=None):
+        if chunk_size is None:
+            return [r.timestamp for r in binlog.read_records(self.path)]
+        with mock.patch.object(binlog, "iter_chunks", functools.partial(
+                binlog.iter_chunks, chunk_size=chunk_size)):
+            return [r.timestamp for r in binlog.read_records(self.path)]
+
+    def test_round_trip(self):
+        offset = binlog.encode("offset", 5.0, {
+            "device": "living room", "sensor_temp": 21.25, "new_offset": 1})
+        self.write(reading(0, "sense_hat") + offset)
+        first, second = binlog.read_records(self.path)
+        self.assertEqual(first.sensor, "sense_hat")
+        self.assertEqual(first.temperature, 20.0)
+        self.assertIsNone(first.pressure)
+        self.assertEqual(second.device, "living room")
+        self.assertEqual(second.sensor_temp, 21.25)
+        self.assertIsNone(second.current_temp)
+        self.assertEqual(
+            [type(r).__name__ for r in binlog.read_records(
+                self.path, ["offset"])], ["OffsetRecord"])
+
+    def test_read_columns_filters_by_string_fields(self):
+        self.write(b"".join(reading(i, "dht_22" if i % 2 else "sense_hat")
+                            for i in range(6)))
+        timestamps, temperatures = binlog.read_columns(
+            self.path, "reading", ["timestamp", "temperature"],
+            sensor="dht_22")
+        self.assertEqual(timestamps.tolist(), [1001, 1003, 1005])
+        self.assertEqual(temperatures.tolist(), [21, 23, 25])
+
+    def test_records_after_nul_padding_are_read(self):
+        # What a power loss leaves behind
+        self.write(b"".join(reading(i) for i in range(5)) + b"\0" * 1021 +
+                   b"".join(reading(i) for i in range(5, 10)))
+        expected = [1000.0 + i for i in range(10)]
+        for chunk_size in (None, 1, 7, 64):
+            self.assertEqual(self.timestamps(chunk_size), expected)
+        self.assertEqual(binlog.read_columns(
+            self.path, "reading", ["timestamp"])[0].tolist(), expected)
+
+    def test_torn_records_are_skipped(self):
+        # A record cut off by a crash, then the records after the restart,
+        # then one cut off at the end of the file
+        self.write(b"".join(reading(i) for i in range(3)) + reading(3)[:9] +
+                   b"".join(reading(i) for i in range(4, 7)) + reading(7)[:20])
+        expected = [1000.0, 1001.0, 1002.0, 1004.0, 1005.0, 1006.0]
+        for chunk_size in (None, 1, 7, 64):
+            self.assertEqual(self.timestamps(chunk_size), expected)
+
+    def test_unknown_kinds_are_skipped(self):
+        unknown = binlog.MAGIC + struct.pack("<HBd", 13, 99, 0.0) + b"abcd"
+        self.write(reading(0) + unknown + reading(1))
+        self.assertEqual(self.timestamps(), [1000.0, 1001.0])
+
+    def test_records_without_appended_fields(self):
+        # Written before "pressure" was added to the reading record
+        size = binlog.STRUCTS["reading"].size - 4
+        self.write(shortened(reading(0, "sense_hat"), size) +
+                   reading(1, "sense_hat"))
+        old, new = binlog.read_records(self.path)
+        self.assertEqual((old.temperature, old.pressure), (20.0, None))
+        self.assertEqual(new.temperature, 21.0)
+        temperatures, pressures = binlog.read_columns(
+            self.path, "reading", ["temperature", "pressure"])
+        self.assertEqual(temperatures.tolist(), [20.0, 21.0])
+        self.assertTrue(all(p != p for p in pressures))
+
+    def test_records_with_unknown_appended_fields(self):
+        record = reading(0)
+        longer = record[:2] + struct.pack(
+            "<H", len(record) + 4 - binlog.PREFIX.size) + record[4:] + \
+            struct.pack("<f", 3.3)
+        self.write(longer + reading(1))
+        self.assertEqual(
+            [r.temperature for r in binlog.read_records(self.path)],
+            [20.0, 21.0])
+
+    def test_rotated_files_are_gzipped_and_read_in_order(self):
+        logger = binlog.setup(self.path)
+        self.addCleanup(logging.getLogger("binlog").handlers.clear)
+        handler = logger.handlers[-1]
+        binlog.log_record(logger, "reading", 1.0, sensor="dht_22",
+                          temperature=20.0)
+        handler.doRollover()
+        binlog.log_record(logger, "reading", 2.0, sensor="dht_22",
+                          temperature=21.0)
+        handler.close()
+        files = binlog.find_log_files(self.path)
+        self.assertEqual(len(files), 2)
+        self.assertTrue(files[0].endswith(".gz"))
+        self.assertEqual(self.timestamps(), [1.0, 2.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import drivers
+from drivers import DHT22Reading, ReplaySensor, SimulatedSensor
+
+
+class SimulatedSensorTest(unittest.TestCase):
+    def test_readings_are_spaced_by_the_interval(self):
+        sensor = SimulatedSensor("sense_hat", interval=15, seed=1)
+        first, second = sensor.read(), sensor.read()
+        self.assertEqual(second.timestamp - first.timestamp, 15)
+        self.assertAlmostEqual(first.timestamp, time.time(), delta=5)
+        self.assertAlmostEqual(first.pressure, 1013.0, delta=1)
+
+    def test_failures(self):
+        sensor = SimulatedSensor("dht_22", failure_rate=1.0)
+        self.assertIsNone(sensor.read())
+
+
+class ReplaySensorTest(unittest.TestCase):
+    def test_readings_are_stamped_from_the_start_of_the_replay(self):
+        sensor = ReplaySensor([DHT22Reading(1000.0, 20.0, 40.0),
+                               DHT22Reading(1015.0, 21.0, 41.0)])
+        readings = [sensor.read() for _ in range(5)]
+        start = readings[0].timestamp
+        self.assertAlmostEqual(start, time.time(), delta=5)
+        self.assertEqual([r.timestamp - start for r in readings],
+                         [0, 15, 16, 31, 32])
+        self.assertEqual([r.temperature for r in readings],
+                         [20.0, 21.0, 20.0, 21.0, 20.0])
+
+    def test_nothing_to_replay(self):
+        self.assertRaises(ValueError, ReplaySensor, [])
+
+
+class LoadLogReadingsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.dir, "room_weather.log")
+        self.start = int(time.mktime((2026, 10, 12, 8, 0, 0, 0, 0, -1)))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, *lines):
+        with open(self.log_file, "w") as f:
+            for when, message in lines:
+                f.write("{},{:03d} {}\n".format(
+                    time.strftime("%Y-%m-%d %H:%M:%S",
+                                  time.localtime(int(when))),
+                    int(round(when % 1 * 1000)), message))
+
+    def test_values_of_one_sample_are_merged(self):
+        self.write(
+            (self.start + 0.990, "[DHT22] Temperature = 21.5 C"),
+            # Logged in the next second
+            (self.start + 1.010, "[DHT22] Humidity = 45.0 %"),
+            (self.start + 15.500, "[DHT22] Temperature = 21.6 C"),
+            (self.start + 15.501, "[DHT22] Humidity = 45.5 %"),
+            # No humidity: skipped
+            (self.start + 30.000, "[DHT22] Temperature = 21.7 C"),
+            (self.start + 45.000, "[DHT22] Temperature = 21.8 C"),
+            (self.start + 45.001, "[DHT22] Humidity = 46.0 %"))
+        readings = drivers.load_log_readings("dht_22", self.log_file)
+        self.assertEqual([(r.temperature, r.humidity) for r in readings],
+                         [(21.5, 45.0), (21.6, 45.5), (21.8, 46.0)])
+        self.assertAlmostEqual(readings[0].timestamp, self.start + 0.99)
+
+    def test_replay_from_a_log(self):
+        self.write(
+            (self.start, "[SenseHat] Temperature = 25.0 C"),
+            (self.start, "[SenseHat] Humidity = 35.0 %"),
+            (self.start, "[SenseHat] Pressure = 1013.2 millibar"))
+        sensor = ReplaySensor.from_source("sense_hat", self.log_file)
+        self.assertEqual(sensor.read()[1:], (25.0, 35.0, 1013.2))
+
+
+if __name__ == "__main__":
+    unittest.main()
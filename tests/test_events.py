@@ -0,0 +1,71 @@
+import datetime as dt
+import threading
+import time
+import unittest
+
+from events import EventScheduler
+
+
+class EventSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = EventScheduler(poll_interval=0.01)
+
+    def test_due_timers_fire_in_order(self):
+        now = dt.datetime.now()
+        self.scheduler.call_at(now - dt.timedelta(seconds=1), "late")
+        self.scheduler.call_at(now - dt.timedelta(seconds=2), "later")
+        self.scheduler.call_at(now + dt.timedelta(hours=1), "tomorrow")
+        self.assertEqual(self.scheduler.wait(), ["later", "late"])
+        self.assertEqual(list(self.scheduler.timers), ["tomorrow"])
+
+    def test_timer_is_replaced_and_cancelled(self):
+        self.scheduler.call_later(3600, "cycle")
+        self.scheduler.call_later(0.02, "cycle")
+        started = time.monotonic()
+        self.assertEqual(self.scheduler.wait(), ["cycle"])
+        self.assertLess(time.monotonic() - started, 1)
+        self.scheduler.call_later(0, "cycle")
+        self.scheduler.cancel_timer("cycle")
+        self.scheduler.notify("other")
+        self.assertEqual(self.scheduler.wait(), ["other"])
+
+    def test_notify_wakes_a_waiting_thread(self):
+        scheduler = EventScheduler(poll_interval=60)
+        scheduler.call_later(3600, "cycle")
+        timer = threading.Timer(0.05, scheduler.notify, ["config"])
+        timer.start()
+        started = time.monotonic()
+        self.assertEqual(scheduler.wait(), ["config"])
+        self.assertLess(time.monotonic() - started, 5)
+        timer.join()
+
+    def test_events_are_raised_once(self):
+        self.scheduler.notify("config")
+        self.scheduler.notify("config")
+        self.scheduler.call_later(-1, "cycle")
+        self.assertEqual(self.scheduler.wait(), ["cycle", "config"])
+
+    def test_watch_raises_its_event_on_changes(self):
+        values = iter([1, 1, None, 2])
+        self.scheduler.watch("sensor", lambda: next(values, 2))
+        self.scheduler.call_later(0.05, "cycle")
+        # The initial value and a failed or unchanged poll raise nothing
+        self.assertEqual(self.scheduler.wait(), ["sensor"])
+        self.assertEqual(self.scheduler.wait(), ["cycle"])
+
+    def test_failing_watch_is_logged(self):
+        def check():
+            raise RuntimeError("No recent reading")
+
+        with self.assertLogs("root", "WARNING"):
+            self.scheduler.watch("sensor", check)
+
+    def test_cancel_stops_waiting(self):
+        timer = threading.Timer(0.05, self.scheduler.cancel)
+        timer.start()
+        self.assertIsNone(self.scheduler.wait())
+        timer.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import math
+import unittest
+
+from fusion import SensorFilter, TemperatureFusion, hysteresis_offset
+
+
+class SensorFilterTest(unittest.TestCase):
+    def test_first_value_is_taken_as_it_is(self):
+        self.assertEqual(SensorFilter("t").update(20.0), 20.0)
+
+    def test_missing_values_are_rejected(self):
+        sensor_filter = SensorFilter("t")
+        sensor_filter.update(20.0)
+        self.assertEqual(sensor_filter.update(None), 20.0)
+        self.assertEqual(sensor_filter.update(math.nan), 20.0)
+
+    def test_single_outlier_is_rejected(self):
+        sensor_filter = SensorFilter("t", max_jump=3.0)
+        for value in (20.0, 20.1, 19.9):
+            sensor_filter.update(value)
+        before = sensor_filter.value
+        self.assertEqual(sensor_filter.update(-40.0), before)
+        self.assertAlmostEqual(sensor_filter.update(20.0), before, delta=0.1)
+
+    def test_consistent_jump_is_accepted(self):
+        sensor_filter = SensorFilter("t", window=3)
+        sensor_filter.update(20.0)
+        values = [sensor_filter.update(30.0) for _ in range(3)]
+        self.assertEqual(values, [20.0, 20.0, 30.0])
+
+    def test_noise_is_smoothed(self):
+        sensor_filter = SensorFilter("t")
+        values = [sensor_filter.update(20.5 + (0.2 if i % 2 else -0.2))
+                  for i in range(20)]
+        self.assertLess(max(values[5:]) - min(values[5:]), 0.2)
+
+
+class TemperatureFusionTest(unittest.TestCase):
+    def test_primary_is_used_while_recent(self):
+        fusion = TemperatureFusion("dht_22", "sense_hat", max_age=60)
+        fusion.update("dht_22", 0, 20.0)
+        fusion.update("sense_hat", 0, 25.0)
+        self.assertEqual(fusion.temperature(30), 20.0)
+
+    def test_secondary_is_corrected_by_the_learned_bias(self):
+        fusion = TemperatureFusion("dht_22", "sense_hat", max_age=60)
+        fusion.update("dht_22", 0, 20.0)
+        fusion.update("sense_hat", 0, 25.0)
+        # The DHT22 stops reporting, the Sense HAT sees the room warm up
+        for t in range(15, 301, 15):
+            fusion.update("dht_22", t, None)
+            fusion.update("sense_hat", t, 26.0)
+        self.assertAlmostEqual(fusion.temperature(300), 21.0, delta=0.1)
+
+    def test_nothing_recent(self):
+        fusion = TemperatureFusion("dht_22", "sense_hat", max_age=60)
+        self.assertIsNone(fusion.temperature(0))
+        fusion.update("dht_22", 0, 20.0)
+        self.assertIsNone(fusion.temperature(61))
+
+
+class HysteresisOffsetTest(unittest.TestCase):
+    def test_rounds_without_a_current_offset(self):
+        self.assertEqual(hysteresis_offset(1.4, None), 1)
+        self.assertEqual(hysteresis_offset(1.6, None), 2)
+
+    def test_keeps_the_current_offset_within_the_margin(self):
+        self.assertEqual(hysteresis_offset(1.6, 1, margin=0.3), 1)
+        self.assertEqual(hysteresis_offset(0.3, 1, margin=0.3), 1)
+        self.assertEqual(hysteresis_offset(1.9, 1, margin=0.3), 2)
+        self.assertEqual(hysteresis_offset(-0.1, 1, margin=0.3), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
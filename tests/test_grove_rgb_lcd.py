@@ -0,0 +1,90 @@
+import importlib
+import sys
+import types
+import unittest
+from unittest import mock
+
+
+class FakeBus(object):
+    """Records the I2C writes of the text controller"""
+
+    def __init__(self, number):
+        self.writes = []
+
+    def write_byte_data(self, address, register, value):
+        self.writes.append((address, register, value))
+
+    def write_i2c_block_data(self, address, register, data):
+        self.writes.append((address, register, "".join(map(chr, data))))
+
+
+def import_lcd():
+    """Imports grove_rgb_lcd on top of a fake I2C bus"""
+    smbus = types.ModuleType("smbus")
+    smbus.SMBus = FakeBus
+    gpio = types.ModuleType("RPi.GPIO")
+    gpio.RPI_REVISION = 3
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    with mock.patch.dict(sys.modules, {"smbus": smbus, "RPi": rpi,
+                                       "RPi.GPIO": gpio}):
+        sys.modules.pop("grove_rgb_lcd", None)
+        module = importlib.import_module("grove_rgb_lcd")
+    return module
+
+
+class BufferedTextTest(unittest.TestCase):
+    def setUp(self):
+        self.lcd = import_lcd()
+        self.bus = self.lcd.bus
+        patcher = mock.patch.object(self.lcd.time, "sleep")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def text_writes(self):
+        writes = [w for w in self.bus.writes
+                  if w[0] == self.lcd.DISPLAY_TEXT_ADDR]
+        self.bus.writes = []
+        return [w[2] if w[1] == 0x40 else hex(w[2]) for w in writes]
+
+    def test_layout(self):
+        self.assertEqual(self.lcd.layout("21.5 C\n45 %"),
+                         ["21.5 C          ", "45 %            "])
+        self.assertEqual(self.lcd.layout("x" * 20),
+                         ["x" * 16, "xxxx            "])
+        self.assertEqual(self.lcd.layout("a\nb\nc"),
+                         ["a" + " " * 15, "b" + " " * 15])
+
+    def test_only_changed_runs_are_written(self):
+        self.lcd.setText_norefresh("Temp 21.5 C\nHum 45 %")
+        # Initialisation, then one block per row
+        self.assertEqual(self.text_writes(), [
+            "0xc", "0x28", "0x80", "Temp 21.5 C     ",
+            "0xc0", "Hum 45 %        "])
+        self.lcd.setText_norefresh("Temp 21.5 C\nHum 45 %")
+        self.assertEqual(self.text_writes(), [])
+        self.lcd.setText_norefresh("Temp 21.6 C\nHum 46 %")
+        self.assertEqual(self.text_writes(), ["0x88", "6", "0xc5", "6"])
+
+    def test_close_changes_are_merged_into_one_run(self):
+        self.lcd.setText_norefresh("Temp 21.5 C")
+        self.text_writes()
+        self.lcd.setText_norefresh("Temp 22.0 C")
+        self.assertEqual(self.text_writes(), ["0x86", "2.0"])
+        self.lcd.setText_norefresh("Xemp 22.0 Y")
+        self.assertEqual(self.text_writes(), ["0x80", "X", "0x8a", "Y"])
+
+    def test_set_text_clears_and_writes_only_text(self):
+        self.lcd.setText("Hi")
+        self.assertEqual(self.text_writes(), [
+            "0x1", "0xc", "0x28", "0x80", "Hi"])
+
+    def test_unchanged_backlight_is_not_written(self):
+        self.lcd.setRGB(0, 128, 64)
+        self.assertEqual(len(self.bus.writes), 6)
+        self.lcd.setRGB(0, 128, 64)
+        self.assertEqual(len(self.bus.writes), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_exposition_format(self):
+        counter = self.registry.register(metrics.Counter(
+            "test_writes_total", "Writes", ["device"]))
+        counter.labels('living "room"').inc(2)
+        gauge = self.registry.register(metrics.Gauge("test_up", "Up"))
+        gauge.set(1)
+        histogram = self.registry.register(metrics.Histogram(
+            "test_seconds", "Durations", buckets=(0.1, 1)))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(self.registry.expose().splitlines(), [
+            "# HELP test_seconds Durations",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            "test_seconds_sum 5.55",
+            "test_seconds_count 3",
+            "# HELP test_up Up",
+            "# TYPE test_up gauge",
+            "test_up 1",
+            "# HELP test_writes_total Writes",
+            "# TYPE test_writes_total counter",
+            'test_writes_total{device="living \\"room\\""} 2',
+        ])
+
+    def test_registering_twice_returns_the_first_metric(self):
+        first = self.registry.register(metrics.Counter("test_total", "A"))
+        self.assertIs(
+            self.registry.register(metrics.Counter("test_total", "B")), first)
+
+
+if __name__ == "__main__":
+    unittest.main()
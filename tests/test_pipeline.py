@@ -0,0 +1,94 @@
+import logging
+import queue
+import threading
+import unittest
+
+import pipeline
+from pipeline import DroppingQueueHandler, Pipeline
+
+
+class PipelineTest(unittest.TestCase):
+    def test_sinks_see_every_reading_in_order(self):
+        calls = []
+        p = Pipeline()
+        p.add_sink("first", lambda sensor, reading: calls.append(
+            ("first", sensor, reading)))
+        p.add_sink("second", lambda sensor, reading: calls.append(
+            ("second", sensor, reading)))
+        p.start()
+        p.submit("dht_22", 1)
+        p.submit("sense_hat", 2)
+        p.close()
+        self.assertEqual(calls, [("first", "dht_22", 1),
+                                 ("second", "dht_22", 1),
+                                 ("first", "sense_hat", 2),
+                                 ("second", "sense_hat", 2)])
+        self.assertFalse(p.thread.is_alive())
+
+    def test_failing_sink_does_not_stop_the_others(self):
+        calls = []
+
+        def broken(sensor, reading):
+            raise OSError("No space left on device")
+
+        p = Pipeline()
+        p.add_sink("log", broken)
+        p.add_sink("db", lambda sensor, reading: calls.append(reading))
+        errors = pipeline.PIPELINE_SINK_ERRORS.labels("log").value
+        with self.assertLogs(level="ERROR"):
+            p.handle("dht_22", 1)
+        self.assertEqual(calls, [1])
+        self.assertEqual(
+            pipeline.PIPELINE_SINK_ERRORS.labels("log").value, errors + 1)
+
+    def test_oldest_reading_is_dropped_when_the_writer_falls_behind(self):
+        calls = []
+        p = Pipeline(maxsize=2)
+        p.add_sink("db", lambda sensor, reading: calls.append(reading))
+        dropped = pipeline.PIPELINE_DROPPED.labels().value
+        for reading in range(5):
+            p.submit("dht_22", reading)
+        self.assertEqual(pipeline.PIPELINE_DROPPED.labels().value,
+                         dropped + 3)
+        p.start()
+        p.close()
+        self.assertEqual(calls, [3, 4])
+
+    def test_close_drains_the_queue_behind_a_slow_sink(self):
+        calls = []
+        release = threading.Event()
+
+        def slow(sensor, reading):
+            release.wait(5)
+            calls.append(reading)
+
+        p = Pipeline()
+        p.add_sink("slow", slow)
+        p.start()
+        for reading in range(10):
+            p.submit("dht_22", reading)
+        release.set()
+        p.close()
+        self.assertEqual(calls, list(range(10)))
+
+    def test_close_without_start(self):
+        Pipeline().close()
+
+
+class DroppingQueueHandlerTest(unittest.TestCase):
+    def test_full_queue_drops_records(self):
+        handler = DroppingQueueHandler(queue.Queue(1))
+        logger = logging.getLogger("test_pipeline")
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        dropped = pipeline.LOG_RECORDS_DROPPED.labels().value
+        logger.warning("kept")
+        logger.warning("dropped")
+        self.assertEqual(pipeline.LOG_RECORDS_DROPPED.labels().value,
+                         dropped + 1)
+        self.assertEqual(handler.queue.get_nowait().getMessage(), "kept")
+
+
+if __name__ == "__main__":
+    unittest.main()
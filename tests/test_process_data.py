@@ -0,0 +1,242 @@
+import contextlib
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import process_data
+import temperature_db
+
+
+def log_line(when, temperature, millis=0):
+    return "{},{:03d} [DHT22] Temperature = {:0.1f} C\n".format(
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)), millis,
+        temperature)
+
+
+class ParseTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.dir, "room_weather.log")
+        self.start = int(time.mktime((2026, 10, 12, 8, 0, 0, 0, 0, -1)))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_parse_lines(self):
+        lines = [
+            log_line(self.start, 21.5, 250),
+            "2026-10-12 08:00:01,000 [DHT22] Humidity = 45.0 %\n",
+            "\x00\x00\x00" + log_line(self.start + 3600, 22.0),
+            "2026-10-12 08:00:02,000 [DHT22] Temperature = nan? C\n",
+            "garbage [DHT22] Temperature = 20.0 C\n",
+        ]
+        timestamps, values = process_data.parse_lines(lines)
+        self.assertEqual(timestamps.tolist(),
+                         [self.start + 0.25, self.start + 3600])
+        self.assertEqual(values.tolist(), [21.5, 22.0])
+
+    def test_partial_last_line_is_left_for_the_next_call(self):
+        with open(self.log_file, "w") as f:
+            f.write(log_line(self.start, 21.0) + log_line(self.start + 15, 21.5))
+            f.write(log_line(self.start + 30, 22.0)[:20])
+        timestamps, values, offset = process_data.parse_log_file(
+            self.log_file)
+        self.assertEqual(values.tolist(), [21.0, 21.5])
+        with open(self.log_file, "a") as f:
+            f.write(log_line(self.start + 30, 22.0)[20:])
+        timestamps, values, offset = process_data.parse_log_file(
+            self.log_file, offset=offset)
+        self.assertEqual(timestamps.tolist(), [self.start + 30])
+        self.assertEqual(offset, os.path.getsize(self.log_file))
+
+    def test_rotated_set_is_merged_in_time_order(self):
+        with gzip.open(self.log_file + ".2.gz", "wt") as f:
+            f.write(log_line(self.start, 20.0))
+        with open(self.log_file + ".1", "w") as f:
+            f.write(log_line(self.start + 15, 20.5))
+        with open(self.log_file, "w") as f:
+            f.write(log_line(self.start + 30, 21.0))
+        timestamps, values = process_data.load_series(
+            self.log_file, cache_dir=os.path.join(self.dir, "cache"))
+        self.assertEqual(timestamps.tolist(),
+                         [self.start, self.start + 15, self.start + 30])
+        self.assertEqual(values.tolist(), [20.0, 20.5, 21.0])
+
+
+class InlinePool(object):
+    """multiprocessing.Pool running the jobs in the calling process"""
+
+    def __init__(self, processes=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def starmap(self, func, jobs):
+        return [func(*job) for job in jobs]
+
+
+class LogCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.dir, "room_weather.log")
+        self.cache_dir = os.path.join(self.dir, "cache")
+        self.start = int(time.mktime((2026, 10, 12, 8, 0, 0, 0, 0, -1)))
+        self.parsed = []
+        parse_log_file = process_data.parse_log_file
+
+        def record(path, marker, offset):
+            self.parsed.append((os.path.basename(path), offset))
+            return parse_log_file(path, marker, offset)
+
+        for patcher in (
+                mock.patch.object(process_data, "parse_log_file", record),
+                mock.patch.object(process_data.multiprocessing, "Pool",
+                                  InlinePool)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def append(self, path, *lines):
+        with open(path, "a") as f:
+            f.write("".join(lines))
+
+    def load(self):
+        self.parsed = []
+        return process_data.load_series(self.log_file,
+                                        cache_dir=self.cache_dir)
+
+    def test_unchanged_files_are_not_parsed_again(self):
+        self.append(self.log_file, log_line(self.start, 21.0))
+        self.load()
+        self.assertEqual(self.parsed, [("room_weather.log", 0)])
+        timestamps, values = self.load()
+        self.assertEqual(self.parsed, [])
+        self.assertEqual(values.tolist(), [21.0])
+
+    def test_growing_log_is_resumed(self):
+        self.append(self.log_file, log_line(self.start, 21.0))
+        self.load()
+        size = os.path.getsize(self.log_file)
+        self.append(self.log_file, log_line(self.start + 15, 21.5))
+        timestamps, values = self.load()
+        self.assertEqual(self.parsed, [("room_weather.log", size)])
+        self.assertEqual(values.tolist(), [21.0, 21.5])
+
+    def test_rotated_log_is_parsed_again(self):
+        self.append(self.log_file, log_line(self.start, 21.0))
+        self.load()
+        os.rename(self.log_file, self.log_file + ".1")
+        self.append(self.log_file, log_line(self.start + 15, 21.5))
+        timestamps, values = self.load()
+        self.assertEqual(sorted(self.parsed), [("room_weather.log", 0),
+                                               ("room_weather.log.1", 0)])
+        self.assertEqual(values.tolist(), [21.0, 21.5])
+
+    def test_deleted_logs_are_pruned(self):
+        self.append(self.log_file + ".1", log_line(self.start, 21.0))
+        self.append(self.log_file, log_line(self.start + 15, 21.5))
+        self.load()
+        os.remove(self.log_file + ".1")
+        timestamps, values = self.load()
+        self.assertEqual(values.tolist(), [21.5])
+        cache = process_data.LogCache(self.cache_dir)
+        self.assertEqual(len(cache.index), 1)
+        self.assertEqual(len([f for f in os.listdir(self.cache_dir)
+                              if f.endswith(".npy")]), 1)
+
+
+class CommandLineTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.dir, "room_temperature.db")
+        # Rollup buckets are aligned to UTC
+        self.start = 1791792000
+        writer = temperature_db.DatabaseWriter(self.db_file)
+        for i in range(8):
+            writer.write("dht_22", self.start + 900 * i,
+                         temperature=20.0 + i, humidity=40.0)
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_main(self, *argv):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            process_data.main(["--db", self.db_file] + list(argv))
+        return out.getvalue().splitlines()
+
+    def test_series(self):
+        self.assertEqual(self.run_main("series"),
+                         ["dht_22 humidity", "dht_22 temperature"])
+
+    def test_missing_database_is_an_error(self):
+        os.remove(self.db_file)
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            self.assertRaises(SystemExit, self.run_main, "series")
+            self.assertRaises(SystemExit, self.run_main, "query")
+        self.assertIn("does not exist", err.getvalue())
+        self.assertFalse(os.path.exists(self.db_file))
+
+    def test_query_a_range(self):
+        format_time = process_data.format_time
+        lines = self.run_main(
+            "query", "--start", format_time(self.start + 900)[:16], "--end",
+            str(self.start + 2700))
+        self.assertEqual(lines, [
+            "datetime\tvalue",
+            "{}\t21.0".format(format_time(self.start + 900)),
+            "{}\t22.0".format(format_time(self.start + 1800))])
+
+    def test_query_hourly(self):
+        lines = self.run_main("query", "--resolution", "hourly")
+        self.assertEqual(lines[0], "datetime\tmin\tmean\tmax\tcount")
+        self.assertEqual(lines[1].split("\t")[1:],
+                         ["20.0", "21.5", "23.0", "4"])
+
+    def test_export_csv_and_jsonl(self):
+        output = os.path.join(self.dir, "out.csv")
+        self.run_main("export", "--output", output, "--end",
+                      str(self.start + 1))
+        with open(output) as f:
+            self.assertEqual(f.read().splitlines(), [
+                "timestamp,datetime,value",
+                "{},{},20.0".format(self.start,
+                                    process_data.format_time(self.start))])
+        output = os.path.join(self.dir, "out.jsonl")
+        self.run_main("export", "--format", "jsonl", "--output", output,
+                      "--metric", "humidity", "--resolution", "daily")
+        with open(output) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]["mean"], rows[0]["count"]), (40.0, 8))
+
+    def test_invalid_time_is_rejected(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, self.run_main, "query", "--start",
+                              "yesterday")
+
+    def test_log_file_argument_plots_the_log(self):
+        log_file = os.path.join(self.dir, "room_weather.log")
+        with open(log_file, "w") as f:
+            f.write(log_line(self.start, 21.0))
+        with mock.patch.object(process_data, "command_plot_log") as command:
+            process_data.main([log_file])
+        args = command.call_args[0][0]
+        self.assertEqual((args.log_file, args.show), (log_file, True))
+
+
+if __name__ == "__main__":
+    unittest.main()
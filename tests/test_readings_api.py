@@ -0,0 +1,131 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+from readings_api import ReadingsServer
+from temperature_db import DatabaseWriter
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ReadingsServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.dir, "room_temperature.db")
+        writer = DatabaseWriter(self.db_file)
+        for i in range(4):
+            writer.write("dht_22", 3600 + 900 * i, temperature=20.0 + i)
+        writer.close()
+        self.port = free_port()
+        self.server = ReadingsServer(
+            port=self.port, unix_path=os.path.join(self.dir, "api.sock"),
+            db_file=self.db_file, keepalive=0.05,
+            workers=lambda: {"sensors": {"up": True}})
+        self.server.publish({"dht_22": {"temperature": 21.5}})
+        self.server.start()
+
+    def tearDown(self):
+        self.server.loop.call_soon_threadsafe(self.server.loop.stop)
+        shutil.rmtree(self.dir)
+
+    def get(self, path):
+        url = "http://127.0.0.1:{}{}".format(self.port, path)
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return json.loads(response.read().decode())
+
+    def status(self, path, method="GET"):
+        request = urllib.request.Request(
+            "http://127.0.0.1:{}{}".format(self.port, path), method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_readings(self):
+        self.assertEqual(self.get("/readings"),
+                         {"dht_22": {"temperature": 21.5}})
+        self.assertEqual(self.get("/workers"), {"sensors": {"up": True}})
+
+    def test_history(self):
+        self.assertEqual(self.get("/history?start=0&end=5400"),
+                         [[3600, 20.0], [4500, 21.0]])
+        self.assertEqual(
+            self.get("/history?start=0&end=9000&resolution=hourly"),
+            [[3600, 20.0, 21.5, 23.0, 4]])
+        self.assertEqual(self.get("/history?sensor=nope&start=0"), [])
+
+    def test_errors(self):
+        self.assertEqual(self.status("/history?start=yesterday"), 400)
+        self.assertEqual(self.status("/history?resolution=weekly"), 400)
+        self.assertEqual(self.status("/nope"), 404)
+        self.assertEqual(self.status("/readings", "POST"), 405)
+
+    def test_missing_database_is_an_error(self):
+        os.remove(self.db_file)
+        self.assertEqual(self.status("/history"), 503)
+        self.assertFalse(os.path.exists(self.db_file))
+
+    def test_metrics(self):
+        url = "http://127.0.0.1:{}/metrics".format(self.port)
+        with urllib.request.urlopen(url, timeout=5) as response:
+            self.assertTrue(response.headers["Content-Type"].startswith(
+                "text/plain"))
+            response.read()
+
+    def test_unix_socket(self):
+        with socket.socket(socket.AF_UNIX) as s:
+            s.settimeout(5)
+            s.connect(os.path.join(self.dir, "api.sock"))
+            s.sendall(b"GET /readings HTTP/1.1\r\n\r\n")
+            response = b""
+            while True:
+                data = s.recv(4096)
+                if not data:
+                    break
+                response += data
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+        self.assertEqual(json.loads(response.split(b"\r\n\r\n", 1)[1]),
+                         {"dht_22": {"temperature": 21.5}})
+
+    def test_events_push_every_snapshot(self):
+        with socket.create_connection(("127.0.0.1", self.port), 5) as s:
+            s.sendall(b"GET /events HTTP/1.1\r\n\r\n")
+            stream = s.makefile("rb")
+            self.assertEqual(stream.readline(), b"HTTP/1.1 200 OK\r\n")
+            while stream.readline() != b"\r\n":
+                pass
+            self.assertEqual(stream.readline(),
+                             b'data: {"dht_22": {"temperature": 21.5}}\n')
+            stream.readline()
+            self.server.publish({"dht_22": {"temperature": 22.0}})
+            line = stream.readline()
+            while line in (b": keepalive\n", b"\n"):
+                line = stream.readline()
+            self.assertEqual(line,
+                             b'data: {"dht_22": {"temperature": 22.0}}\n')
+            stream.close()
+        # The next keepalive notices the closed connection
+        deadline = time.monotonic() + 5
+        while self.server.subscribers and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.subscribers, set())
+
+    def test_start_fails_when_the_port_is_taken(self):
+        server = ReadingsServer(port=self.port, db_file=self.db_file)
+        self.assertRaises(OSError, server.start)
+        self.assertIsNone(server.loop)
+
+
+if __name__ == "__main__":
+    unittest.main()
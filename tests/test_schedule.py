@@ -0,0 +1,66 @@
+import datetime as dt
+import unittest
+
+from schedule import WeeklySchedule
+
+# A Monday
+MONDAY = dt.datetime(2026, 10, 12)
+
+
+def week(**periods):
+    """Days for WeeklySchedule, e.g. week(mon=[("06:00:00", "08:00:00")])"""
+    names = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+    return [[{"start": start, "end": end}
+             for start, end in periods.get(name, [])] for name in names]
+
+
+def at(days, time):
+    hours, minutes = (int(x) for x in time.split(":"))
+    return MONDAY + dt.timedelta(days=days, hours=hours, minutes=minutes)
+
+
+class WeeklyScheduleTest(unittest.TestCase):
+    def test_slot_within_a_day(self):
+        schedule = WeeklySchedule(week(mon=[("06:00:00", "08:00:00")]))
+        self.assertEqual(schedule.current_slot(at(0, "07:00")),
+                         {"start": at(0, "06:00"), "end": at(0, "08:00")})
+        self.assertIsNone(schedule.current_slot(at(0, "08:00")))
+        self.assertEqual(schedule.next_transition(at(0, "05:00")),
+                         at(0, "06:00"))
+        self.assertEqual(schedule.next_transition(at(0, "07:00")),
+                         at(0, "08:00"))
+
+    def test_slot_past_midnight(self):
+        schedule = WeeklySchedule(week(mon=[("22:00:00", "02:00:00")]))
+        self.assertEqual(schedule.current_slot(at(1, "01:00")),
+                         {"start": at(0, "22:00"), "end": at(1, "02:00")})
+
+    def test_touching_slots_are_merged_across_days(self):
+        schedule = WeeklySchedule(week(mon=[("20:00:00", "23:59:59")],
+                                       tue=[("00:00:00", "06:00:00")]))
+        self.assertEqual(schedule.current_slot(at(0, "23:00")),
+                         {"start": at(0, "20:00"), "end": at(1, "06:00")})
+
+    def test_slot_wrapping_around_the_week(self):
+        schedule = WeeklySchedule(week(sun=[("22:00:00", "02:00:00")],
+                                       mon=[("02:00:00", "06:00:00")],
+                                       wed=[("10:00:00", "12:00:00")]))
+        slot = {"start": at(-1, "22:00"), "end": at(0, "06:00")}
+        self.assertEqual(schedule.current_slot(at(0, "01:00")), slot)
+        self.assertEqual(schedule.current_slot(at(0, "05:00")), slot)
+        self.assertEqual(schedule.current_slot(at(6, "23:00")),
+                         {"start": at(6, "22:00"), "end": at(7, "06:00")})
+        # The continuation at the start of the week is not a new start
+        self.assertEqual(schedule.next_start(at(2, "13:00")), at(6, "22:00"))
+        self.assertEqual(schedule.next_start(at(0, "07:00")), at(2, "10:00"))
+
+    def test_empty_and_unused_periods(self):
+        schedule = WeeklySchedule(week(mon=[(None, None),
+                                            ("06:00:00", "06:00:00")]))
+        self.assertFalse(schedule)
+        self.assertIsNone(schedule.current_slot(at(0, "06:00")))
+        self.assertIsNone(schedule.next_transition(at(0, "05:00")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from drivers import FakeMatrix
+from sense_hat_display_number import NumberDisplay
+
+
+class NumberDisplayTest(unittest.TestCase):
+    def setUp(self):
+        self.matrix = FakeMatrix()
+        self.display = NumberDisplay(sense=self.matrix)
+
+    def test_first_update_writes_the_whole_frame(self):
+        self.display.show_number(42, 200, 0, 60)
+        self.assertEqual(self.matrix.writes, 1)
+        pixels = self.matrix.get_pixels()
+        # Top row of the "4" and of the "2"
+        self.assertEqual(pixels[3 * 8:3 * 8 + 7], [
+            [200, 0, 60], [0, 0, 0], [0, 0, 0], [0, 0, 0],
+            [200, 0, 60], [200, 0, 60], [200, 0, 60]])
+
+    def test_unchanged_frame_is_not_written(self):
+        self.display.show_number(42, 200, 0, 60)
+        self.display.show_number(42, 200, 0, 60)
+        self.assertEqual(self.matrix.writes, 1)
+
+    def test_single_pixel_change_uses_set_pixel(self):
+        self.display.update()
+        self.display.fill_rect(2, 1, 1, 1, 255, 255, 255)
+        self.matrix.set_pixels = None  # Must not be called
+        self.display.update()
+        self.assertEqual(self.matrix.writes, 2)
+        self.assertEqual(self.matrix.get_pixels()[1 * 8 + 2], [255, 255, 255])
+
+    def test_larger_change_is_written_at_once(self):
+        self.display.show_number(41, 200, 0, 60)
+        self.display.show_number(42, 200, 0, 60)
+        self.assertEqual(self.matrix.writes, 2)
+        expected = NumberDisplay(sense=FakeMatrix())
+        expected.show_number(42, 200, 0, 60)
+        self.assertEqual(self.matrix.get_pixels(),
+                         expected.sense.get_pixels())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import sensor_feed
+from sensor_feed import SENSOR_HEADER, SensorFeedReader, SensorFeedWriter
+
+
+class SensorFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "feed")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_publish_and_read(self):
+        writer = SensorFeedWriter(self.path, capacity=4)
+        writer.publish("dht_22", 21.5, 45.0, timestamp=100)
+        writer.publish("sense_hat", 25.0, 40.0, 1013.0, timestamp=101)
+        reader = SensorFeedReader(self.path)
+        self.assertEqual(reader.sensors, ["dht_22", "sense_hat"])
+        self.assertEqual(reader.latest("dht_22"),
+                         sensor_feed.Sample(100, 21.5, 45.0, None))
+        self.assertEqual(reader.latest("sense_hat").pressure, 1013.0)
+
+    def test_ring_keeps_the_newest_samples(self):
+        writer = SensorFeedWriter(self.path, capacity=4)
+        for i in range(10):
+            writer.publish("dht_22", 20 + i, 45.0, timestamp=i)
+        reader = SensorFeedReader(self.path)
+        self.assertEqual([s.timestamp for s in reader.history("dht_22")],
+                         [6, 7, 8, 9])
+        sequence, samples = reader.read("dht_22", 2)
+        self.assertEqual(sequence, 20)
+        self.assertEqual([s.timestamp for s in samples], [9, 8])
+
+    def test_reader_waits_for_a_write_in_progress(self):
+        writer = SensorFeedWriter(self.path, capacity=4)
+        writer.publish("dht_22", 21.0, 45.0, timestamp=1)
+        offset = writer.offsets["dht_22"]
+        name, sequence, count = SENSOR_HEADER.unpack_from(writer.mm, offset)
+        # Leave the sequence odd, like a writer stopped halfway
+        SENSOR_HEADER.pack_into(writer.mm, offset, name, sequence + 1, count)
+
+        def finish():
+            time.sleep(0.05)
+            SENSOR_HEADER.pack_into(writer.mm, offset, name, sequence + 2,
+                                    count)
+
+        thread = threading.Thread(target=finish)
+        thread.start()
+        reader = SensorFeedReader(self.path)
+        self.assertEqual(reader.read("dht_22", 1)[0], sequence + 2)
+        thread.join()
+
+    def test_restarted_writer_closes_an_unfinished_update(self):
+        writer = SensorFeedWriter(self.path, capacity=4)
+        writer.publish("dht_22", 21.0, 45.0, timestamp=1)
+        offset = writer.offsets["dht_22"]
+        name, sequence, count = SENSOR_HEADER.unpack_from(writer.mm, offset)
+        # Killed between the two header writes of publish()
+        SENSOR_HEADER.pack_into(writer.mm, offset, name, sequence + 1, count)
+        writer.close()
+
+        writer = SensorFeedWriter(self.path, capacity=4)
+        writer.publish("dht_22", 22.0, 45.0, timestamp=2)
+        reader = SensorFeedReader(self.path, timeout=0.1)
+        sequence, samples = reader.read("dht_22", 4)
+        self.assertEqual(sequence % 2, 0)
+        self.assertEqual([s.temperature for s in samples], [22.0, 21.0])
+
+    def test_read_gives_up_on_a_stuck_update(self):
+        writer = SensorFeedWriter(self.path, capacity=4)
+        offset = writer.offsets["dht_22"]
+        name, sequence, count = SENSOR_HEADER.unpack_from(writer.mm, offset)
+        SENSOR_HEADER.pack_into(writer.mm, offset, name, sequence + 1, count)
+        reader = SensorFeedReader(self.path, timeout=0.05)
+        started = time.monotonic()
+        self.assertRaises(RuntimeError, reader.latest, "dht_22")
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_writer_reuses_a_compatible_feed(self):
+        SensorFeedWriter(self.path).publish("dht_22", 21.0, 45.0)
+        reader = SensorFeedReader(self.path)
+        SensorFeedWriter(self.path)
+        self.assertFalse(reader.replaced())
+        self.assertEqual(reader.latest("dht_22").temperature, 21.0)
+
+    def test_writer_replaces_an_incompatible_feed(self):
+        SensorFeedWriter(self.path, capacity=4)
+        reader = SensorFeedReader(self.path)
+        SensorFeedWriter(self.path, capacity=8)
+        self.assertTrue(reader.replaced())
+        self.assertEqual(SensorFeedReader(self.path).capacity, 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
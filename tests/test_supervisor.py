@@ -0,0 +1,76 @@
+import threading
+import unittest
+from unittest import mock
+
+from supervisor import Supervisor
+
+
+class SupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.supervisor = Supervisor(backoff=0.01, max_backoff=0.04,
+                                     max_failures=2)
+
+    def run_supervisor(self):
+        """Runs the supervisor in a thread and returns its result"""
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(self.supervisor.run()), daemon=True)
+        with self.assertLogs() as logs:
+            thread.start()
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+        return result[0], logs.output
+
+    def test_crashed_worker_is_restarted_until_it_gives_up(self):
+        runs = []
+
+        def crash():
+            runs.append(1)
+            raise RuntimeError("Sensor unplugged")
+
+        self.supervisor.add("sensor", crash)
+        name, logs = self.run_supervisor()
+        self.assertEqual(name, "sensor")
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(self.supervisor.workers["sensor"].restarts, 2)
+        self.assertEqual(len([line for line in logs
+                              if "Worker sensor crashed" in line]), 3)
+
+    def test_returning_worker_counts_as_a_failure(self):
+        self.supervisor.add("display", lambda: None)
+        name, logs = self.run_supervisor()
+        self.assertEqual(name, "display")
+        self.assertEqual(len([line for line in logs
+                              if "Worker display returned" in line]), 3)
+
+    def test_only_the_dead_worker_is_restarted(self):
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+        self.supervisor.add("feed", stop.wait)
+        self.supervisor.add("sensor", mock.Mock(side_effect=RuntimeError))
+        name, _ = self.run_supervisor()
+        self.assertEqual(name, "sensor")
+        status = self.supervisor.status()
+        self.assertEqual(status["feed"]["restarts"], 0)
+        self.assertTrue(status["feed"]["alive"])
+        self.assertGreater(status["feed"]["uptime"], 0)
+        self.assertEqual(status["sensor"]["restarts"], 2)
+        self.assertFalse(status["sensor"]["alive"])
+        self.assertEqual(status["sensor"]["uptime"], 0)
+
+    def test_backoff_doubles_and_resets_after_a_long_run(self):
+        self.supervisor.add("sensor", None)
+        worker = self.supervisor.workers["sensor"]
+        self.supervisor.reset_after = 300
+        with mock.patch("supervisor.time.monotonic", return_value=1000):
+            worker.started = 990
+            delays = [self.supervisor.delay(worker) for _ in range(4)]
+            self.assertEqual(delays, [0.01, 0.02, 0.04, 0.04])
+            # The worker ran for longer than reset_after
+            worker.started = 600
+            self.assertEqual(self.supervisor.delay(worker), 0.01)
+            self.assertEqual(worker.failures, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
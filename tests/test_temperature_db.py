@@ -0,0 +1,174 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import temperature_db
+from temperature_db import Compactor, DatabaseWriter
+
+
+class TemperatureDbTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.dir, "room_temperature.db")
+        self.writer = DatabaseWriter(self.db_file, batch_size=1000,
+                                     flush_interval=3600)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.dir)
+
+    def rows(self, query):
+        conn = temperature_db.connect(self.db_file)
+        try:
+            return conn.execute(query).fetchall()
+        finally:
+            conn.close()
+
+    def test_samples_are_read_back(self):
+        for i, temperature in enumerate((20.0, 21.0, 23.0)):
+            self.writer.write("dht_22", 3600 + 30 * i,
+                              temperature=temperature, humidity=None)
+        self.writer.flush()
+        self.assertEqual(
+            list(temperature_db.read_samples("dht_22", "temperature",
+                                             db_file=self.db_file)),
+            [(3600, 20.0), (3630, 21.0), (3660, 23.0)])
+        self.assertEqual(list(temperature_db.read_samples(
+            "dht_22", "humidity", db_file=self.db_file)), [])
+
+    def test_close_flushes_the_buffer(self):
+        self.writer.write("dht_22", 3600, temperature=20.0)
+        self.assertEqual(self.rows("SELECT count(*) FROM samples"), [(0,)])
+        self.writer.close()
+        self.assertEqual(self.rows("SELECT count(*) FROM samples"), [(1,)])
+        self.assertRaises(RuntimeError, self.writer.write, "dht_22",
+                          temperature=20.0)
+
+    def test_sensors_have_their_own_series(self):
+        self.writer.write("dht_22", 3600, temperature=20.0, humidity=40.0)
+        self.writer.write("sense_hat", 3600, temperature=25.0, humidity=35.0,
+                          pressure=1013.25)
+        self.writer.flush()
+        self.assertEqual(
+            list(temperature_db.read_samples("sense_hat", "pressure",
+                                             db_file=self.db_file)),
+            [(3600, 1013.25)])
+        self.assertEqual(
+            list(temperature_db.read_samples("dht_22", "temperature",
+                                             db_file=self.db_file)),
+            [(3600, 20.0)])
+        self.assertEqual(self.rows("SELECT count(*) FROM series"), [(5,)])
+
+    def test_aggregates_are_read_back(self):
+        for i, temperature in enumerate((20.0, 21.0, 23.0)):
+            self.writer.write("dht_22", 3600 + 30 * i,
+                              temperature=temperature)
+        self.writer.flush()
+        self.assertEqual(
+            list(temperature_db.read_aggregates(
+                "dht_22", "temperature", 3600, db_file=self.db_file)),
+            [(3600, 20.0, 64.0 / 3, 23.0, 3)])
+
+    def test_duplicate_timestamps_are_counted_once(self):
+        # Within one batch and across batches, e.g. a replay of the same log
+        self.writer.write("dht_22", 3600, temperature=20.0)
+        self.writer.write("dht_22", 3600, temperature=21.0)
+        self.writer.flush()
+        self.writer.write("dht_22", 3600, temperature=22.0)
+        self.writer.flush()
+        self.assertEqual(self.rows("SELECT ts, value FROM samples"),
+                         [(3600, 20.0)])
+        self.assertEqual(
+            self.rows("SELECT min, max, sum, count FROM samples_hourly"),
+            [(20.0, 20.0, 20.0, 1)])
+
+    def test_rollups_match_a_rebuild(self):
+        for ts in range(0, 2 * 86400, 997):
+            self.writer.write("dht_22", ts, temperature=ts % 7,
+                              humidity=40 + ts % 3)
+            if ts % 10 == 0:
+                self.writer.flush()
+        self.writer.flush()
+        queries = ["SELECT * FROM {} ORDER BY series_id, ts".format(t)
+                   for t in sorted(temperature_db.ROLLUPS)]
+        incremental = [self.rows(query) for query in queries]
+        conn = temperature_db.connect(self.db_file)
+        temperature_db.rebuild_rollups(conn)
+        conn.close()
+        self.assertEqual([self.rows(query) for query in queries], incremental)
+
+    def test_compactor_deletes_rows_past_their_retention(self):
+        now = int(time.time())
+        old = now - temperature_db.RETENTION["samples"] - 3600
+        self.writer.write("dht_22", old, temperature=19.0)
+        self.writer.write("dht_22", now, temperature=21.0)
+        self.writer.flush()
+        compactor = Compactor(self.db_file, batch_size=1, pause=0)
+        self.assertEqual(compactor.compact(), 1)
+        self.assertEqual(self.rows("SELECT ts FROM samples"), [(now,)])
+        # The rollups keep the old sample
+        self.assertEqual(len(self.rows("SELECT * FROM samples_hourly")), 2)
+        self.assertEqual(self.rows("PRAGMA auto_vacuum"), [(2,)])
+
+    def test_reading_a_missing_database_does_not_create_it(self):
+        db_file = os.path.join(self.dir, "nope.db")
+        self.assertRaises(FileNotFoundError, list, temperature_db.read_samples(
+            "dht_22", "temperature", db_file=db_file))
+        self.assertRaises(FileNotFoundError, list,
+                          temperature_db.read_aggregates(
+                              "dht_22", "temperature", 60, db_file=db_file))
+        self.assertFalse(os.path.exists(db_file))
+
+
+class LegacyMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.dir, "room_temperature.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_legacy_table_is_moved_into_samples(self):
+        # The layout written by the old write_to_db()
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("""CREATE TABLE dht_22
+            (datetime text, temperature real, humidity real)""")
+        conn.execute("INSERT INTO dht_22 VALUES "
+                     "('2026-10-12 08:00:00', '21.50', '45.00')")
+        conn.commit()
+        conn.close()
+
+        DatabaseWriter(self.db_file).close()
+        epoch = int(time.mktime(time.strptime("2026-10-12 08:00:00",
+                                              "%Y-%m-%d %H:%M:%S")))
+        self.assertEqual(
+            list(temperature_db.read_samples("dht_22", "temperature",
+                                             db_file=self.db_file)),
+            [(epoch, 21.5)])
+        self.assertEqual(
+            list(temperature_db.read_samples("dht_22", "humidity",
+                                             db_file=self.db_file)),
+            [(epoch, 45.0)])
+        conn = temperature_db.connect(self.db_file)
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")]
+        conn.close()
+        self.assertNotIn("dht_22", tables)
+
+class PickResolutionTest(unittest.TestCase):
+    def test_coarsest_needed_table(self):
+        now = 100 * 86400
+        pick = temperature_db.pick_resolution
+        self.assertEqual(pick(now - 3600, now, 500, now=now), 0)
+        self.assertEqual(pick(now - 86400, now, 500, now=now), 3600)
+        self.assertEqual(pick(now - 86400, now, 5000, now=now), 60)
+        # Raw samples are gone after 30 days
+        self.assertEqual(pick(now - 40 * 86400, now - 40 * 86400 + 3600, 500,
+                              now=now), 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
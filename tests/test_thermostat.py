@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from thermostat import ConfigSync, FakeThermostat, ThermostatSession
+
+
+class FlakyThermostat(FakeThermostat):
+    """Fails the first `failures` connection attempts"""
+
+    def __init__(self, failures):
+        super(FlakyThermostat, self).__init__()
+        self.failures = failures
+
+    def connect(self):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("Connection failed")
+        super(FlakyThermostat, self).connect()
+
+
+class ThermostatSessionTest(unittest.TestCase):
+    def test_nested_operations_share_one_connection(self):
+        device = FakeThermostat()
+        session = ThermostatSession(device, retry_delay=0)
+        with session:
+            session.get_temperatures()
+            with session:
+                session.get_battery()
+            self.assertTrue(device.connected)
+        self.assertFalse(device.connected)
+        self.assertEqual(device.connections, 1)
+
+    def test_operation_outside_a_session_disconnects(self):
+        device = FakeThermostat()
+        ThermostatSession(device, retry_delay=0).get_battery()
+        self.assertFalse(device.connected)
+
+    def test_failed_operations_are_retried(self):
+        device = FlakyThermostat(failures=2)
+        session = ThermostatSession(device, retries=2, retry_delay=0)
+        self.assertEqual(session.get_battery(), 80)
+        device = FlakyThermostat(failures=3)
+        session = ThermostatSession(device, retries=2, retry_delay=0)
+        self.assertRaises(RuntimeError, session.get_battery)
+
+    def test_apply_temperatures_only_writes_changes(self):
+        device = FakeThermostat()
+        session = ThermostatSession(device, retry_delay=0)
+        with session:
+            session.apply_temperatures({"offset_temp": 1.0,
+                                        "manual_temp": 21.0})
+            self.assertEqual(device.operations, 2)  # read, write
+            session.apply_temperatures({"offset_temp": 1.0})
+            self.assertEqual(device.operations, 2)
+        self.assertEqual(device.temperatures["offset_temp"], 1.0)
+
+    def test_apply_temperatures_verifies_the_write(self):
+        class Stubborn(FakeThermostat):
+            def set_temperatures(self, temps):
+                self.operation()
+                return dict(self.temperatures)
+
+        session = ThermostatSession(Stubborn(), retry_delay=0)
+        self.assertRaises(RuntimeError, session.apply_temperatures,
+                          {"offset_temp": 2.0})
+
+
+class ConfigSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.dir, "config.json")
+        self.config = {
+            "days": [[{"start": "06:00:00", "end": "08:00:00"}] +
+                     [{"start": None, "end": None}] * 3 for _ in range(7)],
+            "lcd_timer": {"preload": 30, "current": 12},
+            "temperatures": {"target_temp_l": 17.0, "temp_offset": None},
+        }
+        self.write_config()
+        self.device = FakeThermostat()
+        self.sync = ConfigSync(ThermostatSession(self.device, retry_delay=0),
+                               self.config_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_config(self):
+        with open(self.config_file, "w") as f:
+            json.dump(self.config, f)
+        # Make every write visible through the mtime
+        stat = os.stat(self.config_file)
+        os.utime(self.config_file, ns=(stat.st_atime_ns,
+                                       stat.st_mtime_ns + 10 ** 9))
+
+    def test_pushes_only_differing_sections(self):
+        self.sync.sync()
+        self.assertEqual(self.device.days[0][0],
+                         {"start": "06:00:00", "end": "08:00:00"})
+        self.assertEqual(self.device.temperatures["target_temp_l"], 17.0)
+        self.assertEqual(self.device.connections, 1)
+
+        operations = self.device.operations
+        self.sync.sync()
+        # Nothing changed: no reads or writes
+        self.assertEqual(self.device.operations, operations)
+
+    def test_changed_section_is_pushed_alone(self):
+        self.sync.sync()
+        self.config["days"][2][0] = {"start": "07:00:00", "end": "09:00:00"}
+        self.write_config()
+        pushed = []
+        restore = self.device.restore
+        self.device.restore = lambda data: pushed.append(sorted(data)) or \
+            restore(data)
+        self.sync.sync()
+        self.assertEqual(pushed, [["days"]])
+        self.assertEqual(self.sync.days()[2][0],
+                         {"start": "07:00:00", "end": "09:00:00"})
+
+    def test_times_are_compared_at_device_resolution(self):
+        self.config["days"][0][0] = {"start": "06:04:00", "end": "08:00:00"}
+        self.write_config()
+        self.sync.sync()
+        # The device stores 06:00:00, which matches the file after rounding
+        self.device.days[0][0] = {"start": "06:00:00", "end": "08:00:00"}
+        self.sync.device_hashes = {}
+        operations = self.device.operations
+        self.sync.sync()
+        self.assertEqual(self.device.operations - operations, 3)  # reads
+
+
+if __name__ == "__main__":
+    unittest.main()
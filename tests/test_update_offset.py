@@ -0,0 +1,174 @@
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from sensor_feed import SensorFeedWriter
+from thermostat import FakeThermostat
+
+
+def import_update_offset():
+    """Imports update_offset with the settings of configuration.py.template"""
+    configuration = types.ModuleType("configuration")
+    configuration.SLEEP_MINUTES = 10
+    with mock.patch.dict(sys.modules, {"configuration": configuration}):
+        sys.modules.pop("update_offset", None)
+        module = importlib.import_module("update_offset")
+    return module
+
+
+update_offset = import_update_offset()
+
+
+class OutOfRange(FakeThermostat):
+    def connect(self):
+        raise RuntimeError("Device not found")
+
+
+class UpdateOffsetTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.feed_file = os.path.join(self.dir, "feed")
+        self.feed = SensorFeedWriter(self.feed_file, capacity=8)
+        self.config_file = os.path.join(self.dir, "config.json")
+        with open(self.config_file, "w") as f:
+            json.dump({
+                # Heating all week long
+                "days": [[{"start": "00:00:00", "end": "12:00:00"},
+                          {"start": "12:00:00", "end": "00:00:00"}] +
+                         [{"start": None, "end": None}] * 2
+                         for _ in range(7)],
+                "temperatures": {"target_temp_l": 17.0},
+            }, f)
+        self.device = {"name": "living-room", "address": None, "pin": 0,
+                       "adapter": "hci-test", "backend": "fake",
+                       "config": self.config_file, "feed": self.feed_file,
+                       "sensor": "dht_22"}
+        self.slot = {"start": "00:00:00", "end": "12:00:00"}
+
+    def tearDown(self):
+        self.feed.close()
+        shutil.rmtree(self.dir)
+
+    def controller(self, backend=None):
+        controller = update_offset.ThermostatController(self.device)
+        controller.session.retry_delay = 0
+        if backend is not None:
+            controller.session.backend = backend
+        return controller
+
+    def test_correct_offset(self):
+        self.feed.publish("dht_22", 21.0, 45.0)
+        session = self.controller().session
+        sensor = update_offset.SensorSource(self.feed_file)
+        self.assertEqual(update_offset.correct_offset(
+            session, self.slot, sensor), 21.0)
+        # The thermostat reads 19 degrees
+        self.assertEqual(session.backend.temperatures["offset_temp"], 2)
+
+    def test_stale_reading_skips_the_correction(self):
+        self.feed.publish("dht_22", 21.0, 45.0,
+                          timestamp=time.time() - 2 * 3600)
+        controller = self.controller()
+        sensor = update_offset.SensorSource(self.feed_file)
+        with self.assertLogs("root", "WARNING"):
+            self.assertIsNone(update_offset.correct_offset(
+                controller.session, self.slot, sensor))
+        self.assertEqual(controller.session.backend.connections, 0)
+
+    def test_missing_feed_skips_the_correction(self):
+        controller = self.controller()
+        sensor = update_offset.SensorSource(os.path.join(self.dir, "nope"))
+        with self.assertLogs("root", "WARNING"):
+            self.assertIsNone(update_offset.correct_offset(
+                controller.session, self.slot, sensor))
+
+    def test_wake_up_keeps_the_last_corrected_temperature(self):
+        self.feed.publish("dht_22", 21.0, 45.0)
+        controller = self.controller()
+        controller.wake_up(["startup"])
+        self.assertEqual(controller.corrected_temp, 21.0)
+        self.assertFalse(controller.needs_setup)
+        self.assertIsNotNone(controller.current_timeslot)
+        # room_thermometer stopped
+        controller.sensor = update_offset.SensorSource(
+            os.path.join(self.dir, "nope"))
+        with self.assertLogs("root", "WARNING"):
+            controller.wake_up(["correction"])
+        self.assertEqual(controller.corrected_temp, 21.0)
+
+    def test_failed_wake_up_is_retried(self):
+        self.feed.publish("dht_22", 21.0, 45.0)
+        controller = self.controller(OutOfRange())
+        controller.scheduler.poll_interval = 0.01
+        wake_ups = []
+        wake_up = controller.wake_up
+
+        def record(reasons):
+            wake_ups.append(list(reasons))
+            if len(wake_ups) == 3:
+                # The device is back in range
+                controller.session.backend = FakeThermostat()
+            try:
+                return wake_up(reasons)
+            finally:
+                if len(wake_ups) == 3:
+                    controller.stop()
+
+        controller.wake_up = record
+        self.addCleanup(controller.stop)
+        thread = threading.Thread(target=controller.run, daemon=True)
+        with mock.patch.object(update_offset, "RETRY_DELAY", 0.01), \
+                self.assertLogs("root") as logs:
+            thread.start()
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(wake_ups, [["startup"], ["retry"], ["retry"]])
+        self.assertEqual(len([line for line in logs.output
+                              if "failed, retrying" in line]), 2)
+        self.assertEqual(controller.failures, 0)
+        self.assertFalse(controller.needs_setup)
+        self.assertEqual(controller.corrected_temp, 21.0)
+
+    def test_sensor_moves_only_past_the_deadband(self):
+        controller = self.controller()
+        controller.corrected_temp = 20.5
+        self.feed.publish("dht_22", 20.5, 45.0)
+        self.assertEqual(controller.sensor_moves(), 0)
+        self.feed.publish("dht_22", 20.4, 45.0)
+        self.feed.publish("dht_22", 20.6, 45.0)
+        self.assertEqual(controller.sensor_moves(), 0)
+        for _ in range(5):
+            self.feed.publish("dht_22", 22.0, 45.0)
+        self.assertEqual(controller.sensor_moves(), 1)
+        self.assertGreater(controller.corrected_temp,
+                           20.5 + controller.deadband)
+
+    def test_stale_sensor_does_not_fail_the_watch(self):
+        self.feed.publish("dht_22", 21.0, 45.0,
+                          timestamp=time.time() - 2 * 3600)
+        controller = self.controller()
+        with mock.patch.object(controller.scheduler.logger,
+                               "warning") as warning:
+            controller.scheduler.watch("sensor", controller.sensor_moves)
+        self.assertIsNone(controller.scheduler.watches["sensor"][1])
+        warning.assert_not_called()
+
+    def test_retry_delay_doubles_up_to_the_correction_interval(self):
+        controller = self.controller()
+        delays = []
+        for failures in range(1, 8):
+            controller.failures = failures
+            delays.append(controller.retry_delay())
+        self.assertEqual(delays, [30, 60, 120, 240, 480, 600, 600])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+import copy
+import datetime as dt
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+import metrics
+
+THERMOSTAT_CALL_SECONDS = metrics.histogram(
+    "thermostat_call_seconds", "Duration of thermostat operations, "
+    "including connecting and retries", ["method"])
+THERMOSTAT_RETRIES = metrics.counter(
+    "thermostat_retries_total", "Failed thermostat operation attempts",
+    ["method"])
+THERMOSTAT_CONNECTIONS = metrics.counter(
+    "thermostat_connections_total", "Connections made to the thermostat")
+THERMOSTAT_RADIO_WAIT_SECONDS = metrics.histogram(
+    "thermostat_radio_wait_seconds",
+    "Time waited for a free connection slot on the Bluetooth adapter",
+    ["adapter"])
+COMETBLUE_COMMAND_SECONDS = metrics.histogram(
+    "cometblue_command_seconds", "Duration of cometblue processes",
+    ["command"])
+
+# Values are exchanged in the same JSON friendly form as printed by
+# "cometblue -f json": times of day as "HH:MM:SS" strings and holiday
+# dates as "YYYY-mm-ddTHH:MM:SS" strings, so that config.json can be used
+# as it is with every backend.
+TIME_FORMAT = "%H:%M:%S"
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Options of "cometblue ... set temperatures" per temperatures field
+TEMPERATURE_OPTIONS = {
+    "manual_temp": "--temp-manual",
+    "target_temp_l": "--temp-target-low",
+    "target_temp_h": "--temp-target-high",
+    "offset_temp": "--temp-offset",
+    "window_open_detection": "--window-open-detect",
+    "window_open_minutes": "--window-open-minutes",
+}
+
+
+# One connection slot semaphore per Bluetooth adapter, shared by all sessions
+ADAPTER_LIMITERS = {}
+ADAPTER_LIMITERS_LOCK = threading.Lock()
+
+
+class AdapterLimiter(object):
+    """Bounds the number of simultaneous connections over one adapter"""
+
+    def __init__(self, adapter, limit):
+        self.adapter = adapter
+        self.semaphore = threading.BoundedSemaphore(limit)
+
+    def acquire(self):
+        with THERMOSTAT_RADIO_WAIT_SECONDS.labels(self.adapter).time():
+            self.semaphore.acquire()
+
+    def release(self):
+        self.semaphore.release()
+
+
+def adapter_limiter(adapter, limit):
+    """Returns the limiter of `adapter`, the first call sets its limit"""
+    with ADAPTER_LIMITERS_LOCK:
+        limiter = ADAPTER_LIMITERS.get(adapter)
+        if limiter is None:
+            limiter = ADAPTER_LIMITERS[adapter] = AdapterLimiter(adapter, limit)
+        return limiter
+
+
+class ThermostatBackend(object):
+    """Interface to one CometBlue thermostat
+
+    connect() and disconnect() bracket a session; everything in between
+    should reuse the same connection where the backend supports it.
+    """
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def get_battery(self):
+        raise NotImplementedError
+
+    def set_datetime(self, value):
+        raise NotImplementedError
+
+    def get_days(self):
+        raise NotImplementedError
+
+    def get_holidays(self):
+        raise NotImplementedError
+
+    def get_temperatures(self):
+        raise NotImplementedError
+
+    def set_temperatures(self, temps):
+        """Writes the given temperature fields, leaving the others unchanged
+
+        Returns all temperatures as read back after the write.
+        """
+        raise NotImplementedError
+
+    def get_lcd_timer(self):
+        raise NotImplementedError
+
+    def restore(self, data):
+        """Writes a backup in the config.json format to the thermostat"""
+        raise NotImplementedError
+
+
+class CommandLineBackend(ThermostatBackend):
+    """Runs the cometblue command line tool, one connection per operation"""
+
+    def __init__(self, address, pin, executable="cometblue"):
+        self.base_command = [executable, "device", "-p", str(pin), address]
+        self.logger = logging.getLogger("root")
+
+    def run_command(self, args, json_output=False):
+        command = list(self.base_command)
+        if json_output:
+            command[1:1] = ["-f", "json"]
+        command += args
+        self.logger.debug("Running command: '{}'".format(" ".join(command)))
+        with COMETBLUE_COMMAND_SECONDS.labels(" ".join(args[:2])).time():
+            result = subprocess.run(command, stdout=subprocess.PIPE)
+        if result.returncode != 0:
+            error_message = "Command '{}' failed!".format(" ".join(command))
+            self.logger.error(error_message)
+            raise RuntimeError(error_message)
+        if json_output:
+            return json.loads(result.stdout.decode("utf-8"))
+        return result.stdout
+
+    def get_battery(self):
+        return self.run_command(["get", "battery"], json_output=True)
+
+    def set_datetime(self, value):
+        self.run_command(
+            ["set", "datetime", value.strftime("%Y-%m-%d %H:%M:%S")])
+
+    def get_days(self):
+        return self.run_command(["get", "days"], json_output=True)
+
+    def get_holidays(self):
+        return self.run_command(["get", "holidays"], json_output=True)
+
+    def get_temperatures(self):
+        return self.run_command(["get", "temperatures"], json_output=True)
+
+    def set_temperatures(self, temps):
+        args = ["set", "temperatures"]
+        for field, value in sorted(temps.items()):
+            args += [TEMPERATURE_OPTIONS[field], str(value)]
+        self.run_command(args)
+        return self.get_temperatures()
+
+    def get_lcd_timer(self):
+        return self.run_command(["get", "lcd_timer"], json_output=True)
+
+    def restore(self, data):
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+            json.dump(data, f)
+            f.flush()
+            self.run_command(["restore", f.name])
+
+
+class BluetoothBackend(ThermostatBackend):
+    """Talks to the thermostat through one connection of the cometblue library"""
+
+    def __init__(self, address, pin, adapter="hci0"):
+        self.address = address
+        self.pin = pin
+        self.adapter = adapter
+        self.device = None
+
+    def connect(self):
+        import cometblue.device
+
+        device = cometblue.device.CometBlue(
+            self.address, adapter=self.adapter, pin=self.pin)
+        device.__enter__()
+        self.device = device
+
+    def disconnect(self):
+        device, self.device = self.device, None
+        if device is not None:
+            device.__exit__(None, None, None)
+
+    def get_battery(self):
+        return self.device.get_battery()
+
+    def set_datetime(self, value):
+        self.device.set_datetime(value)
+
+    def get_days(self):
+        return [[{key: time_x.strftime(TIME_FORMAT) if time_x else None
+                  for key, time_x in period.items()}
+                 for period in day] for day in self.device.get_days()]
+
+    def get_holidays(self):
+        return [{key: value.strftime(DATETIME_FORMAT)
+                 if isinstance(value, dt.datetime) else value
+                 for key, value in holiday.items()}
+                for holiday in self.device.get_holidays()]
+
+    def get_temperatures(self):
+        return self.device.get_temperatures()
+
+    def set_temperatures(self, temps):
+        self.device.set_temperatures(temps)
+        return self.device.get_temperatures()
+
+    def get_lcd_timer(self):
+        return self.device.get_lcd_timer()
+
+    def restore(self, data):
+        self.device.restore(decode_backup(data))
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    return dt.datetime.strptime(value, TIME_FORMAT).time()
+
+
+def parse_datetime(value):
+    if value is None:
+        return None
+    return dt.datetime.strptime(value.replace(" ", "T"), DATETIME_FORMAT)
+
+
+def decode_backup(data):
+    """Converts config.json style strings to the library's time objects"""
+    data = copy.deepcopy(data)
+    if "days" in data:
+        data["days"] = [[{"start": parse_time(period["start"]),
+                          "end": parse_time(period["end"])}
+                         for period in day] for day in data["days"]]
+    if "holidays" in data:
+        data["holidays"] = [{"start": parse_datetime(holiday["start"]),
+                             "end": parse_datetime(holiday["end"]),
+                             "temp": holiday["temp"]}
+                            for holiday in data["holidays"]]
+    return data
+
+
+class FakeThermostat(ThermostatBackend):
+    """In-process thermostat for tests and dry runs
+
+    Keeps the device state in memory and counts connections and operations,
+    so callers can check how much radio traffic a code path would cause.
+    """
+
+    def __init__(self, current_temp=19.0, battery=80):
+        self.connected = False
+        self.connections = 0
+        self.operations = 0
+        self.battery = battery
+        self.datetime = None
+        self.days = [[{"start": None, "end": None}] * 4 for _ in range(7)]
+        self.holidays = [{"start": None, "end": None, "temp": None}] * 8
+        self.lcd_timer = {"preload": 30, "current": 30}
+        self.temperatures = {
+            "current_temp": current_temp,
+            "manual_temp": 21.0,
+            "target_temp_l": 16.0,
+            "target_temp_h": 21.0,
+            "offset_temp": 0.0,
+            "window_open_detection": 4,
+            "window_open_minutes": 10,
+        }
+
+    def connect(self):
+        self.connected = True
+        self.connections += 1
+
+    def disconnect(self):
+        self.connected = False
+
+    def operation(self):
+        if not self.connected:
+            raise RuntimeError("Not connected")
+        self.operations += 1
+
+    def get_battery(self):
+        self.operation()
+        return self.battery
+
+    def set_datetime(self, value):
+        self.operation()
+        self.datetime = value
+
+    def get_days(self):
+        self.operation()
+        return copy.deepcopy(self.days)
+
+    def get_holidays(self):
+        self.operation()
+        return copy.deepcopy(self.holidays)
+
+    def get_temperatures(self):
+        self.operation()
+        return dict(self.temperatures)
+
+    def set_temperatures(self, temps):
+        self.operation()
+        for field, value in temps.items():
+            if field not in TEMPERATURE_OPTIONS:
+                raise KeyError("Unknown temperature field '{}'".format(field))
+            self.temperatures[field] = value
+        return dict(self.temperatures)
+
+    def get_lcd_timer(self):
+        self.operation()
+        return dict(self.lcd_timer)
+
+    def restore(self, data):
+        self.operation()
+        if "days" in data:
+            self.days = copy.deepcopy(data["days"])
+        if "holidays" in data:
+            self.holidays = copy.deepcopy(data["holidays"])
+        if "lcd_timer" in data:
+            self.lcd_timer["preload"] = data["lcd_timer"]["preload"]
+        if "temperatures" in data:
+            # Like the device, ignore unknown fields such as "temp_offset"
+            self.temperatures.update(
+                (field, value) for field, value in data["temperatures"].items()
+                if field in TEMPERATURE_OPTIONS and value is not None)
+
+
+class ThermostatSession(object):
+    """Shares one backend connection between many operations
+
+    Use as a context manager around a group of operations; nested uses
+    share the outer connection. Failed operations are retried after
+    reconnecting, up to `retries` times.
+
+    The session also remembers the last known device state, so that writes
+    of values the device already has can be skipped entirely. With a
+    `limiter`, a slot of it is held from connecting until disconnecting.
+    """
+
+    def __init__(self, backend, retries=3, retry_delay=2, state_max_age=600,
+                 limiter=None):
+        self.backend = backend
+        self.limiter = limiter
+        self.holding_limiter = False
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.state_max_age = state_max_age
+        self.depth = 0
+        self.connected = False
+        self.temperatures = None
+        self.temperatures_time = 0
+        self.restored_data = None
+        self.logger = logging.getLogger("root")
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.depth -= 1
+        if self.depth == 0:
+            self.close()
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            try:
+                self.backend.disconnect()
+            except (RuntimeError, OSError) as e:
+                self.logger.warning("Disconnecting failed: {}".format(e))
+        if self.holding_limiter:
+            self.holding_limiter = False
+            self.limiter.release()
+
+    def call(self, method, *args):
+        with THERMOSTAT_CALL_SECONDS.labels(method).time():
+            result = self.call_with_retries(method, *args)
+        if self.depth == 0:
+            self.close()
+        return result
+
+    def call_with_retries(self, method, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                if not self.connected:
+                    if self.limiter is not None and not self.holding_limiter:
+                        self.limiter.acquire()
+                        self.holding_limiter = True
+                    THERMOSTAT_CONNECTIONS.inc()
+                    self.backend.connect()
+                    self.connected = True
+                return getattr(self.backend, method)(*args)
+            except (RuntimeError, OSError) as e:
+                THERMOSTAT_RETRIES.labels(method).inc()
+                self.close()
+                if attempt == self.retries:
+                    raise
+                self.logger.warning("Thermostat '{}' failed ({}), retrying "
+                                    "in {} s...".format(method, e, self.retry_delay))
+                time.sleep(self.retry_delay)
+
+    def get_battery(self):
+        return self.call("get_battery")
+
+    def set_datetime(self, value=None):
+        return self.call("set_datetime", value or dt.datetime.now())
+
+    def get_days(self):
+        return self.call("get_days")
+
+    def get_holidays(self):
+        return self.call("get_holidays")
+
+    def get_temperatures(self):
+        self.temperatures = self.call("get_temperatures")
+        self.temperatures_time = time.monotonic()
+        return dict(self.temperatures)
+
+    def set_temperatures(self, temps):
+        # The device no longer matches what was restored last
+        self.restored_data = None
+        self.temperatures = None
+        self.temperatures = self.call("set_temperatures", temps)
+        self.temperatures_time = time.monotonic()
+        return dict(self.temperatures)
+
+    def known_temperatures(self):
+        """Returns the last read temperatures, reading them if too old"""
+        if self.temperatures is None or \
+                time.monotonic() - self.temperatures_time > self.state_max_age:
+            return self.get_temperatures()
+        return dict(self.temperatures)
+
+    def apply_temperatures(self, temps):
+        """Brings the device to the given temperature fields with one write
+
+        Only fields which differ from the last known state are written, and
+        they are verified from the state read back by that write. Returns
+        the resulting temperatures.
+        """
+        known = self.known_temperatures()
+        changes = dict((field, value) for field, value in temps.items()
+                       if known.get(field) != value)
+        if not changes:
+            self.logger.debug("Temperatures already set: {}".format(temps))
+            return known
+        self.logger.info("Writing temperatures: {}".format(changes))
+        result = self.set_temperatures(changes)
+        failed = dict((field, result.get(field)) for field, value
+                      in changes.items() if result.get(field) != value)
+        if failed:
+            raise RuntimeError(
+                "Thermostat did not take temperatures: {}".format(failed))
+        return result
+
+    def get_lcd_timer(self):
+        return self.call("get_lcd_timer")
+
+    def restore(self, data):
+        """Writes a backup, unless it is the one this session wrote last"""
+        if data == self.restored_data:
+            self.logger.debug("Backup already restored, skipping")
+            return
+        self.restored_data = None
+        self.temperatures = None
+        self.call("restore", data)
+        self.restored_data = copy.deepcopy(data)
+
+
+def normalize_section(section, value, reported=False):
+    """Brings a config.json section into the form the device reports it in
+
+    Times are rounded down to the 10 minute resolution of the device and
+    fields the device does not store are dropped, so that a section read
+    back from the device compares equal to the one that was written.
+    """
+    def round_time(value):
+        if value is None:
+            return None
+        time_x = parse_time(value)
+        return time_x.replace(minute=time_x.minute - time_x.minute % 10,
+                              second=0).strftime(TIME_FORMAT)
+
+    if section == "days":
+        return [[{"start": round_time(period["start"]),
+                  "end": round_time(period["end"])}
+                 for period in day] for day in value]
+    if section == "holidays":
+        return [{"start": holiday["start"] and parse_datetime(
+                     holiday["start"]).strftime(DATETIME_FORMAT),
+                 "end": holiday["end"] and parse_datetime(
+                     holiday["end"]).strftime(DATETIME_FORMAT),
+                 "temp": holiday["temp"]} for holiday in value]
+    if section == "lcd_timer":
+        return {"preload": value["preload"]}
+    return value
+
+
+def content_hash(value):
+    return hashlib.sha1(
+        json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ConfigSync(object):
+    """Keeps the thermostat in line with config.json at minimal radio cost
+
+    The file is only re-read when its mtime changes. What the device last
+    reported for every section is cached as a content hash (re-read after
+    `snapshot_max_age` seconds), and only the sections whose hash differs
+    from the file are pushed. Temperatures go through the session's field
+    level diff instead.
+    """
+
+    SECTIONS = ["days", "holidays", "lcd_timer"]
+
+    def __init__(self, session, config_file, snapshot_max_age=24 * 3600):
+        self.session = session
+        self.config_file = config_file
+        self.snapshot_max_age = snapshot_max_age
+        self.config = None
+        self.config_mtime = None
+        self.config_hashes = {}
+        self.device = {}
+        self.device_hashes = {}
+        self.device_time = 0
+        self.logger = logging.getLogger("root")
+
+    def load(self):
+        mtime = os.stat(self.config_file).st_mtime
+        if mtime != self.config_mtime:
+            self.logger.info("Reading config file: {}".format(self.config_file))
+            with open(self.config_file) as f:
+                self.config = json.load(f)
+            self.config_mtime = mtime
+            self.config_hashes = dict(
+                (section, content_hash(normalize_section(section, value)))
+                for section, value in self.config.items()
+                if section in self.SECTIONS)
+        return self.config
+
+    def read_device(self):
+        self.logger.info("Reading configuration snapshot from thermostat...")
+        for section in self.SECTIONS:
+            value = normalize_section(
+                section, getattr(self.session, "get_" + section)())
+            self.device[section] = value
+            self.device_hashes[section] = content_hash(value)
+        self.device_time = time.monotonic()
+
+    def sync(self):
+        """Pushes the sections of config.json which the device differs in"""
+        config = self.load()
+        with self.session:
+            if not self.device_hashes or \
+                    time.monotonic() - self.device_time > self.snapshot_max_age:
+                self.read_device()
+            changed = [section for section in self.SECTIONS
+                       if section in config and
+                       self.config_hashes[section] != self.device_hashes[section]]
+            if changed:
+                self.logger.info("Pushing config sections: {}".format(changed))
+                self.session.restore(
+                    dict((section, config[section]) for section in changed))
+                for section in changed:
+                    self.device[section] = normalize_section(
+                        section, config[section])
+                    self.device_hashes[section] = self.config_hashes[section]
+            if "temperatures" in config:
+                self.session.apply_temperatures(dict(
+                    (field, value)
+                    for field, value in config["temperatures"].items()
+                    if field in TEMPERATURE_OPTIONS and value is not None))
+
+    def days(self):
+        """Returns the weekly schedule as currently stored on the device"""
+        return copy.deepcopy(self.device["days"])
+
+
+def make_backend(name, address, pin, adapter="hci0"):
+    if name == "bluetooth":
+        return BluetoothBackend(address, pin, adapter)
+    if name == "cli":
+        return CommandLineBackend(address, pin)
+    if name == "fake":
+        return FakeThermostat()
+    raise ValueError("Unknown thermostat backend '{}'".format(name))
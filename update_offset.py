@@ -1,21 +1,41 @@
 #!/usr/bin/env python3
-import subprocess
-import time
 import logging
 import logging.handlers
 import os
-import json
+import signal
 import sys
+import threading
+import time
 import pprint
 import datetime as dt
+import metrics
+import thermostat
+import fusion
+import binlog
+from schedule import WeeklySchedule
+from events import EventScheduler
+from sensor_feed import FEED_FILE, SensorFeedReader
+
+# Readings older than this are not used for offset corrections
+MAX_READING_AGE = 120
+# How far past the .5 rounding boundary the temperature difference has to
+# move before the offset is changed
+OFFSET_HYSTERESIS = 0.3
+# First wait in seconds before a failed wake-up of a controller is retried,
+# doubling with every failure in a row up to the correction interval
+RETRY_DELAY = 30
+
+# Defaults for settings missing from older configuration files
+BT_MAC_ADDR = None
+BT_PIN = 1762
+BT_ADAPTER = "hci0"
+BT_CONNECTIONS_PER_ADAPTER = 2
+THERMOSTAT_BACKEND = "bluetooth"
+METRICS_PORT = 8024
+DEVICES = []
+STRUCTURED_LOG = False
 from configuration import *
 
-# First part of the actual command:
-# "cometblue -f json device -p 1762 80:30:DC:E9:4E:50" + " get temperatures"
-BASE_COMMAND_WRITE = "cometblue device -p 1762 {}".format(BT_MAC_ADDR)
-BASE_COMMAND_READ = BASE_COMMAND_WRITE.replace(
-    "cometblue", "cometblue -f json")  # Read values in JSON format
-
 
 def setup_logger():
     logger = logging.getLogger("root")
@@ -25,7 +45,8 @@ def setup_logger():
 
     # Define format
     formatter = logging.Formatter(
-        "%(asctime)s :: %(levelname)-5s :: %(funcName)17s() :: %(message)s")
+        "%(asctime)s :: %(levelname)-5s :: %(threadName)s :: %(funcName)17s() :: "
+        "%(message)s")
     formatter.default_time_format = "%Y-%m-%d %H:%M:%S"
     formatter.default_msec_format = "%s.%03d"
 
@@ -35,7 +56,8 @@ def setup_logger():
         dirname + "/logs/update_offset.log",
         when='midnight',
         backupCount=200)
-    fh_info.setLevel(logging.DEBUG)
+    # With the structured log, per-cycle details only go to the binary log
+    fh_info.setLevel(logging.INFO if STRUCTURED_LOG else logging.DEBUG)
     fh_info.setFormatter(formatter)
     logger.addHandler(fh_info)
 
@@ -44,170 +66,360 @@ def setup_logger():
     ch.setLevel(logging.ERROR)
     ch.setFormatter(formatter)
     logger.addHandler(ch)
+
+    if STRUCTURED_LOG:
+        binlog.setup(dirname + "/logs/update_offset.bin")
     return logger
 
 
-def run_command(command):
+def configured_devices():
+    """Returns the DEVICES entries with defaults filled in
+
+    Without DEVICES, the single thermostat at BT_MAC_ADDR is paired with
+    the DHT22 of this Pi.
+    """
+    dirname = os.path.split(os.path.abspath(__file__))[0]
+    defaults = {
+        "pin": BT_PIN,
+        "adapter": BT_ADAPTER,
+        "backend": THERMOSTAT_BACKEND,
+        "config": dirname + "/config.json",
+        "feed": FEED_FILE,
+        "sensor": "dht_22",
+    }
+    if not DEVICES:
+        return [dict(defaults, name="default", address=BT_MAC_ADDR)]
+    return [dict(defaults, **device) for device in DEVICES]
+
+
+def create_session(device):
+    backend = thermostat.make_backend(
+        device["backend"], device["address"], device["pin"], device["adapter"])
+    limiter = thermostat.adapter_limiter(
+        device["adapter"], BT_CONNECTIONS_PER_ADAPTER)
+    return thermostat.ThermostatSession(backend, limiter=limiter)
+
+
+def update_schedule(schedule, days):
+    """Compiles the weekly schedule, unless `days` did not change"""
+    if schedule is not None and schedule.days == days:
+        return schedule
     logger = logging.getLogger("root")
-    logger.debug("Running command: '{}'".format(command))
-    result = subprocess.run([command], stdout=subprocess.PIPE, shell=True)
-    if result.returncode != 0:
-        error_message = "Command '{}' failed!".format(command)
-        logger.error(error_message)
-        raise RuntimeError(error_message)
-    return result.stdout
-
-
-def get_current_timeslot(active_timeslots):
-    for timeslot in active_timeslots:
-        if timeslot["start"] < dt.datetime.now() < timeslot["end"]:
-            return timeslot
-    return None
-
-
-def get_slots_for_day(all_active_timeslots, date_x):
-    active_timeslots = all_active_timeslots[date_x.weekday()]
-    # Filter out invalid timeslots: null and empty ones
-    valid_timeslots = list(
-        filter(lambda t: (t["start"] != t["end"] != None), active_timeslots))
-
-    def timeslot_to_datetime(timeslot):
-        formatted_timeslot = {}
-        for key in ["start", "end"]:
-            value = timeslot[key]
-            time_x = dt.datetime.strptime(value, "%H:%M:%S").time()
-            date_time = dt.datetime.combine(date_x, time_x)
-            formatted_timeslot[key] = date_time
-        return formatted_timeslot
-    return list(map(timeslot_to_datetime, valid_timeslots))
+    schedule = WeeklySchedule(days)
+    logger.info("Active timeslots: \n{}".format(pprint.pformat(
+        ["{} -> {}".format(dt.timedelta(seconds=start), dt.timedelta(seconds=end))
+         for start, end in zip(schedule.starts, schedule.ends)])))
+    return schedule
 
 
 def timeslot_to_str(ts):
     return "{} -> {}".format(ts["start"], ts["end"])
 
 
-def restore_config():
+def restore_config(config_sync):
     logger = logging.getLogger("root")
-    config_file = os.path.split(os.path.abspath(__file__))[0] + "/config.json"
-    logger.info("Config file: {}".format(config_file))
-    run_command(BASE_COMMAND_WRITE + " restore " + config_file)
+    logger.info("Config file: {}".format(config_sync.config_file))
+    config_sync.sync()
     logger.info("Config restored successfully")
 
 
-def main():
-    setup_logger()
+class SensorSource(object):
+    """Filtered readings of one sensor published by room_thermometer
+
+    New feed samples are passed through a TemperatureFusion, with the
+    Sense HAT as a fallback when the feed has one.
+    """
+
+    def __init__(self, feed_file=FEED_FILE, sensor="dht_22"):
+        self.feed_file = feed_file
+        self.sensor = sensor
+        self.reader = None
+        self.fusion = None
+        self.seen = {}
+        self.humidity = None
+
+    def open(self):
+        self.reader = SensorFeedReader(self.feed_file)
+        secondary = "sense_hat" if self.sensor != "sense_hat" and \
+            "sense_hat" in self.reader.sensors else None
+        self.fusion = fusion.TemperatureFusion(
+            self.sensor, secondary, max_age=MAX_READING_AGE)
+        self.seen = {}
+
+    def new_samples(self, sensor):
+        """Samples published since the last call, oldest first"""
+        last = self.seen.get(sensor, 0)
+        n = 8
+        while True:
+            samples = self.reader.read(sensor, n)[1]
+            if len(samples) < n or samples[-1].timestamp <= last or \
+                    n >= self.reader.capacity:
+                break
+            n *= 4
+        samples = [sample for sample in reversed(samples)
+                   if sample.timestamp > last]
+        if samples:
+            self.seen[sensor] = samples[-1].timestamp
+        return samples
+
+    def read(self):
+        """Returns the filtered temperature and the latest humidity
+
+        Raises RuntimeError when the feed has no recent reading.
+        """
+        if self.reader is None or self.reader.replaced():
+            try:
+                self.open()
+            except (OSError, ValueError) as e:
+                raise RuntimeError("Cannot open the sensor feed {}: {}".format(
+                    self.feed_file, e))
+        sensors = [self.sensor]
+        if self.fusion.secondary is not None:
+            sensors.append(self.fusion.secondary.name)
+        for sensor in sensors:
+            for sample in self.new_samples(sensor):
+                self.fusion.update(
+                    sensor, sample.timestamp, sample.temperature)
+                if sensor == self.sensor and sample.humidity is not None:
+                    self.humidity = sample.humidity
+        temperature = self.fusion.temperature(time.time())
+        if temperature is None:
+            raise RuntimeError("No recent {} reading in {}".format(
+                self.sensor, self.feed_file))
+        return temperature, self.humidity
+
+
+def setup_thermostat(session, config_sync, schedule):
+    """Restores the config, checks the device and returns the schedule"""
     logger = logging.getLogger("root")
-    while True:
+    # One connection for the whole setup sequence
+    with session:
         # Write "good" config
-        restore_config()
+        restore_config(config_sync)
 
         # Log battery level
         logger.info("Getting battery information from thermostat...")
-        result_stdout = run_command(BASE_COMMAND_READ + " get battery")
-        battery_level = result_stdout.decode("utf-8")
+        battery_level = session.get_battery()
         logger.info("Battery = {} %".format(battery_level))
 
         # Ensure correct time is set on cometblue
         logger.info("Setting time on cometblue...")
-        run_command(BASE_COMMAND_WRITE + " set datetime")
+        session.set_datetime()
         logger.info("Time set successfully")
 
-        # Read timeslots
-        logger.info("Reading active timeslots from cometblue...")
-        result_stdout = run_command(BASE_COMMAND_READ + " get days")
-        all_active_timeslots = json.loads(result_stdout)
-        today = dt.date.today()
-        tomorrow = dt.date.today() + dt.timedelta(days=1)
-        # Add one extra slot from next day
-        active_timeslots = \
-            get_slots_for_day(all_active_timeslots, today) + \
-            get_slots_for_day(all_active_timeslots, tomorrow)[:1]
-        logger.info("Active timeslots: \n{}".format(
-            pprint.pformat(list(map(timeslot_to_str, active_timeslots)))))
-
-        current_timeslot = get_current_timeslot(active_timeslots)
-        if current_timeslot is None:
-            # Step(1): Set the offset temperature to 0'C and setpoint to 10'C
-            run_command(BASE_COMMAND_WRITE +
-                        " set temperatures --temp-offset 0")
-            run_command(BASE_COMMAND_WRITE +
-                        " set temperatures --temp-target-high 10")
-            run_command(BASE_COMMAND_WRITE +
-                        " set temperatures --temp-manual 10")
-
-            # Step(2): Find immediate next timeslot
-            upcoming_timeslots = filter(
-                lambda ts: ts["start"] > dt.datetime.now(), active_timeslots)
-            upcoming_starting_times = map(
-                lambda ts: ts["start"], upcoming_timeslots)
-            next_start_time = min(upcoming_starting_times)
-
-            # Step(3): Sleep for the difference
-            time_to_sleep = next_start_time - dt.datetime.now().replace(microsecond=0)
-            logger.info(
-                "Next active timeslot starts at: {}".format(next_start_time))
-            logger.info(
-                "Sleeping for {} ...".format(time_to_sleep))
-            time.sleep(time_to_sleep.total_seconds())
+        # Timeslots as last read from or written to the cometblue
+        return update_schedule(schedule, config_sync.days())
+
+
+class ThermostatController(object):
+    """Runs the schedule and offset loop of one thermostat
+
+    Sleeps in its own EventScheduler until a slot starts or ends, the
+    config file changes, the room temperature moves or the next correction
+    is due. The temperature only counts as moved once it is further from
+    the one of the last correction than the offset hysteresis lets pass,
+    so noise around a rounding boundary does not cost radio sessions.
+
+    A failed wake-up, e.g. a thermostat out of range after its retries, is
+    logged and retried after a backoff. It never stops the controllers of
+    the other thermostats.
+    """
+
+    def __init__(self, device):
+        self.name = device["name"]
+        self.session = create_session(device)
+        self.config_sync = thermostat.ConfigSync(self.session, device["config"])
+        self.sensor = SensorSource(device["feed"], device["sensor"])
+        self.scheduler = EventScheduler()
+        self.deadband = 0.5 + OFFSET_HYSTERESIS
+        self.corrected_temp = None
+        self.moves = 0
+        self.schedule = None
+        self.current_timeslot = None
+        self.needs_setup = True
+        self.failures = 0
+
+    def stop(self):
+        self.scheduler.cancel()
+
+    def sensor_moves(self):
+        """Counts the times the temperature left the deadband
+
+        Returns None, which the scheduler ignores, while the feed has no
+        recent reading.
+        """
+        try:
+            temperature = self.sensor.read()[0]
+        except RuntimeError:
+            return None
+        if self.corrected_temp is not None and \
+                abs(temperature - self.corrected_temp) > self.deadband:
+            self.corrected_temp = temperature
+            self.moves += 1
+        return self.moves
+
+    def retry_delay(self):
+        """Seconds to wait after the current run of failures"""
+        return min(RETRY_DELAY * 2 ** (self.failures - 1), SLEEP_MINUTES * 60)
+
+    def run(self):
+        logger = logging.getLogger("root")
+        config_sync, scheduler = self.config_sync, self.scheduler
+        # Wake up early when the schedule is edited or the room temperature moves
+        scheduler.watch("config",
+                        lambda: os.stat(config_sync.config_file).st_mtime)
+        scheduler.watch("sensor", self.sensor_moves)
+
+        reasons = ["startup"]
+        while reasons is not None:
+            logger.info("Woken up by: {}".format(", ".join(reasons)))
+            try:
+                self.wake_up(reasons)
+                self.failures = 0
+            except Exception:
+                self.failures += 1
+                delay = self.retry_delay()
+                logger.exception("Controller '{}' failed, retrying in {} s"
+                                 .format(self.name, delay))
+                scheduler.call_later(delay, "retry")
+            reasons = scheduler.wait()
+        logger.info("Shutting down")
+        self.session.close()
+
+    def wake_up(self, reasons):
+        """Sets the thermostat up if needed and corrects its offset"""
+        logger = logging.getLogger("root")
+        session, config_sync, scheduler = \
+            self.session, self.config_sync, self.scheduler
+        if self.needs_setup or set(reasons) & {"config", "transition"}:
+            # Done again after a failure, until it went through once
+            self.needs_setup = True
+            self.schedule = setup_thermostat(session, config_sync,
+                                             self.schedule)
+            timeslot = self.schedule.current_slot()
+            if self.current_timeslot is not None and \
+                    timeslot != self.current_timeslot:
+                logger.info("Timeslot [{}] ended".format(
+                    timeslot_to_str(self.current_timeslot)))
+            self.current_timeslot = timeslot
+
+            if self.current_timeslot is None:
+                # Set the offset temperature to 0'C and setpoint to 10'C
+                session.apply_temperatures(
+                    {"offset_temp": 0, "target_temp_h": 10, "manual_temp": 10})
+                scheduler.cancel_timer("correction")
+            else:
+                logger.info("Current active timeslot is: [{}]".format(
+                    timeslot_to_str(self.current_timeslot)))
+
+            # Wake up exactly at the next slot start or end
+            next_transition = self.schedule.next_transition()
+            if next_transition is None:
+                logger.info("No active timeslots")
+                scheduler.cancel_timer("transition")
+            else:
+                logger.info("Next transition at: {}".format(next_transition))
+                scheduler.call_at(next_transition, "transition")
+            self.needs_setup = False
+
+        if self.current_timeslot is not None:
+            temperature = correct_offset(
+                session, self.current_timeslot, self.sensor, self.name)
+            if temperature is not None:
+                self.corrected_temp = temperature
+            scheduler.call_later(SLEEP_MINUTES * 60, "correction")
 
-        else:
-            # Start the monitoring loop
-            logger.info("Current active timeslot is: [{}]".format(
-                timeslot_to_str(current_timeslot)))
-            monitoring_loop(current_timeslot)
-            logger.info("Timeslot [{}] ended".format(
-                timeslot_to_str(current_timeslot)))
-            # After the while loop, write the JSON config again
-            restore_config()
 
-
-def monitoring_loop(current_timeslot):
+def main():
+    setup_logger()
     logger = logging.getLogger("root")
-    while dt.datetime.now() < current_timeslot["end"]:
-        logger.info("Running loop for the slot [{}]".format(
-            timeslot_to_str(current_timeslot)))
-        """ Step (1) """
-        sensor_data_file = "/tmp/dht22_reading.txt"
-        with open(sensor_data_file) as f:
-            logger.info(
-                "Read DHT22 sensor file: '{}'".format(sensor_data_file))
-            lines = f.readlines()
-            dht22_temp = float(lines[0])
-            dht22_hum = float(lines[1])
-        logger.info(
-            "DHT22 sensor reports: Temp = {:.2f} C, Hum = {:.2f} %".format(dht22_temp, dht22_hum))
-
+    metrics.serve(METRICS_PORT)
+    controllers = [ThermostatController(device)
+                   for device in configured_devices()]
+    failed = []
+
+    def stop(signum=None, frame=None):
+        for controller in controllers:
+            controller.stop()
+
+    def run(controller):
+        # Failures of a thermostat are retried inside its controller, this
+        # only catches bugs; the other rooms keep being controlled
+        try:
+            controller.run()
+        except Exception:
+            logger.exception("Controller '{}' failed".format(controller.name))
+            failed.append(controller.name)
+
+    signal.signal(signal.SIGTERM, stop)
+    # Controllers mostly wait; the radio is shared through adapter_limiter
+    threads = [threading.Thread(target=run, args=(controller,),
+                                name="thermostat-" + controller.name)
+               for controller in controllers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failed:
+        sys.exit(1)
+
+
+def correct_offset(session, current_timeslot, sensor, name="default"):
+    """Sets the offset for the sensor temperature, which it returns
+
+    Returns None without touching the thermostat when the sensor has no
+    recent reading.
+    """
+    logger = logging.getLogger("root")
+    # Routine details are only kept in the text log without the binary one
+    log = logger.debug if STRUCTURED_LOG else logger.info
+    log("Running loop for the slot [{}]".format(
+        timeslot_to_str(current_timeslot)))
+    """ Step (1) """
+    try:
+        dht22_temp, dht22_hum = sensor.read()
+    except RuntimeError as e:
+        # Without a current reading the offset is left as it is
+        logger.warning("Skipping the offset correction: {}".format(e))
+        return None
+    log("DHT22 sensor reports: Temp = {:.2f} C (filtered), Hum = {} %".format(
+        dht22_temp, dht22_hum))
+
+    # Read, correct and verify over a single connection
+    with session:
         """ Step (2) """
-        logger.info("Reading temperature from cometblue...")
-        result_stdout = run_command(BASE_COMMAND_READ + " get temperatures")
-        cometblue_temperatures = json.loads(result_stdout)
-        logger.info("All temperatures: \n{}".format(
+        log("Reading temperature from cometblue...")
+        cometblue_temperatures = session.get_temperatures()
+        log("All temperatures: \n{}".format(
             pprint.pformat(cometblue_temperatures)))
-        logger.info("Cometblue reports: {} C".format(
+        log("Cometblue reports: {} C".format(
             cometblue_temperatures["current_temp"]))
 
         """ Step (3) """
-        correct_offset = round(
-            dht22_temp - cometblue_temperatures["current_temp"])
-        logger.info("Correct offset is: {} C".format(correct_offset))
+        correct_offset = fusion.hysteresis_offset(
+            dht22_temp - cometblue_temperatures["current_temp"],
+            cometblue_temperatures["offset_temp"], OFFSET_HYSTERESIS)
+        log("Correct offset is: {} C".format(correct_offset))
 
         if cometblue_temperatures["offset_temp"] != correct_offset:
             logger.info("Setting correct offset...")
-            run_command(
-                BASE_COMMAND_WRITE +
-                " set temperatures --temp-offset {}".format(correct_offset))
-            result_stdout = run_command(
-                BASE_COMMAND_READ + " get temperatures")
-            cometblue_temperatures = json.loads(result_stdout)
-            logger.info("Checking if offset is correct...")
-            assert correct_offset == cometblue_temperatures["offset_temp"]
+            # Verified from the state read back with the write
+            session.apply_temperatures({"offset_temp": correct_offset})
             logger.info("Successfully set the correct offset")
         else:
-            logger.info("Offset is already correct")
-
-        # Sleep
-        logger.info("Sleeping for {} minutes...".format(SLEEP_MINUTES))
-        time.sleep(SLEEP_MINUTES * 60)
+            log("Offset is already correct")
+
+    if STRUCTURED_LOG:
+        binlog.log_record(
+            logging.getLogger("binlog"), "offset", time.time(), device=name,
+            sensor_temp=dht22_temp, sensor_humidity=dht22_hum,
+            current_temp=cometblue_temperatures["current_temp"],
+            offset_temp=cometblue_temperatures["offset_temp"],
+            new_offset=correct_offset,
+            target_temp_l=cometblue_temperatures.get("target_temp_l"),
+            target_temp_h=cometblue_temperatures.get("target_temp_h"),
+            manual_temp=cometblue_temperatures.get("manual_temp"))
+    return dht22_temp
 
 
 if __name__ == "__main__":